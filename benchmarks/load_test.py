@@ -0,0 +1,477 @@
+"""
+Нагрузочный тест бота без сети.
+
+Синтетические обновления Telegram подаются в настоящий Dispatcher с роутерами
+из handlers/ (как в main.create_dispatcher). Запросы к Telegram обрабатывает
+заглушка сессии бота, ответы модели - заглушка PollinationsService с настраиваемой
+задержкой. База данных - отдельный временный файл SQLite.
+
+Запуск из корня репозитория:
+    python -m benchmarks.load_test --users 50 --rate 20 --duration 30
+    python -m benchmarks.load_test --llm-latency lognormal:0.8:0.5 --streaming --json report.json
+
+Распределения задержек: fixed:СЕК, uniform:МИН:МАКС, exp:СРЕДНЕЕ, lognormal:МЕДИАНА:SIGMA.
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+# Идентификаторы синтетических пользователей и сообщений бота
+FIRST_USER_ID = 100000
+FIRST_BOT_MESSAGE_ID = 10 ** 9
+
+# Этапы обработки сообщения, которые относятся к базе данных (services.metrics.STAGE_DURATION)
+DB_STAGES = ("db_context", "db_write")
+
+
+class LatencyDistribution:
+    """Распределение задержки, заданное строкой вида "вид:параметры" """
+    
+    def __init__(self, spec: str, rng: random.Random):
+        self.spec = spec
+        self.rng = rng
+        kind, *params = spec.split(":")
+        self.kind = kind
+        self.params = [float(param) for param in params]
+        
+        expected = {'fixed': 1, 'uniform': 2, 'exp': 1, 'lognormal': 2}
+        if kind not in expected or len(self.params) != expected[kind]:
+            raise ValueError(f"Invalid latency distribution: {spec}")
+    
+    def sample(self) -> float:
+        """Случайная задержка в секундах"""
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return self.rng.uniform(*self.params)
+        if self.kind == 'exp':
+            return self.rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        median, sigma = self.params
+        return self.rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль q (0-100) методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test of the bot handlers")
+    parser.add_argument("--users", type=int, default=20, help="Synthetic users")
+    parser.add_argument("--rate", type=float, default=10.0, help="Updates per second (Poisson arrivals)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Load duration, seconds")
+    parser.add_argument("--command-ratio", type=float, default=0.05, help="Share of /help, /chats, /model commands")
+    parser.add_argument("--callback-ratio", type=float, default=0.05, help="Share of inline button presses")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="Share of repeated prompts (response cache)")
+    parser.add_argument("--llm-latency", default="lognormal:0.5:0.5", help="Fake model latency distribution")
+    parser.add_argument("--llm-words", type=int, default=80, help="Words in fake model responses")
+    parser.add_argument("--telegram-latency", default="fixed:0.02", help="Fake Telegram API latency distribution")
+    parser.add_argument("--streaming", action="store_true", help="Use streaming replies")
+    parser.add_argument("--send-limits", action="store_true", help="Apply Telegram send rate limits (SendScheduler)")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Seconds to wait for outstanding replies")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--db", help="SQLite file (default: new temporary file)")
+    parser.add_argument("--json", dest="json_path", help="Also write the report as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args: argparse.Namespace) -> str:
+    """Настраивает окружение до импорта модулей бота (config читает его при импорте)"""
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="bot-load-"), "bot.db")
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:LOADTEST")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["DB_PATH"] = db_path
+    os.environ["STREAMING_ENABLED"] = "1" if args.streaming else "0"
+    os.environ["METRICS_ENABLED"] = "0"
+    os.environ["BOT_MODE"] = "polling"
+    os.environ["WORKERS"] = "1"
+    return db_path
+
+
+class ReplyTracker:
+    """
+    Замеряет время от поступления обновления до ответа бота.
+    Сообщение пользователя считается обработанным, когда бот отправил ответ на него
+    (или на более позднее сообщение того же пользователя - при объединении сообщений),
+    нажатие кнопки - когда бот ответил на callback.
+    """
+    
+    def __init__(self, placeholder: str):
+        self.placeholder = placeholder
+        self._pending = {}
+        self._callbacks = {}
+        self._placeholders = {}
+        self.latencies = []
+    
+    @property
+    def outstanding(self) -> int:
+        return sum(len(items) for items in self._pending.values()) + len(self._callbacks)
+    
+    def start_message(self, chat_id: int, message_id: int):
+        self._pending.setdefault(chat_id, []).append((message_id, time.perf_counter()))
+    
+    def start_callback(self, callback_id: str):
+        self._callbacks[callback_id] = time.perf_counter()
+    
+    def _complete(self, chat_id: int, reply_to: int = None):
+        """Отмечает обработанными сообщения чата до reply_to включительно (все, если не указано)"""
+        now = time.perf_counter()
+        remaining = []
+        for message_id, started in self._pending.get(chat_id, []):
+            if reply_to is None or message_id <= reply_to:
+                self.latencies.append(now - started)
+            else:
+                remaining.append((message_id, started))
+        self._pending[chat_id] = remaining
+    
+    def on_request(self, method, sent_message_id: int):
+        """Разбирает запрос бота к Telegram"""
+        from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendDocument, SendMessage
+        
+        if isinstance(method, AnswerCallbackQuery):
+            started = self._callbacks.pop(method.callback_query_id, None)
+            if started is not None:
+                self.latencies.append(time.perf_counter() - started)
+        
+        elif isinstance(method, (SendMessage, SendDocument)):
+            reply_to = method.reply_parameters.message_id if method.reply_parameters else None
+            if isinstance(method, SendMessage) and method.text == self.placeholder:
+                # Промежуточное сообщение потоковой выдачи - ответ будет позже
+                self._placeholders[(method.chat_id, sent_message_id)] = reply_to
+            else:
+                self._complete(method.chat_id, reply_to)
+        
+        elif isinstance(method, EditMessageText):
+            # Промежуточные редактирования отправляются без разметки, финальное - с ней
+            key = (method.chat_id, method.message_id)
+            if method.parse_mode is not None and key in self._placeholders:
+                self._complete(method.chat_id, self._placeholders.pop(key))
+
+
+def create_stub_session(latency: LatencyDistribution, tracker: ReplyTracker):
+    """Создает сессию бота, которая отвечает на запросы без обращения к Telegram"""
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import EditMessageText, GetMe, SendDocument, SendMessage
+    from aiogram.types import Chat, Message, User
+    
+    class StubSession(BaseSession):
+        """Заглушка Telegram Bot API"""
+        
+        def __init__(self):
+            super().__init__()
+            self.requests = Counter()
+            self._message_ids = iter(range(FIRST_BOT_MESSAGE_ID, sys.maxsize))
+        
+        async def make_request(self, bot, method, timeout=None):
+            self.requests[type(method).__name__] += 1
+            delay = latency.sample()
+            if delay:
+                await asyncio.sleep(delay)
+            
+            result = True
+            sent_message_id = None
+            if isinstance(method, GetMe):
+                result = User(id=bot.id, is_bot=True, first_name="LoadTestBot", username="load_test_bot")
+            elif isinstance(method, (SendMessage, SendDocument, EditMessageText)):
+                sent_message_id = getattr(method, 'message_id', None) or next(self._message_ids)
+                result = Message(
+                    message_id=sent_message_id,
+                    date=datetime.now(timezone.utc),
+                    chat=Chat(id=method.chat_id, type="private"),
+                    text=getattr(method, 'text', None)
+                ).as_(bot)
+            
+            tracker.on_request(method, sent_message_id)
+            return result
+        
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b""
+        
+        async def close(self):
+            pass
+    
+    return StubSession()
+
+
+def create_fake_service(latency: LatencyDistribution, words: int):
+    """
+    Создает заглушку PollinationsService: настоящие ограничения одновременных
+    запросов (AdmissionController), но ответ генерируется локально
+    """
+    from services.pollinations_api import PollinationsService
+    from services.providers import FakeProvider
+    
+    class FakePollinationsService(PollinationsService):
+        """PollinationsService без обращения к сети"""
+        
+        def __init__(self):
+            super().__init__()
+            self._responses = FakeProvider(words=words)
+            self.calls = 0
+        
+        async def generate_response(self, messages: list, model: str = "gpt-4") -> str:
+            async with self.admission.slot(model):
+                self.calls += 1
+                await asyncio.sleep(latency.sample())
+                return await self._responses.generate(messages, model)
+        
+        async def stream_response(self, messages: list, model: str = "gpt-4"):
+            async with self.admission.slot(model):
+                self.calls += 1
+                text = await self._responses.generate(messages, model)
+                words_list = text.split(" ")
+                delay = latency.sample() / len(words_list)
+                for i, word in enumerate(words_list):
+                    await asyncio.sleep(delay)
+                    yield word if i == 0 else f" {word}"
+    
+    return FakePollinationsService()
+
+
+class DbTimer:
+    """Замеряет время вызовов функций database.db (вложенные вызовы не считаются дважды)"""
+    
+    # Открытие и закрытие базы не относятся к обработке обновлений
+    SKIP = ("init_db", "close_db", "check_db")
+    
+    def __init__(self):
+        self.samples = {}
+        self._active = contextvars.ContextVar("db_timer_active", default=False)
+    
+    def install(self, module):
+        for name, function in inspect.getmembers(module, inspect.iscoroutinefunction):
+            if name.startswith("_") or name in self.SKIP or function.__module__ != module.__name__:
+                continue
+            setattr(module, name, self._wrap(name, function))
+    
+    def _wrap(self, name: str, function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if self._active.get():
+                return await function(*args, **kwargs)
+            token = self._active.set(True)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.samples.setdefault(name, []).append(time.perf_counter() - start)
+                self._active.reset(token)
+        return wrapper
+
+
+def make_message_update(update_id: int, user_id: int, message_id: int, text: str) -> dict:
+    """Сырое обновление с сообщением пользователя (как приходит от Telegram)"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user,
+            'text': text
+        }
+    }
+
+
+def make_callback_update(update_id: int, user_id: int, message_id: int, data: str) -> dict:
+    """Сырое обновление с нажатием кнопки под сообщением бота"""
+    update = make_message_update(update_id, user_id, message_id, "menu")
+    message = update.pop('message')
+    message['from'] = {'id': 123456, 'is_bot': True, 'first_name': "LoadTestBot"}
+    update['callback_query'] = {
+        'id': f"cb{update_id}",
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+        'chat_instance': str(user_id),
+        'message': message,
+        'data': data
+    }
+    return update
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """Проводит нагрузочный тест и возвращает отчет"""
+    configure_environment(args)
+    
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.enums import ParseMode
+    
+    import main
+    from config import BOT_TOKEN, STREAM_PLACEHOLDER
+    from database import db
+    from services import metrics
+    from services.send_scheduler import SendScheduler
+    
+    rng = random.Random(args.seed)
+    tracker = ReplyTracker(STREAM_PLACEHOLDER)
+    session = create_stub_session(LatencyDistribution(args.telegram_latency, rng), tracker)
+    ai_service = create_fake_service(LatencyDistribution(args.llm_latency, rng), args.llm_words)
+    db_timer = DbTimer()
+    db_timer.install(db)
+    
+    bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    if args.send_limits:
+        bot.session.middleware(SendScheduler())
+    
+    await db.init_db()
+    dp = main.create_dispatcher(ai_service)
+    tasks = set()
+    update_ids = iter(range(1, sys.maxsize))
+    message_ids = iter(range(1, FIRST_BOT_MESSAGE_ID))
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    sent = Counter()
+    
+    def feed(update: dict):
+        task = asyncio.create_task(dp.feed_raw_update(bot, update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    try:
+        # Регистрируем пользователей (не входит в замер)
+        await asyncio.gather(*(
+            dp.feed_raw_update(bot, make_message_update(next(update_ids), user_id, next(message_ids), "/start"))
+            for user_id in users
+        ))
+        tracker.latencies.clear()
+        db_timer.samples.clear()
+        stages_before = {
+            stage: (metrics.STAGE_DURATION.labels(stage).sum, metrics.STAGE_DURATION.labels(stage).count)
+            for stage in DB_STAGES
+        }
+        errors_before = metrics.ERRORS.children()
+        
+        prompts = []
+        started = time.perf_counter()
+        deadline = started + args.duration
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(rng.expovariate(args.rate))
+            user_id = rng.choice(users)
+            update_id = next(update_ids)
+            message_id = next(message_ids)
+            kind = rng.random()
+            
+            if kind < args.callback_ratio:
+                update = make_callback_update(update_id, user_id, message_id, "chat_action_back")
+                tracker.start_callback(update['callback_query']['id'])
+                sent['callback'] += 1
+            elif kind < args.callback_ratio + args.command_ratio:
+                command = rng.choice(["/help", "/chats", "/model"])
+                update = make_message_update(update_id, user_id, message_id, command)
+                tracker.start_message(user_id, message_id)
+                sent['command'] += 1
+            else:
+                if prompts and rng.random() < args.repeat_ratio:
+                    text = rng.choice(prompts)
+                else:
+                    text = f"Вопрос номер {update_id}: расскажи про {rng.choice(['SQLite', 'asyncio', 'Telegram'])}"
+                    prompts.append(text)
+                update = make_message_update(update_id, user_id, message_id, text)
+                tracker.start_message(user_id, message_id)
+                sent['text'] += 1
+            feed(update)
+        
+        load_time = time.perf_counter() - started
+        
+        # Ждем ответов на уже отправленные обновления
+        drain_deadline = time.perf_counter() + args.drain_timeout
+        while (tracker.outstanding or tasks) and time.perf_counter() < drain_deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+    
+    finally:
+        for task in tasks:
+            task.cancel()
+        await db.close_db()
+        await bot.session.close()
+    
+    latencies = tracker.latencies
+    db_samples = [value for samples in db_timer.samples.values() for value in samples]
+    stage_means = {}
+    for stage, (total_before, count_before) in stages_before.items():
+        child = metrics.STAGE_DURATION.labels(stage)
+        count = child.count - count_before
+        stage_means[stage] = round((child.sum - total_before) / count * 1000, 2) if count else 0.0
+    errors = {
+        labels[0]: int(child.get() - errors_before.get(labels, 0))
+        for labels, child in metrics.ERRORS.children().items()
+    }
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'json_path'},
+        'updates': dict(sent),
+        'load_seconds': round(load_time, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'completed': len(latencies),
+        'timed_out': tracker.outstanding,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 1),
+            'p95': round(percentile(latencies, 95) * 1000, 1),
+            'p99': round(percentile(latencies, 99) * 1000, 1),
+            'max': round(max(latencies, default=0.0) * 1000, 1)
+        },
+        'db': {
+            'calls': len(db_samples),
+            'total_ms': round(sum(db_samples) * 1000, 1),
+            'p50_ms': round(percentile(db_samples, 50) * 1000, 2),
+            'p95_ms': round(percentile(db_samples, 95) * 1000, 2),
+            'p99_ms': round(percentile(db_samples, 99) * 1000, 2),
+            'by_function_ms': {
+                name: {
+                    'calls': len(samples),
+                    'p50': round(percentile(samples, 50) * 1000, 2),
+                    'p95': round(percentile(samples, 95) * 1000, 2)
+                }
+                for name, samples in sorted(db_timer.samples.items())
+            },
+            'stage_mean_ms': stage_means
+        },
+        'llm_calls': ai_service.calls,
+        'telegram_requests': dict(session.requests),
+        'errors': {stage: count for stage, count in errors.items() if count}
+    }
+
+
+def print_report(report: dict):
+    """Выводит отчет в читаемом виде"""
+    latency = report['latency_ms']
+    db_report = report['db']
+    print(f"Updates sent:      {sum(report['updates'].values())} {report['updates']} in {report['load_seconds']}s")
+    print(f"Completed:         {report['completed']} (no reply: {report['timed_out']}) in {report['elapsed_seconds']}s")
+    print(f"Throughput:        {report['throughput_rps']} replies/s")
+    print(f"End-to-end (ms):   p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    print(f"DB calls:          {db_report['calls']}, total {db_report['total_ms']} ms")
+    print(f"DB call (ms):      p50 {db_report['p50_ms']}  p95 {db_report['p95_ms']}  p99 {db_report['p99_ms']}")
+    for name, stats in db_report['by_function_ms'].items():
+        print(f"  {name:<28} calls {stats['calls']:<6} p50 {stats['p50']:<8} p95 {stats['p95']}")
+    print(f"LLM calls:         {report['llm_calls']}")
+    print(f"Telegram requests: {report['telegram_requests']}")
+    print(f"Errors:            {report['errors'] or 'none'}")
+
+
+def cli(argv: list = None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
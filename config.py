@@ -10,13 +10,23 @@ if not BOT_TOKEN:
     raise ValueError("TELEGRAM_TOKEN not found in environment variables")
 
 # Настройки базы данных
-DB_PATH = os.path.join(os.path.dirname(__file__), "data", "bot.db")
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "data", "bot.db"))
 
 # Временная директория для файлов
 TEMP_DIR = os.path.join(os.path.dirname(__file__), "temp")
 
 # Настройки логирования
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Формат вывода: text - строки для чтения, json - по объекту JSON на строку
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# Доля записываемых частых info-сообщений (ответы пользователям, обработка обновлений)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+# Логгеры, все info-сообщения которых считаются частыми (через запятую)
+LOG_SAMPLED_LOGGERS = tuple(
+    name.strip() for name in os.getenv("LOG_SAMPLED_LOGGERS", "aiogram.event").split(",") if name.strip()
+)
+# Размер очереди записей; при переполнении записи отбрасываются
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
 
 # Настройки AI
 DEFAULT_TEXT_MODEL = "gpt-4"  # Модель по умолчанию для текстовых запросов
@@ -25,7 +35,33 @@ DEFAULT_SYSTEM_PROMPT = """Ты - умный и полезный ассисте
 При этом ты остаёшься дружелюбным и вежливым."""
 
 # Максимальное количество сообщений в истории
-MAX_HISTORY_LENGTH = 10
+# (окно дополнительно ограничивается бюджетом токенов)
+MAX_HISTORY_LENGTH = int(os.getenv("MAX_HISTORY_LENGTH", "40"))
+
+# Бюджет токенов на историю чата (приблизительно)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+MODEL_TOKEN_BUDGETS = {
+    "gpt-4": 3000,
+    "gpt-4o": 6000,
+    "gpt-4o-mini": 6000,
+    "claude": 6000,
+    "gemini-2.0-flash": 8000,
+    "gemini-2.0-flash-thinking": 8000,
+}
+
+# Настройки краткого содержания старой части чата
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_MIN_NEW_MESSAGES = int(os.getenv("SUMMARY_MIN_NEW_MESSAGES", "6"))  # Пересчитывать, когда столько сообщений выпало из окна
+SUMMARY_MAX_SOURCE_MESSAGES = int(os.getenv("SUMMARY_MAX_SOURCE_MESSAGES", "50"))  # Максимум сообщений за один пересчет
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "2000"))
+
+# Подбор старых сообщений чата, относящихся к новому сообщению (BM25 по поисковому индексу)
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") == "1"
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))  # Максимум найденных сообщений в контексте
+RETRIEVAL_BUDGET_SHARE = float(os.getenv("RETRIEVAL_BUDGET_SHARE", "0.25"))  # Доля бюджета токенов истории
+RETRIEVAL_MAX_CHARS = int(os.getenv("RETRIEVAL_MAX_CHARS", "1000"))  # Длина одного найденного сообщения
+RETRIEVAL_MIN_TERM_LENGTH = int(os.getenv("RETRIEVAL_MIN_TERM_LENGTH", "3"))  # Более короткие слова не ищутся
 
 # Настройки режима размышления
 THINKING_MODE_PROMPT = """Теперь ты должен тщательно обдумывать каждый ответ.
@@ -35,3 +71,144 @@ THINKING_MODE_PROMPT = """Теперь ты должен тщательно об
 💭 - процесс анализа
 💡 - появление идеи
 ✨ - формулировка ответа"""
+
+# Настройки отложенной записи в базу данных (write-behind)
+# При включении вставки сообщений и обновления настроек копятся в очереди
+# и записываются группами в одной транзакции
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "0") == "1"
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "100"))  # Размер пачки для сброса
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.5"))  # Секунды между сбросами
+
+# Настройки SQLite
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))  # Количество соединений только для чтения (0 - читать через основное)
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # OFF, NORMAL, FULL или EXTRA
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-16000"))  # Отрицательное значение - размер в КиБ
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))  # Байты
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "5000"))  # Миллисекунды
+
+# Настройки кэша пользовательских настроек и активного чата
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))  # Максимальное количество записей
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))  # Время жизни записи в секундах
+
+# Буфер последних сообщений активных чатов в памяти
+# (история для промпта собирается без чтения из базы)
+HISTORY_BUFFER_MESSAGES = int(os.getenv("HISTORY_BUFFER_MESSAGES", str(MAX_HISTORY_LENGTH)))  # Сообщений на чат (0 - отключить)
+HISTORY_BUFFER_MAX_BYTES = int(os.getenv("HISTORY_BUFFER_MAX_BYTES", str(64 * 1024 * 1024)))  # Общий объем всех чатов
+
+# Архивирование старых сообщений: сообщения за пределами последних ARCHIVE_KEEP_MESSAGES
+# и старше ARCHIVE_MIN_AGE_DAYS переносятся в сжатые блоки таблицы chat_archive
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "1") == "1"
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))  # Секунды между запусками
+ARCHIVE_KEEP_MESSAGES = int(os.getenv("ARCHIVE_KEEP_MESSAGES", "200"))  # Последние сообщения чата, которые не архивируются
+ARCHIVE_MIN_AGE_DAYS = float(os.getenv("ARCHIVE_MIN_AGE_DAYS", "7"))
+ARCHIVE_MIN_BLOCK_MESSAGES = int(os.getenv("ARCHIVE_MIN_BLOCK_MESSAGES", "50"))  # Меньше сообщений не архивируем
+ARCHIVE_BLOCK_MESSAGES = int(os.getenv("ARCHIVE_BLOCK_MESSAGES", "500"))  # Максимум сообщений в одном блоке
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zlib")  # zlib или zstd (pip install zstandard)
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", "0"))  # Удалять архив старше (0 - хранить всегда)
+ARCHIVE_VACUUM_PAGES = int(os.getenv("ARCHIVE_VACUUM_PAGES", "1000"))  # Страниц за один шаг incremental_vacuum
+
+# Полнотекстовый поиск по истории (/search)
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))  # Результатов на странице
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "200"))  # Длина фрагмента сообщения
+SEARCH_BACKFILL_BATCH = int(os.getenv("SEARCH_BACKFILL_BATCH", "1000"))  # Сообщений за шаг заполнения индекса
+SEARCH_BACKFILL_DELAY = float(os.getenv("SEARCH_BACKFILL_DELAY", "0.1"))  # Пауза между шагами, секунды
+
+# Экспорт чата в файл (файл создается в TEMP_DIR и удаляется после отправки)
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))  # Сообщений, читаемых из базы за раз
+EXPORT_MAX_BYTES = int(os.getenv("EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))  # Ограничение Telegram на файлы от ботов
+
+# Настройки потоковой выдачи ответов
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1") == "1"
+STREAM_EDIT_INTERVAL_MS = int(os.getenv("STREAM_EDIT_INTERVAL_MS", "1000"))  # Не чаще одного редактирования на чат
+STREAM_PLACEHOLDER = "✍️ Печатаю..."
+
+# Настройки многоитерационного размышления (ThinkingProcess)
+THINKING_ITERATIONS = int(os.getenv("THINKING_ITERATIONS", "7"))  # Максимальное количество итераций/черновиков (черновиков не больше 4)
+THINKING_PARALLEL = os.getenv("THINKING_PARALLEL", "1") == "1"  # Генерировать черновики параллельно
+THINKING_CONCURRENCY = int(os.getenv("THINKING_CONCURRENCY", "3"))  # Одновременных запросов к модели
+THINKING_SIMILARITY_THRESHOLD = float(os.getenv("THINKING_SIMILARITY_THRESHOLD", "0.8"))  # Порог сходимости (0 - отключить)
+THINKING_MAX_PROMPT_CHARS = int(os.getenv("THINKING_MAX_PROMPT_CHARS", "12000"))  # Бюджет размера промпта в символах
+THINKING_ENGINE_ENABLED = os.getenv("THINKING_ENGINE_ENABLED", "1") == "1"  # Использовать ThinkingProcess в режиме размышления
+THINKING_CONTEXT_MESSAGES = int(os.getenv("THINKING_CONTEXT_MESSAGES", "6"))  # Сообщений истории в контексте запроса
+
+# Ограничения Telegram на отправку сообщений (планировщик отправки)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # Сообщений в секунду для всего бота (делится между процессами)
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # Сообщений в секунду в один личный чат
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))  # Сообщений в секунду в группу (20 в минуту)
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))  # Сколько сообщений в чат можно отправить подряд без ожидания
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))  # Повторов после ответа 429 (RetryAfter)
+
+# Отправка длинных ответов
+# Темп отправки частей задает планировщик отправки, пауза добавляется сверх него
+REPLY_CHUNK_DELAY = float(os.getenv("REPLY_CHUNK_DELAY", "0"))  # Пауза между частями ответа, секунды
+REPLY_MAX_CHUNKS = int(os.getenv("REPLY_MAX_CHUNKS", "5"))  # Ответ длиннее стольких сообщений отправляется файлом
+
+# Объединение сообщений пользователя
+# Окно ожидания новых сообщений перед запросом к модели (0 - без ожидания)
+MESSAGE_DEBOUNCE_MS = int(os.getenv("MESSAGE_DEBOUNCE_MS", "0"))
+
+# Ограничения запросов к модели
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))  # Всего одновременных запросов
+LLM_MODEL_CONCURRENCY = int(os.getenv("LLM_MODEL_CONCURRENCY", "8"))  # Одновременных запросов к одной модели
+LLM_MODEL_CONCURRENCY_LIMITS = {
+    # Индивидуальные лимиты для отдельных моделей, например "gpt-4": 4
+}
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "100"))  # Запросов в очереди, после которых отвечаем "занято"
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))  # Секунд ожидания свободного слота
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "90"))  # Общий срок запроса с повторами, в секундах
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))  # Секунды
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))  # Секунды
+
+# Резервные модели и хеджирование запросов
+MODEL_FALLBACK_ENABLED = os.getenv("MODEL_FALLBACK_ENABLED", "1") == "1"
+# Модели, которые пробуются по порядку после выбранной пользователем
+MODEL_FALLBACK_CHAIN = [
+    model.strip()
+    for model in os.getenv("MODEL_FALLBACK_CHAIN", "gpt-4o-mini,mistral-nemo").split(",")
+    if model.strip()
+]
+MODEL_LATENCY_SLO = float(os.getenv("MODEL_LATENCY_SLO", "45"))  # Секунд до перехода на резервную модель (0 - без ограничения)
+MODEL_HEDGING_ENABLED = os.getenv("MODEL_HEDGING_ENABLED", "0") == "1"  # Дублировать медленный запрос на резервную модель
+MODEL_STATS_WINDOW = int(os.getenv("MODEL_STATS_WINDOW", "100"))  # Последних запросов в статистике модели
+MODEL_STATS_MIN_SAMPLES = int(os.getenv("MODEL_STATS_MIN_SAMPLES", "20"))  # Минимум запросов для решений по статистике
+MODEL_STATS_MAX_AGE = float(os.getenv("MODEL_STATS_MAX_AGE", "300"))  # Секунд, через которые запрос выпадает из статистики (0 - не устаревает)
+MODEL_ERROR_RATE_THRESHOLD = float(os.getenv("MODEL_ERROR_RATE_THRESHOLD", "0.5"))  # Доля ошибок, при которой модель пропускается
+
+# Кэш ответов модели
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 60 * 60)))  # Секунды
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_NEAR_DUPLICATES = os.getenv("RESPONSE_CACHE_NEAR_DUPLICATES", "0") == "1"  # Искать похожие запросы (MinHash)
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.9"))  # Минимальное сходство похожих запросов
+
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "100"))  # Одновременно обрабатываемых обновлений
+
+# Настройки вебхука.
+# Для локальной проверки можно не задавать WEBHOOK_URL и отправлять
+# записанные обновления POST-запросом на http://WEBAPP_HOST:WEBAPP_PORT{WEBHOOK_PATH}
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics.
+# Процессы-обработчики (WORKERS > 1) используют порты METRICS_PORT + 1 + номер процесса
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Хранилище состояний FSM: "memory", "sqlite" или "redis".
+# "sqlite" и "redis" позволяют запускать несколько процессов бота
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")  # Подходит любой сервер с протоколом Redis
+
+# Количество процессов-обработчиков (1 - всё в одном процессе).
+# При WORKERS > 1 основной процесс только получает обновления и распределяет
+# их по процессам по user_id, поэтому обновления одного пользователя
+# всегда обрабатывает один и тот же процесс
+WORKERS = int(os.getenv("WORKERS", "1"))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))  # Секунды long polling при WORKERS > 1
@@ -0,0 +1,51 @@
+import json
+import zlib
+
+# Поддерживаемые алгоритмы сжатия блоков архива
+COMPRESSIONS = ("zlib", "zstd")
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+
+
+def _zstd():
+    # Необязательная зависимость: pip install zstandard
+    import zstandard
+    return zstandard
+
+
+def check_compression(compression: str):
+    """Проверяет, что алгоритм сжатия поддерживается и доступен"""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Invalid ARCHIVE_COMPRESSION value: {compression}")
+    if compression == "zstd":
+        _zstd()
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    """Сжимает данные указанным алгоритмом"""
+    if compression == "zstd":
+        return _zstd().ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if compression == "zlib":
+        return zlib.compress(data, ZLIB_LEVEL)
+    raise ValueError(f"Unknown archive compression: {compression}")
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    """Распаковывает данные, сжатые указанным алгоритмом"""
+    if compression == "zstd":
+        return _zstd().ZstdDecompressor().decompress(data)
+    if compression == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown archive compression: {compression}")
+
+
+def pack_messages(rows: list, compression: str) -> bytes:
+    """Упаковывает сообщения (message_id, role, content, created_at) в сжатый блок"""
+    payload = json.dumps([list(row) for row in rows], ensure_ascii=False, separators=(',', ':'))
+    return compress(payload.encode('utf-8'), compression)
+
+
+def unpack_messages(data: bytes, compression: str) -> list:
+    """Распаковывает блок в список (message_id, role, content, created_at)"""
+    return [tuple(row) for row in json.loads(decompress(data, compression))]
@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+
+# Маркер отсутствия значения в кэше (None - допустимое значение)
+MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш с ограниченным размером и временем жизни записей"""
+    
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+    
+    def get(self, key):
+        """Возвращает значение по ключу или MISSING"""
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return MISSING
+        
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            # Запись устарела
+            del self._data[key]
+            self.misses += 1
+            return MISSING
+        
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        """Сохраняет значение, вытесняя самые старые записи при переполнении"""
+        if self.max_size <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+    
+    def invalidate(self, key):
+        """Удаляет запись из кэша"""
+        self._data.pop(key, None)
+    
+    def clear(self):
+        """Очищает кэш"""
+        self._data.clear()
+    
+    def stats(self) -> dict:
+        """Возвращает статистику попаданий"""
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses
+        }
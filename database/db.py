@@ -2,25 +2,145 @@ import aiosqlite
 import asyncio
 import logging
 import os
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
-from config import DB_PATH
+from config import (
+    DB_PATH,
+    DB_READ_POOL_SIZE,
+    DB_SYNCHRONOUS,
+    DB_CACHE_SIZE,
+    DB_MMAP_SIZE,
+    DB_BUSY_TIMEOUT,
+    CACHE_MAX_SIZE,
+    CACHE_TTL,
+    HISTORY_BUFFER_MESSAGES,
+    HISTORY_BUFFER_MAX_BYTES,
+    WRITE_BEHIND_ENABLED,
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+    ARCHIVE_ENABLED,
+    ARCHIVE_INTERVAL,
+    ARCHIVE_KEEP_MESSAGES,
+    ARCHIVE_MIN_AGE_DAYS,
+    ARCHIVE_MIN_BLOCK_MESSAGES,
+    ARCHIVE_BLOCK_MESSAGES,
+    ARCHIVE_COMPRESSION,
+    ARCHIVE_RETENTION_DAYS,
+    ARCHIVE_VACUUM_PAGES,
+    SEARCH_BACKFILL_BATCH,
+    SEARCH_BACKFILL_DELAY
+)
+from database.archive import check_compression, pack_messages, unpack_messages
+from database.cache import TTLCache, MISSING
+from database.history_buffer import HistoryBuffer, HistoryRecord
+from database.migrations import apply_migrations
 
 logger = logging.getLogger(__name__)
 
 # Создаем директорию для базы данных, если её нет
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-# Глобальное подключение к базе данных
+# Глобальное подключение к базе данных (единственное пишущее соединение)
 db = None
 
-async def init_db():
-    """Инициализация базы данных"""
-    global db
+# Пул соединений только для чтения
+_read_pool = None
+_read_connections = []
+
+# Очередь отложенной записи: вставки выполняются по порядку,
+# обновления с одинаковым ключом схлопываются до последнего значения
+_pending_inserts = []
+_pending_updates = {}
+_pending_chats = set()
+_pending_users = set()
+_flush_task = None
+
+# Все транзакции пишущего соединения выполняются только под этим замком:
+# commit или rollback одной корутины иначе зафиксировал бы или отменил
+# незавершенные изменения другой
+_write_lock = asyncio.Lock()
+
+# Фоновое архивирование старых сообщений
+_archive_task = None
+
+# Фоновое заполнение поискового индекса сообщениями, записанными до его создания
+_backfill_task = None
+
+# Кэш настроек пользователя, активного чата и кратких содержаний чатов.
+# Ключи: ('thinking_mode', user_id), ('model', user_id), ('active_chat', user_id), ('summary', chat_id)
+_cache = TTLCache(max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL)
+
+# Последние сообщения активных чатов.
+# Сообщения пишутся и буфер заполняется из базы только под _write_lock через основное
+# соединение, поэтому буфер не может пропустить сообщение, записанное во время чтения
+_history = HistoryBuffer(max_messages=HISTORY_BUFFER_MESSAGES, max_bytes=HISTORY_BUFFER_MAX_BYTES)
+
+_INSERT_MESSAGE = 'INSERT INTO chat_messages (chat_id, role, content) VALUES (?, ?, ?)'
+
+_TOUCH_CACHED_RESPONSE = 'UPDATE response_cache SET last_used_at = ?, hits = hits + ? WHERE cache_key = ?'
+
+async def init_db(migrate: bool = True, maintenance: bool = True):
+    """
+    Инициализация базы данных
+    
+    :param migrate: Создать таблицы и применить миграции схемы
+    :param maintenance: Запустить фоновое обслуживание (архивирование, дозаполнение поиска).
+                        При нескольких процессах его выполняет только один из них
+    """
+    global db, _flush_task, _archive_task, _backfill_task
+    
+    if DB_SYNCHRONOUS.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        raise ValueError(f"Invalid DB_SYNCHRONOUS value: {DB_SYNCHRONOUS}")
+    check_compression(ARCHIVE_COMPRESSION)
     
     # Создаем подключение к базе данных
     db = await aiosqlite.connect(DB_PATH)
     
-    async with db.cursor() as cur:
+    # Включаем WAL, чтобы чтение не блокировалось записью
+    await db.execute('PRAGMA journal_mode = WAL')
+    await db.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS.upper()}')
+    await _apply_connection_pragmas(db)
+    
+    if migrate:
+        await _create_schema(db)
+    
+    # Открываем пул соединений для чтения
+    await _open_read_pool()
+    
+    # Запускаем фоновый сброс очереди отложенной записи
+    if WRITE_BEHIND_ENABLED:
+        _flush_task = asyncio.create_task(_flush_loop())
+        logger.info("Write-behind queue enabled")
+    
+    # Запускаем фоновое архивирование старых сообщений
+    if maintenance and ARCHIVE_ENABLED:
+        _archive_task = asyncio.create_task(_archive_loop())
+        logger.info("Message archiving enabled")
+    
+    # Дозаполняем поисковый индекс, если база создана до его появления
+    if maintenance and await search_backfill_pending():
+        _backfill_task = asyncio.create_task(_search_backfill_loop())
+        logger.info("Search index backfill started")
+
+
+async def migrate_db():
+    """
+    Создает таблицы и применяет миграции схемы, не открывая постоянных соединений.
+    При нескольких процессах-обработчиках выполняется один раз до их запуска
+    """
+    conn = await aiosqlite.connect(DB_PATH)
+    try:
+        await conn.execute('PRAGMA journal_mode = WAL')
+        await _apply_connection_pragmas(conn)
+        await _create_schema(conn)
+    finally:
+        await conn.close()
+
+
+async def _create_schema(conn):
+    """Создает таблицы и применяет миграции схемы"""
+    async with conn.cursor() as cur:
         # Создаем таблицу пользователей
         await cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -61,13 +181,256 @@ async def init_db():
         ''')
         logger.info("Chat messages table created/verified")
         
-        await db.commit()
+        await conn.commit()
         logger.info("All tables created successfully")
+    
+    # Применяем миграции схемы (индексы и т.д.)
+    await apply_migrations(conn)
+
+
+async def close_db():
+    """Сбрасывает очередь записи и закрывает подключение к базе данных"""
+    global db, _flush_task, _archive_task, _backfill_task
+    
+    for task in (_flush_task, _archive_task, _backfill_task):
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    _flush_task = None
+    _archive_task = None
+    _backfill_task = None
+    
+    await _close_read_pool()
+    
+    if db:
+        await flush_writes()
+        await db.close()
+        db = None
+        logger.info("Database connection closed")
+
+
+async def check_db() -> bool:
+    """Проверяет, что база данных доступна"""
+    if db is None:
+        return False
+    try:
+        async with db.execute('SELECT 1') as cursor:
+            await cursor.fetchone()
+        return True
+    except Exception as e:
+        logger.error(f"Database health check failed: {e}")
+        return False
+
+
+def get_cache_stats() -> dict:
+    """Возвращает статистику кэша настроек и активных чатов"""
+    return _cache.stats()
+
+
+def get_history_buffer_stats() -> dict:
+    """Статистика буфера последних сообщений"""
+    return _history.stats()
+
+
+def _invalidate_user_cache(user_id: int):
+    """Сбрасывает все закэшированные данные пользователя"""
+    _cache.invalidate(('thinking_mode', user_id))
+    _cache.invalidate(('model', user_id))
+    _cache.invalidate(('active_chat', user_id))
+
+
+async def _apply_connection_pragmas(conn):
+    """Применяет настройки производительности к соединению"""
+    # PRAGMA не поддерживает параметры, значения всегда int
+    await conn.execute(f'PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT)}')
+    await conn.execute(f'PRAGMA cache_size = {int(DB_CACHE_SIZE)}')
+    await conn.execute(f'PRAGMA mmap_size = {int(DB_MMAP_SIZE)}')
+
+
+async def _open_read_pool():
+    """Открывает соединения только для чтения"""
+    global _read_pool
+    
+    if DB_READ_POOL_SIZE <= 0:
+        return
+    
+    _read_pool = asyncio.Queue()
+    for _ in range(DB_READ_POOL_SIZE):
+        conn = await aiosqlite.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+        await _apply_connection_pragmas(conn)
+        await conn.execute('PRAGMA query_only = 1')
+        _read_connections.append(conn)
+        _read_pool.put_nowait(conn)
+    logger.info(f"Read connection pool opened: {DB_READ_POOL_SIZE} connections")
+
+
+async def _close_read_pool():
+    """Закрывает пул соединений для чтения"""
+    global _read_pool
+    
+    for conn in _read_connections:
+        await conn.close()
+    _read_connections.clear()
+    _read_pool = None
+
+
+@asynccontextmanager
+async def _read_connection():
+    """Выдает соединение для чтения из пула (или основное, если пул отключен)"""
+    if _read_pool is None:
+        yield db
+        return
+    
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+
+async def _flush_loop():
+    """Периодически сбрасывает очередь отложенной записи"""
+    while True:
+        await asyncio.sleep(WRITE_BEHIND_FLUSH_INTERVAL)
+        try:
+            await flush_writes()
+        except Exception as e:
+            logger.error(f"Error flushing write-behind queue: {e}")
+
+
+def _take_pending() -> tuple:
+    """Забирает накопленные записи из очереди"""
+    global _pending_inserts, _pending_updates
+    inserts, updates = _pending_inserts, _pending_updates
+    _pending_inserts, _pending_updates = [], {}
+    _pending_chats.clear()
+    _pending_users.clear()
+    return inserts, updates
+
+
+def _restore_pending(inserts: list, updates: dict):
+    """Возвращает записи в очередь после неудачного сброса"""
+    global _pending_inserts, _pending_updates
+    _pending_inserts = inserts + _pending_inserts
+    updates.update(_pending_updates)
+    _pending_updates = updates
+    for query, params, chat_id in inserts:
+        _pending_chats.add(chat_id)
+    for query, key in updates:
+        if query != _TOUCH_CACHED_RESPONSE:
+            _pending_users.add(key)
+
+
+async def _execute_pending(cur, inserts: list, updates: dict) -> list:
+    """
+    Выполняет накопленные записи в текущей транзакции.
+    Возвращает записанные сообщения [(chat_id, HistoryRecord)] для буфера истории
+    """
+    written = []
+    
+    # Группируем подряд идущие одинаковые вставки для executemany
+    batch_query, batch = None, []
+    for query, params, chat_id in inserts:
+        if query != batch_query and batch:
+            written.extend(await _execute_batch(cur, batch_query, batch))
+            batch = []
+        batch_query = query
+        batch.append(params)
+    if batch:
+        written.extend(await _execute_batch(cur, batch_query, batch))
+    
+    for (query, key), params in updates.items():
+        await cur.execute(query, params)
+    
+    return written
+
+
+async def _execute_batch(cur, query: str, batch: list) -> list:
+    """Выполняет пачку одинаковых вставок, для сообщений возвращает их записи"""
+    await cur.executemany(query, batch)
+    if query != _INSERT_MESSAGE or not _history.enabled:
+        return []
+    
+    # Пачка вставлена подряд одним соединением, поэтому ее ID идут подряд
+    # и заканчиваются последним вставленным
+    await cur.execute('SELECT last_insert_rowid(), CURRENT_TIMESTAMP')
+    last_id, created_at = await cur.fetchone()
+    first_id = last_id - len(batch) + 1
+    return [
+        (chat_id, HistoryRecord(first_id + index, role, content, created_at))
+        for index, (chat_id, role, content) in enumerate(batch)
+    ]
+
+
+def _buffer_written(written: list):
+    """Добавляет записанные сообщения в буфер истории (после фиксации транзакции)"""
+    for chat_id, record in written:
+        _history.append(chat_id, record)
+
+
+async def flush_writes():
+    """Записывает накопленную очередь в базу одной транзакцией"""
+    async with _write_lock:
+        await _flush_pending()
+
+
+async def _flush_pending():
+    """Записывает накопленную очередь (под _write_lock)"""
+    if not _pending_inserts and not _pending_updates:
+        return
+    
+    inserts, updates = _take_pending()
+    try:
+        async with db.cursor() as cur:
+            written = await _execute_pending(cur, inserts, updates)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        _restore_pending(inserts, updates)
+        raise
+    _buffer_written(written)
+
+
+@asynccontextmanager
+async def _write_transaction():
+    """
+    Транзакция пишущего соединения под _write_lock: фиксируется при выходе из блока,
+    при ошибке откатывается. Перед ней записывается очередь отложенной записи,
+    чтобы сохранить порядок изменений
+    """
+    async with _write_lock:
+        await _flush_pending()
+        try:
+            async with db.cursor() as cur:
+                yield cur
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+
+async def _enqueue_insert(query: str, params: tuple, chat_id: int):
+    """Добавляет вставку в очередь отложенной записи"""
+    _pending_inserts.append((query, params, chat_id))
+    _pending_chats.add(chat_id)
+    if len(_pending_inserts) + len(_pending_updates) >= WRITE_BEHIND_BATCH_SIZE:
+        await flush_writes()
+
+
+async def _enqueue_update(query: str, params: tuple, user_id: int):
+    """Добавляет обновление в очередь, заменяя предыдущее с тем же ключом"""
+    _pending_updates[(query, user_id)] = params
+    _pending_users.add(user_id)
+    if len(_pending_inserts) + len(_pending_updates) >= WRITE_BEHIND_BATCH_SIZE:
+        await flush_writes()
 
 
 async def create_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
     """Создает нового пользователя"""
-    async with db.cursor() as cur:
+    async with _write_transaction() as cur:
         # Проверяем, существует ли пользователь
         await cur.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
         existing_user = await cur.fetchone()
@@ -82,64 +445,93 @@ async def create_user(user_id: int, username: str = None, first_name: str = None
                 (user_id, username, first_name, last_name)
             )
             
-            # Создаем чат по умолчанию для нового пользователя
+            # Создаем чат по умолчанию для нового пользователя,
+            # если активный чат ещё не был создан
             await cur.execute(
                 '''
                 INSERT INTO chats (user_id, name, is_active)
-                VALUES (?, ?, 1)
+                SELECT ?, ?, 1
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM chats WHERE user_id = ? AND is_active = 1
+                )
                 ''',
-                (user_id, "Чат по умолчанию")
+                (user_id, "Чат по умолчанию", user_id)
             )
-            
-            await db.commit()
-            logger.info(f"Created new user: {user_id}")
-        else:
-            logger.info(f"User already exists: {user_id}")
+    
+    if not existing_user:
+        _invalidate_user_cache(user_id)
+        logger.info(f"Created new user: {user_id}")
+    else:
+        logger.info(f"User already exists: {user_id}")
 
 
 async def get_thinking_mode(user_id: int) -> bool:
     """Получает статус режима размышления пользователя"""
-    async with db.execute(
-        'SELECT thinking_mode FROM users WHERE user_id = ?',
-        (user_id,)
-    ) as cur:
-        result = await cur.fetchone()
-        return bool(result[0]) if result else False
+    cached = _cache.get(('thinking_mode', user_id))
+    if cached is not MISSING:
+        return cached
+    
+    if user_id in _pending_users:
+        await flush_writes()
+    async with _read_connection() as conn:
+        async with conn.execute(
+            'SELECT thinking_mode FROM users WHERE user_id = ?',
+            (user_id,)
+        ) as cur:
+            result = await cur.fetchone()
+    
+    enabled = bool(result[0]) if result else False
+    _cache.set(('thinking_mode', user_id), enabled)
+    return enabled
 
 
 async def set_thinking_mode(user_id: int, enabled: bool):
     """Устанавливает режим размышления пользователя"""
-    async with db.cursor() as cur:
-        await cur.execute(
-            'UPDATE users SET thinking_mode = ? WHERE user_id = ?',
-            (int(enabled), user_id)
-        )
-        await db.commit()
+    query = 'UPDATE users SET thinking_mode = ? WHERE user_id = ?'
+    _cache.invalidate(('thinking_mode', user_id))
+    if WRITE_BEHIND_ENABLED:
+        await _enqueue_update(query, (int(enabled), user_id), user_id)
+        return
+    
+    async with _write_transaction() as cur:
+        await cur.execute(query, (int(enabled), user_id))
 
 
 async def get_user_model(user_id: int) -> str:
     """Получает выбранную модель пользователя"""
-    async with db.execute(
-        'SELECT selected_model FROM users WHERE user_id = ?',
-        (user_id,)
-    ) as cursor:
-        result = await cursor.fetchone()
-        return result[0] if result else None
+    cached = _cache.get(('model', user_id))
+    if cached is not MISSING:
+        return cached
+    
+    if user_id in _pending_users:
+        await flush_writes()
+    async with _read_connection() as conn:
+        async with conn.execute(
+            'SELECT selected_model FROM users WHERE user_id = ?',
+            (user_id,)
+        ) as cursor:
+            result = await cursor.fetchone()
+    
+    model = result[0] if result else None
+    _cache.set(('model', user_id), model)
+    return model
 
 
 async def update_user_model(user_id: int, model: str):
     """Обновляет выбранную модель пользователя"""
-    async with db.cursor() as cur:
-        await cur.execute(
-            'UPDATE users SET selected_model = ? WHERE user_id = ?',
-            (model, user_id)
-        )
-        await db.commit()
+    query = 'UPDATE users SET selected_model = ? WHERE user_id = ?'
+    _cache.invalidate(('model', user_id))
+    if WRITE_BEHIND_ENABLED:
+        await _enqueue_update(query, (model, user_id), user_id)
+        return
+    
+    async with _write_transaction() as cur:
+        await cur.execute(query, (model, user_id))
 
 
 async def create_default_chat(user_id: int) -> int:
     """Создает чат по умолчанию для пользователя"""
-    async with db.cursor() as cur:
+    async with _write_transaction() as cur:
         # Проверяем, есть ли уже активный чат
         cursor = await db.execute(
             'SELECT chat_id FROM chats WHERE user_id = ? AND is_active = 1',
@@ -155,63 +547,93 @@ async def create_default_chat(user_id: int) -> int:
             'INSERT INTO chats (user_id, name, is_active) VALUES (?, ?, 1)',
             (user_id, "Чат по умолчанию")
         )
-        await db.commit()
-        return cursor.lastrowid
+    
+    # Новый чат пуст - его история известна без чтения из базы
+    _history.hydrate(cursor.lastrowid, [], 1)
+    return cursor.lastrowid
 
 
 async def get_user_chats(user_id: int) -> list:
     """Получает список чатов пользователя"""
-    async with db.execute(
-        '''
-        SELECT chat_id, name, is_active, created_at 
-        FROM chats 
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-        ''',
-        (user_id,)
-    ) as cursor:
-        chats = await cursor.fetchall()
-        return [
-            {
-                'id': chat[0],
-                'name': chat[1],
-                'is_active': bool(chat[2]),
-                'created_at': chat[3]
-            }
-            for chat in chats
-        ]
+    async with _read_connection() as conn:
+        async with conn.execute(
+            '''
+            SELECT chat_id, name, is_active, created_at 
+            FROM chats 
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            ''',
+            (user_id,)
+        ) as cursor:
+            chats = await cursor.fetchall()
+    
+    return [
+        {
+            'id': chat[0],
+            'name': chat[1],
+            'is_active': bool(chat[2]),
+            'created_at': chat[3]
+        }
+        for chat in chats
+    ]
 
 
 async def get_active_chat(user_id: int) -> dict:
     """Получает активный чат пользователя"""
-    async with db.execute(
-        '''
-        SELECT chat_id, name, created_at 
-        FROM chats 
-        WHERE user_id = ? AND is_active = 1
-        ''',
-        (user_id,)
-    ) as cursor:
-        chat = await cursor.fetchone()
-        if not chat:
-            # Если активного чата нет, создаем новый
-            chat_id = await create_default_chat(user_id)
-            cursor = await db.execute(
-                'SELECT chat_id, name, created_at FROM chats WHERE chat_id = ?',
-                (chat_id,)
-            )
+    cached = _cache.get(('active_chat', user_id))
+    if cached is not MISSING:
+        return dict(cached)
+    
+    async with _read_connection() as conn:
+        async with conn.execute(
+            '''
+            SELECT chat_id, name, created_at 
+            FROM chats 
+            WHERE user_id = ? AND is_active = 1
+            ''',
+            (user_id,)
+        ) as cursor:
             chat = await cursor.fetchone()
-            
-        return {
-            'id': chat[0],
-            'name': chat[1],
-            'created_at': chat[2]
-        }
+    
+    if not chat:
+        # Если активного чата нет, создаем новый
+        chat_id = await create_default_chat(user_id)
+        async with db.execute(
+            'SELECT chat_id, name, created_at FROM chats WHERE chat_id = ?',
+            (chat_id,)
+        ) as cursor:
+            chat = await cursor.fetchone()
+    
+    active_chat = {
+        'id': chat[0],
+        'name': chat[1],
+        'created_at': chat[2]
+    }
+    _cache.set(('active_chat', user_id), active_chat)
+    return dict(active_chat)
+
+
+async def get_user_chat(user_id: int, chat_id: int) -> dict:
+    """Получает чат пользователя по ID или None, если чат принадлежит другому пользователю"""
+    async with _read_connection() as conn:
+        async with conn.execute(
+            'SELECT chat_id, name, created_at FROM chats WHERE chat_id = ? AND user_id = ?',
+            (chat_id, user_id)
+        ) as cursor:
+            chat = await cursor.fetchone()
+    
+    if not chat:
+        return None
+    return {
+        'id': chat[0],
+        'name': chat[1],
+        'created_at': chat[2]
+    }
 
 
 async def create_chat(user_id: int, name: str) -> int:
     """Создает новый чат"""
-    async with db.cursor() as cur:
+    async with _write_transaction() as cur:
         # Деактивируем текущий активный чат
         await cur.execute(
             'UPDATE chats SET is_active = 0 WHERE user_id = ? AND is_active = 1',
@@ -223,25 +645,29 @@ async def create_chat(user_id: int, name: str) -> int:
             'INSERT INTO chats (user_id, name, is_active) VALUES (?, ?, 1)',
             (user_id, name)
         )
-        await db.commit()
-        return cursor.lastrowid
+    _cache.invalidate(('active_chat', user_id))
+    
+    # Новый чат пуст - его история известна без чтения из базы
+    _history.hydrate(cursor.lastrowid, [], 1)
+    return cursor.lastrowid
 
 
 async def update_chat(chat_id: int, name: str = None, is_active: bool = None):
     """Обновляет параметры чата"""
-    async with db.cursor() as cur:
-        if is_active is not None and is_active:
+    async with _write_transaction() as cur:
+        # Получаем владельца чата для сброса кэша активного чата
+        user_cursor = await db.execute(
+            'SELECT user_id FROM chats WHERE chat_id = ?',
+            (chat_id,)
+        )
+        user = await user_cursor.fetchone()
+        
+        if is_active is not None and is_active and user:
             # Если делаем чат активным, деактивируем остальные
-            user_cursor = await db.execute(
-                'SELECT user_id FROM chats WHERE chat_id = ?',
-                (chat_id,)
+            await cur.execute(
+                'UPDATE chats SET is_active = 0 WHERE user_id = ?',
+                (user[0],)
             )
-            user = await user_cursor.fetchone()
-            if user:
-                await cur.execute(
-                    'UPDATE chats SET is_active = 0 WHERE user_id = ?',
-                    (user[0],)
-                )
         
         # Обновляем параметры чата
         updates = []
@@ -252,18 +678,20 @@ async def update_chat(chat_id: int, name: str = None, is_active: bool = None):
         if is_active is not None:
             updates.append('is_active = ?')
             params.append(int(is_active))
-            
+        
         if updates:
             query = f'UPDATE chats SET {", ".join(updates)} WHERE chat_id = ?'
             params.append(chat_id)
             await cur.execute(query, params)
-            await db.commit()
+    
+    if user:
+        _cache.invalidate(('active_chat', user[0]))
 
 
 async def delete_chat(chat_id: int):
     """Удаляет чат"""
-    async with db.cursor() as cur:
-        try:
+    try:
+        async with _write_transaction() as cur:
             # Проверяем, был ли чат активным и получаем user_id
             cursor = await db.execute(
                 'SELECT user_id, is_active FROM chats WHERE chat_id = ?',
@@ -274,14 +702,19 @@ async def delete_chat(chat_id: int):
             if not chat_info:
                 logger.warning(f"Attempted to delete non-existent chat: {chat_id}")
                 return
-                
+            
             user_id, was_active = chat_info
             
-            # Удаляем сообщения чата
+            # Удаляем сообщения чата (вместе с архивом) и их краткое содержание
             await cur.execute(
                 'DELETE FROM chat_messages WHERE chat_id = ?',
                 (chat_id,)
             )
+            await _delete_archive_blocks(cur, 'chat_id = ?', (chat_id,))
+            await cur.execute(
+                'DELETE FROM chat_summaries WHERE chat_id = ?',
+                (chat_id,)
+            )
             
             # Удаляем сам чат
             await cur.execute(
@@ -318,50 +751,1023 @@ async def delete_chat(chat_id: int):
                         ''',
                         (user_id, "Чат по умолчанию")
                     )
-            
-            await db.commit()
-            logger.info(f"Chat {chat_id} deleted successfully")
-            
-        except Exception as e:
-            logger.error(f"Error deleting chat {chat_id}: {e}")
-            raise
+        
+        _cache.invalidate(('active_chat', user_id))
+        _cache.invalidate(('summary', chat_id))
+        _history.invalidate(chat_id)
+        logger.info(f"Chat {chat_id} deleted successfully")
+    
+    except Exception as e:
+        logger.error(f"Error deleting chat {chat_id}: {e}")
+        raise
 
 
 async def clear_chat_history(chat_id: int):
     """Очищает историю сообщений чата"""
-    async with db.cursor() as cur:
+    async with _write_transaction() as cur:
         await cur.execute('DELETE FROM chat_messages WHERE chat_id = ?', (chat_id,))
-        await db.commit()
+        await _delete_archive_blocks(cur, 'chat_id = ?', (chat_id,))
+        await cur.execute('DELETE FROM chat_summaries WHERE chat_id = ?', (chat_id,))
+    _cache.invalidate(('summary', chat_id))
+    _history.invalidate(chat_id)
 
 
 async def add_chat_message(chat_id: int, role: str, content: str):
     """Добавляет сообщение в историю чата"""
-    async with db.cursor() as cur:
+    if WRITE_BEHIND_ENABLED:
+        await _enqueue_insert(_INSERT_MESSAGE, (chat_id, role, content), chat_id)
+        return
+    
+    async with _write_transaction() as cur:
         await cur.execute(
-            'INSERT INTO chat_messages (chat_id, role, content) VALUES (?, ?, ?)',
+            _INSERT_MESSAGE + ' RETURNING message_id, created_at',
             (chat_id, role, content)
         )
-        await db.commit()
+        message_id, created_at = (await cur.fetchall())[0]
+    _history.append(chat_id, HistoryRecord(message_id, role, content, created_at))
 
 
-async def get_chat_history(chat_id: int, limit: int = 10) -> list:
-    """Получает историю сообщений чата"""
+async def get_chat_messages_range(chat_id: int, after_id: int, before_id: int, limit: int = 50) -> list:
+    """
+    Получает не более limit самых старых сообщений чата с after_id < message_id < before_id
+    в хронологическом порядке, включая сообщения из архива.
+    Следующую страницу можно получить, передав ID последнего сообщения как after_id
+    """
+    if chat_id in _pending_chats:
+        await flush_writes()
+    async with _read_connection() as conn:
+        # Архив и основная таблица читаются в одной транзакции, чтобы не пропустить
+        # сообщения, перенесенные в архив во время чтения
+        snapshot = conn is not db
+        if snapshot:
+            await conn.execute('BEGIN')
+        try:
+            # В архиве лежат самые старые сообщения чата
+            messages = await _read_archive_range(conn, chat_id, after_id, before_id, limit)
+            last_id = messages[-1][3] if messages else after_id
+            
+            if len(messages) < limit:
+                async with conn.execute(
+                    '''
+                    SELECT role, content, created_at, message_id
+                    FROM chat_messages
+                    WHERE chat_id = ? AND message_id > ? AND message_id < ?
+                    ORDER BY message_id
+                    LIMIT ?
+                    ''',
+                    (chat_id, last_id, before_id, limit - len(messages))
+                ) as cursor:
+                    messages.extend(await cursor.fetchall())
+        finally:
+            if snapshot:
+                await conn.rollback()
+    
+    return [
+        {
+            'role': msg[0],
+            'content': msg[1],
+            'created_at': msg[2],
+            'id': msg[3]
+        }
+        for msg in messages
+    ]
+
+
+async def _read_archive_range(conn, chat_id: int, after_id: int, before_id: int, limit: int) -> list:
+    """
+    Читает из архива не больше limit самых старых сообщений с after_id < message_id < before_id.
+    Возвращает строки (role, content, created_at, message_id) от старых к новым
+    """
+    messages = []
+    async with conn.execute(
+        '''
+        SELECT compression, data
+        FROM chat_archive
+        WHERE chat_id = ? AND first_message_id < ? AND last_message_id > ?
+        ORDER BY first_message_id
+        ''',
+        (chat_id, before_id, after_id)
+    ) as cursor:
+        async for compression, data in cursor:
+            for message_id, role, content, created_at in unpack_messages(data, compression):
+                if after_id < message_id < before_id:
+                    messages.append((role, content, created_at, message_id))
+                    if len(messages) >= limit:
+                        return messages
+    return messages
+
+
+async def iter_chat_messages(chat_id: int, batch_size: int = 500):
+    """
+    Перебирает все сообщения чата в хронологическом порядке, включая архив.
+    Выдает списки словарей не длиннее batch_size, не загружая историю целиком
+    """
+    if chat_id in _pending_chats:
+        await flush_writes()
+    
+    async with _read_connection() as conn:
+        # Архив и основная таблица читаются в одной транзакции, чтобы не пропустить
+        # сообщения, перенесенные в архив во время чтения
+        snapshot = conn is not db
+        if snapshot:
+            await conn.execute('BEGIN')
+        try:
+            async for batch in _iter_chat_rows(conn, chat_id, batch_size):
+                yield batch
+        finally:
+            if snapshot:
+                await conn.rollback()
+
+
+async def _iter_chat_rows(conn, chat_id: int, batch_size: int):
+    """Перебирает сообщения чата: сначала архив, затем основную таблицу"""
+    last_id = 0
+    
+    # Блоки архива распаковываются по одному
+    async with conn.execute(
+        '''
+        SELECT compression, data
+        FROM chat_archive
+        WHERE chat_id = ?
+        ORDER BY first_message_id
+        ''',
+        (chat_id,)
+    ) as cursor:
+        async for compression, data in cursor:
+            rows = await asyncio.to_thread(unpack_messages, data, compression)
+            for start in range(0, len(rows), batch_size):
+                yield [
+                    {'role': role, 'content': content, 'created_at': created_at, 'id': message_id}
+                    for message_id, role, content, created_at in rows[start:start + batch_size]
+                ]
+            if rows:
+                last_id = max(last_id, rows[-1][0])
+    
+    # Сообщения основной таблицы (кроме уже выданных из архива)
+    async with conn.execute(
+        '''
+        SELECT role, content, created_at, message_id
+        FROM chat_messages
+        WHERE chat_id = ? AND message_id > ?
+        ORDER BY message_id
+        ''',
+        (chat_id, last_id)
+    ) as cursor:
+        while True:
+            rows = await cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [
+                {'role': row[0], 'content': row[1], 'created_at': row[2], 'id': row[3]}
+                for row in rows
+            ]
+
+
+async def get_chat_summary(chat_id: int) -> dict:
+    """Получает краткое содержание старой части чата"""
+    cached = _cache.get(('summary', chat_id))
+    if cached is not MISSING:
+        return dict(cached) if cached else None
+    
+    async with _read_connection() as conn:
+        async with conn.execute(
+            'SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = ?',
+            (chat_id,)
+        ) as cursor:
+            result = await cursor.fetchone()
+    
+    summary = {'summary': result[0], 'last_message_id': result[1]} if result else None
+    _cache.set(('summary', chat_id), summary)
+    return dict(summary) if summary else None
+
+
+async def save_chat_summary(chat_id: int, summary: str, last_message_id: int):
+    """
+    Сохраняет краткое содержание чата до сообщения last_message_id включительно.
+    Не сохраняет, если это сообщение уже удалено (например, история очищена).
+    """
+    async with _write_transaction() as cur:
+        await cur.execute(
+            '''
+            INSERT OR REPLACE INTO chat_summaries (chat_id, summary, last_message_id, updated_at)
+            SELECT ?, ?, ?, CURRENT_TIMESTAMP
+            WHERE EXISTS (
+                SELECT 1 FROM chat_messages WHERE chat_id = ? AND message_id = ?
+            ) OR EXISTS (
+                SELECT 1 FROM chat_archive
+                WHERE chat_id = ? AND ? BETWEEN first_message_id AND last_message_id
+            )
+            ''',
+            (chat_id, summary, last_message_id, chat_id, last_message_id, chat_id, last_message_id)
+        )
+    _cache.invalidate(('summary', chat_id))
+
+
+async def load_conversation_context(user_id: int, content: str, limit: int = 10) -> dict:
+    """
+    Сохраняет сообщение пользователя и одним запросом получает
+    настройки пользователя, активный чат и последние сообщения истории.
+    Для активных чатов история берется из буфера без чтения из базы
+    """
+    async with _write_lock:
+        thinking_mode = _cache.get(('thinking_mode', user_id))
+        model = _cache.get(('model', user_id))
+        chat = _cache.get(('active_chat', user_id))
+        cached = MISSING not in (thinking_mode, model, chat)
+        
+        # Накопленные записи выполняются в той же транзакции,
+        # поэтому история всегда содержит все ранее сохраненные сообщения
+        inserts, updates = _take_pending()
+        try:
+            async with db.cursor() as cur:
+                written = await _execute_pending(cur, inserts, updates)
+                if cached:
+                    # Настройки и чат уже в кэше: нужна только вставка сообщения
+                    written.append((chat['id'], await _insert_user_message(cur, chat['id'], content)))
+                else:
+                    rows = await _load_conversation_rows(cur, user_id, content, limit)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            _restore_pending(inserts, updates)
+            raise
+        _buffer_written(written)
+        
+        if cached:
+            history = _history.get(chat['id'], limit)
+            if history is None:
+                # Чата нет в буфере: читаем историю и заполняем буфер
+                history = await _load_history(chat['id'], limit)
+                _history.hydrate(chat['id'], history, limit)
+        else:
+            first = rows[0]
+            thinking_mode = bool(first[3])
+            model = first[4]
+            chat = {
+                'id': first[0],
+                'name': first[1],
+                'created_at': first[2]
+            }
+            history = [_history_record(row[5:]) for row in rows if row[5] is not None]
+            _history.hydrate(chat['id'], history, limit)
+            
+            _cache.set(('thinking_mode', user_id), thinking_mode)
+            _cache.set(('model', user_id), model)
+            _cache.set(('active_chat', user_id), chat)
+    
+    return {
+        'thinking_mode': thinking_mode,
+        'model': model,
+        'chat': dict(chat),
+        'history': history
+    }
+
+
+def _history_record(row: tuple) -> HistoryRecord:
+    """Запись истории из строки (role, content, created_at, message_id)"""
+    return HistoryRecord(row[3], row[0], row[1], row[2])
+
+
+async def _insert_user_message(cur, chat_id: int, content: str) -> HistoryRecord:
+    """Сохраняет сообщение пользователя в известный чат"""
+    await cur.execute(
+        _INSERT_MESSAGE + ' RETURNING message_id, created_at',
+        (chat_id, 'user', content)
+    )
+    message_id, created_at = (await cur.fetchall())[0]
+    return HistoryRecord(message_id, 'user', content, created_at)
+
+
+async def _load_history(chat_id: int, limit: int) -> list:
+    """Читает последние сообщения чата через основное соединение (под _write_lock)"""
     async with db.execute(
         '''
-        SELECT role, content, created_at 
-        FROM chat_messages 
+        SELECT role, content, created_at, message_id
+        FROM chat_messages
         WHERE chat_id = ?
-        ORDER BY created_at DESC
+        ORDER BY message_id DESC
         LIMIT ?
         ''',
         (chat_id, limit)
     ) as cursor:
-        messages = await cursor.fetchall()
-        return [
-            {
-                'role': msg[0],
-                'content': msg[1],
-                'created_at': msg[2]
-            }
-            for msg in messages
+        rows = await cursor.fetchall()
+    return [_history_record(row) for row in rows]
+
+
+async def _load_conversation_rows(cur, user_id: int, content: str, limit: int) -> list:
+    """Сохраняет сообщение и выбирает строки контекста в текущей транзакции"""
+    # Создаем чат по умолчанию, если активного чата нет
+    await cur.execute(
+        '''
+        INSERT INTO chats (user_id, name, is_active)
+        SELECT ?, ?, 1
+        WHERE NOT EXISTS (
+            SELECT 1 FROM chats WHERE user_id = ? AND is_active = 1
+        )
+        ''',
+        (user_id, "Чат по умолчанию", user_id)
+    )
+    
+    # Сохраняем сообщение пользователя в активный чат
+    await cur.execute(
+        '''
+        INSERT INTO chat_messages (chat_id, role, content)
+        SELECT chat_id, 'user', ?
+        FROM chats
+        WHERE user_id = ? AND is_active = 1
+        LIMIT 1
+        ''',
+        (content, user_id)
+    )
+    
+    # Получаем настройки, активный чат и историю одним запросом
+    await cur.execute(
+        '''
+        WITH active AS (
+            SELECT chat_id, user_id, name, created_at
+            FROM chats
+            WHERE user_id = ? AND is_active = 1
+            LIMIT 1
+        )
+        SELECT a.chat_id, a.name, a.created_at,
+               u.thinking_mode, u.selected_model,
+               m.role, m.content, m.created_at, m.message_id
+        FROM active a
+        LEFT JOIN users u ON u.user_id = a.user_id
+        LEFT JOIN (
+            SELECT message_id, chat_id, role, content, created_at
+            FROM chat_messages
+            WHERE chat_id = (SELECT chat_id FROM active)
+            ORDER BY message_id DESC
+            LIMIT ?
+        ) m ON m.chat_id = a.chat_id
+        ORDER BY m.message_id DESC
+        ''',
+        (user_id, limit)
+    )
+    return await cur.fetchall()
+
+
+async def _archive_loop():
+    """Периодически переносит старые сообщения в архив и освобождает место"""
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try:
+            archived = await archive_old_messages(
+                ARCHIVE_KEEP_MESSAGES,
+                ARCHIVE_MIN_AGE_DAYS,
+                ARCHIVE_MIN_BLOCK_MESSAGES,
+                ARCHIVE_BLOCK_MESSAGES,
+                ARCHIVE_COMPRESSION
+            )
+            removed = await apply_archive_retention(ARCHIVE_RETENTION_DAYS)
+            freed = await reclaim_free_pages(ARCHIVE_VACUUM_PAGES)
+            if archived or removed or freed:
+                logger.info(
+                    f"Archived {archived} messages, removed {removed} archive blocks, "
+                    f"freed {freed} pages"
+                )
+        except Exception as e:
+            logger.error(f"Error archiving messages: {e}")
+
+
+async def archive_old_messages(keep: int, min_age_days: float, min_block: int,
+                               block_messages: int, compression: str) -> int:
+    """
+    Переносит в архив сообщения чатов, не входящие в последние keep сообщений
+    и созданные раньше min_age_days дней назад. Возвращает количество перенесенных сообщений
+    """
+    # Пока поисковый индекс заполняется, сообщения не переносим:
+    # перенесенное непроиндексированное сообщение уже не попало бы в индекс
+    if await search_backfill_pending():
+        return 0
+    
+    async with _read_connection() as conn:
+        # ID растут вместе со временем создания: все старые сообщения лежат до первого нового
+        async with conn.execute(
+            '''
+            SELECT COALESCE(
+                (SELECT message_id FROM chat_messages
+                 WHERE created_at >= datetime('now', ?)
+                 ORDER BY message_id LIMIT 1),
+                (SELECT MAX(message_id) + 1 FROM chat_messages)
+            )
+            ''',
+            (f'-{min_age_days} days',)
+        ) as cursor:
+            cutoff_id = (await cursor.fetchone())[0]
+        if cutoff_id is None:
+            return 0
+        
+        async with conn.execute(
+            '''
+            SELECT chat_id FROM chat_messages
+            WHERE message_id < ?
+            GROUP BY chat_id
+            HAVING COUNT(*) >= ?
+            ''',
+            (cutoff_id, min_block)
+        ) as cursor:
+            chat_ids = [row[0] for row in await cursor.fetchall()]
+    
+    archived = 0
+    for chat_id in chat_ids:
+        archived += await _archive_chat(chat_id, cutoff_id, keep, min_block, block_messages, compression)
+    return archived
+
+
+async def _archive_chat(chat_id: int, cutoff_id: int, keep: int, min_block: int,
+                        block_messages: int, compression: str) -> int:
+    """Переносит старые сообщения одного чата в архив блоками по block_messages"""
+    archived = 0
+    while True:
+        async with _read_connection() as conn:
+            # Последние keep сообщений остаются в основной таблице
+            async with conn.execute(
+                '''
+                SELECT message_id, role, content, created_at
+                FROM chat_messages
+                WHERE chat_id = ? AND message_id < ? AND message_id <= COALESCE((
+                    SELECT message_id FROM chat_messages
+                    WHERE chat_id = ?
+                    ORDER BY message_id DESC
+                    LIMIT 1 OFFSET ?
+                ), 0)
+                ORDER BY message_id
+                LIMIT ?
+                ''',
+                (chat_id, cutoff_id, chat_id, keep, block_messages)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        
+        if len(rows) < min_block:
+            return archived
+        
+        # Сжатие выполняется вне цикла событий
+        data = await asyncio.to_thread(pack_messages, rows, compression)
+        
+        async with _write_lock:
+            try:
+                async with db.cursor() as cur:
+                    # Блок записывается до удаления строк: по нему триггер поискового
+                    # индекса понимает, что сообщения перенесены, а не удалены
+                    await cur.execute(
+                        '''
+                        INSERT INTO chat_archive (
+                            chat_id, first_message_id, last_message_id, message_count,
+                            first_created_at, last_created_at, compression, data
+                        )
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ''',
+                        (chat_id, rows[0][0], rows[-1][0], len(rows),
+                         rows[0][3], rows[-1][3], compression, data)
+                    )
+                    await cur.execute(
+                        'DELETE FROM chat_messages WHERE chat_id = ? AND message_id BETWEEN ? AND ?',
+                        (chat_id, rows[0][0], rows[-1][0])
+                    )
+                    if cur.rowcount != len(rows):
+                        # Чат очищен или удален во время архивирования
+                        await db.rollback()
+                        return archived
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        
+        archived += len(rows)
+        if len(rows) < block_messages:
+            return archived
+
+
+async def apply_archive_retention(retention_days: float) -> int:
+    """Удаляет блоки архива старше retention_days дней (0 - хранить всегда)"""
+    if retention_days <= 0:
+        return 0
+    
+    async with _write_lock:
+        try:
+            async with db.cursor() as cur:
+                removed = await _delete_archive_blocks(
+                    cur,
+                    "last_created_at < datetime('now', ?)",
+                    (f'-{retention_days} days',)
+                )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    return removed
+
+
+async def _delete_archive_blocks(cur, condition: str, params: tuple) -> int:
+    """
+    Удаляет блоки архива, подходящие под условие, и убирает их сообщения из поискового индекса.
+    Возвращает количество удаленных блоков
+    """
+    await cur.execute(f'SELECT archive_id FROM chat_archive WHERE {condition}', params)
+    archive_ids = [row[0] for row in await cur.fetchall()]
+    if not archive_ids:
+        return 0
+    
+    await cur.execute('SELECT archive_last_id, archive_end_id FROM chat_messages_fts_backfill')
+    archive_last_id, archive_end_id = await cur.fetchone()
+    
+    for archive_id in archive_ids:
+        if archive_last_id < archive_id <= archive_end_id:
+            # Блок еще не проиндексирован
+            continue
+        
+        await cur.execute(
+            '''
+            SELECT c.user_id, a.chat_id, a.compression, a.data
+            FROM chat_archive a
+            JOIN chats c ON c.chat_id = a.chat_id
+            WHERE a.archive_id = ?
+            ''',
+            (archive_id,)
+        )
+        block = await cur.fetchone()
+        if not block:
+            continue
+        
+        user_id, chat_id, compression, data = block
+        owner = _search_owner(user_id, chat_id)
+        await cur.executemany(
+            '''
+            INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content, owner)
+            VALUES ('delete', ?, ?, ?)
+            ''',
+            [
+                (message_id, content, owner)
+                for message_id, role, content, created_at in unpack_messages(data, compression)
+            ]
+        )
+    
+    await cur.execute(f'DELETE FROM chat_archive WHERE {condition}', params)
+    return len(archive_ids)
+
+
+async def reclaim_free_pages(pages_per_step: int) -> int:
+    """
+    Возвращает системе место удаленных строк через PRAGMA incremental_vacuum.
+    Страницы освобождаются шагами по pages_per_step, чтобы не задерживать запись сообщений надолго.
+    Возвращает количество освобожденных страниц
+    """
+    async with db.execute('PRAGMA auto_vacuum') as cursor:
+        if (await cursor.fetchone())[0] != 2:
+            # База создана без auto_vacuum = INCREMENTAL
+            return 0
+    
+    freed = 0
+    while True:
+        async with _write_lock:
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                free_pages = (await cursor.fetchone())[0]
+            if free_pages == 0:
+                return freed
+            
+            step = min(free_pages, pages_per_step) if pages_per_step > 0 else free_pages
+            # execute выполняет один шаг прагмы, а каждый шаг освобождает одну страницу.
+            # executescript не подходит: он фиксирует открытую транзакцию
+            for _ in range(step):
+                await db.execute('PRAGMA incremental_vacuum(1)')
+            freed += step
+
+
+def _search_owner(user_id: int, chat_id: int) -> str:
+    """Значение колонки owner поискового индекса: токены пользователя и чата"""
+    return f'u{user_id} c{chat_id}'
+
+
+async def search_backfill_pending() -> bool:
+    """Поисковый индекс еще не содержит всех сообщений, записанных до его создания"""
+    async with db.execute(
+        '''
+        SELECT hot_last_id < hot_end_id OR archive_last_id < archive_end_id
+        FROM chat_messages_fts_backfill
+        '''
+    ) as cursor:
+        row = await cursor.fetchone()
+    return bool(row and row[0])
+
+
+async def _search_backfill_loop():
+    """Заполняет поисковый индекс небольшими шагами, не блокируя запись сообщений надолго"""
+    indexed = 0
+    try:
+        while True:
+            count = await backfill_search_index(SEARCH_BACKFILL_BATCH)
+            if count is None:
+                break
+            indexed += count
+            await asyncio.sleep(SEARCH_BACKFILL_DELAY)
+        logger.info(f"Search index backfill finished: {indexed} messages indexed")
+    except Exception as e:
+        logger.error(f"Error backfilling search index: {e}")
+
+
+async def backfill_search_index(batch_size: int):
+    """
+    Индексирует следующую пачку сообщений, записанных до создания индекса:
+    сначала из основной таблицы, затем из архива (по блоку за шаг).
+    Возвращает количество проиндексированных сообщений или None, если индекс заполнен
+    """
+    async with _write_lock:
+        async with db.execute(
+            'SELECT hot_last_id, hot_end_id, archive_last_id, archive_end_id FROM chat_messages_fts_backfill'
+        ) as cursor:
+            hot_last_id, hot_end_id, archive_last_id, archive_end_id = await cursor.fetchone()
+        
+        try:
+            async with db.cursor() as cur:
+                if hot_last_id < hot_end_id:
+                    count = await _backfill_messages(cur, hot_last_id, hot_end_id, batch_size)
+                elif archive_last_id < archive_end_id:
+                    count = await _backfill_archive_block(cur, archive_last_id, archive_end_id)
+                else:
+                    return None
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+    return count
+
+
+async def _backfill_messages(cur, last_id: int, end_id: int, batch_size: int) -> int:
+    """Индексирует сообщения основной таблицы с last_id < message_id <= (ID конца пачки)"""
+    await cur.execute(
+        '''
+        SELECT message_id FROM chat_messages
+        WHERE message_id > ? AND message_id <= ?
+        ORDER BY message_id
+        LIMIT 1 OFFSET ?
+        ''',
+        (last_id, end_id, batch_size - 1)
+    )
+    row = await cur.fetchone()
+    upper_id = row[0] if row else end_id
+    
+    await cur.execute(
+        '''
+        INSERT INTO chat_messages_fts (rowid, content, owner)
+        SELECT m.message_id, m.content, 'u' || c.user_id || ' c' || c.chat_id
+        FROM chat_messages m
+        JOIN chats c ON c.chat_id = m.chat_id
+        WHERE m.message_id > ? AND m.message_id <= ?
+        ''',
+        (last_id, upper_id)
+    )
+    count = cur.rowcount
+    await cur.execute('UPDATE chat_messages_fts_backfill SET hot_last_id = ?', (upper_id,))
+    return count
+
+
+async def _backfill_archive_block(cur, last_id: int, end_id: int) -> int:
+    """Индексирует сообщения следующего блока архива с last_id < archive_id <= end_id"""
+    await cur.execute(
+        '''
+        SELECT a.archive_id, c.user_id, a.chat_id, a.compression, a.data
+        FROM chat_archive a
+        LEFT JOIN chats c ON c.chat_id = a.chat_id
+        WHERE a.archive_id > ? AND a.archive_id <= ?
+        ORDER BY a.archive_id
+        LIMIT 1
+        ''',
+        (last_id, end_id)
+    )
+    block = await cur.fetchone()
+    if not block:
+        await cur.execute('UPDATE chat_messages_fts_backfill SET archive_last_id = ?', (end_id,))
+        return 0
+    
+    archive_id, user_id, chat_id, compression, data = block
+    rows = []
+    if user_id is not None:
+        owner = _search_owner(user_id, chat_id)
+        rows = [
+            (message_id, content, owner)
+            for message_id, role, content, created_at in unpack_messages(data, compression)
         ]
+        await cur.executemany(
+            'INSERT INTO chat_messages_fts (rowid, content, owner) VALUES (?, ?, ?)',
+            rows
+        )
+    await cur.execute('UPDATE chat_messages_fts_backfill SET archive_last_id = ?', (archive_id,))
+    return len(rows)
+
+
+async def search_messages(user_id: int, query: str, limit: int = 5, offset: int = 0) -> list:
+    """
+    Ищет сообщения во всех чатах пользователя, включая архив.
+    query - выражение FTS5 (см. services/search.py).
+    Возвращает сообщения в порядке релевантности с названием чата
+    """
+    async with _read_connection() as conn:
+        # Релевантность считается только по тексту сообщения, без колонки владельца
+        async with conn.execute(
+            '''
+            SELECT rowid
+            FROM chat_messages_fts
+            WHERE chat_messages_fts MATCH ?
+            ORDER BY bm25(chat_messages_fts, 1.0, 0.0), rowid DESC
+            LIMIT ? OFFSET ?
+            ''',
+            (f'owner : u{user_id} AND content : ({query})', limit, offset)
+        ) as cursor:
+            message_ids = [row[0] for row in await cursor.fetchall()]
+        if not message_ids:
+            return []
+        
+        # Текст найденных сообщений: из основной таблицы или из архива
+        placeholders = ", ".join("?" * len(message_ids))
+        async with conn.execute(
+            f'''
+            SELECT m.message_id, m.chat_id, c.name, m.role, m.content, m.created_at
+            FROM chat_messages m
+            JOIN chats c ON c.chat_id = m.chat_id
+            WHERE m.message_id IN ({placeholders}) AND c.user_id = ?
+            ''',
+            (*message_ids, user_id)
+        ) as cursor:
+            found = {row[0]: row for row in await cursor.fetchall()}
+        
+        for message_id in message_ids:
+            if message_id not in found:
+                row = await _find_archived_message(conn, user_id, message_id)
+                if row:
+                    found[message_id] = row
+    
+    return [
+        {
+            'id': found[message_id][0],
+            'chat_id': found[message_id][1],
+            'chat_name': found[message_id][2],
+            'role': found[message_id][3],
+            'content': found[message_id][4],
+            'created_at': found[message_id][5]
+        }
+        for message_id in message_ids
+        if message_id in found
+    ]
+
+
+async def _find_archived_message(conn, user_id: int, message_id: int):
+    """Находит сообщение пользователя в архиве: (message_id, chat_id, name, role, content, created_at)"""
+    async with conn.execute(
+        '''
+        SELECT a.chat_id, c.name, a.compression, a.data
+        FROM chat_archive a
+        JOIN chats c ON c.chat_id = a.chat_id
+        WHERE c.user_id = ? AND ? BETWEEN a.first_message_id AND a.last_message_id
+        ''',
+        (user_id, message_id)
+    ) as cursor:
+        blocks = await cursor.fetchall()
+    
+    for chat_id, name, compression, data in blocks:
+        for archived_id, role, content, created_at in unpack_messages(data, compression):
+            if archived_id == message_id:
+                return (message_id, chat_id, name, role, content, created_at)
+    return None
+
+
+async def find_relevant_messages(chat_id: int, query: str, before_id: int, limit: int = 5) -> list:
+    """
+    Находит в чате сообщения старше before_id, наиболее релевантные запросу (BM25), включая архив.
+    query - выражение FTS5 (см. services/search.py).
+    Возвращает сообщения в порядке релевантности
+    """
+    async with _read_connection() as conn:
+        async with conn.execute(
+            '''
+            SELECT rowid
+            FROM chat_messages_fts
+            WHERE chat_messages_fts MATCH ? AND rowid < ?
+            ORDER BY bm25(chat_messages_fts, 1.0, 0.0)
+            LIMIT ?
+            ''',
+            (f'owner : c{chat_id} AND content : ({query})', before_id, limit)
+        ) as cursor:
+            message_ids = [row[0] for row in await cursor.fetchall()]
+        if not message_ids:
+            return []
+        
+        placeholders = ", ".join("?" * len(message_ids))
+        async with conn.execute(
+            f'''
+            SELECT message_id, role, content, created_at
+            FROM chat_messages
+            WHERE message_id IN ({placeholders}) AND chat_id = ?
+            ''',
+            (*message_ids, chat_id)
+        ) as cursor:
+            found = {row[0]: row for row in await cursor.fetchall()}
+        
+        missing = [message_id for message_id in message_ids if message_id not in found]
+        if missing:
+            found.update(await _read_archived_messages(conn, chat_id, missing))
+    
+    return [
+        {
+            'id': found[message_id][0],
+            'role': found[message_id][1],
+            'content': found[message_id][2],
+            'created_at': found[message_id][3]
+        }
+        for message_id in message_ids
+        if message_id in found
+    ]
+
+
+async def _read_archived_messages(conn, chat_id: int, message_ids: list) -> dict:
+    """Читает сообщения чата из архива: {message_id: (message_id, role, content, created_at)}"""
+    wanted = set(message_ids)
+    found = {}
+    for message_id in message_ids:
+        if message_id in found:
+            # Уже распакован вместе с другим сообщением того же блока
+            continue
+        
+        async with conn.execute(
+            '''
+            SELECT compression, data
+            FROM chat_archive
+            WHERE chat_id = ? AND ? BETWEEN first_message_id AND last_message_id
+            ''',
+            (chat_id, message_id)
+        ) as cursor:
+            block = await cursor.fetchone()
+        if not block:
+            continue
+        
+        for row in unpack_messages(block[1], block[0]):
+            if row[0] in wanted:
+                found[row[0]] = row
+    return found
+
+
+async def get_cached_response(cache_key: str, min_created_at: float) -> str:
+    """Получает закэшированный ответ модели, если он не устарел"""
+    async with _read_connection() as conn:
+        async with conn.execute(
+            'SELECT response FROM response_cache WHERE cache_key = ? AND created_at >= ?',
+            (cache_key, min_created_at)
+        ) as cursor:
+            result = await cursor.fetchone()
+    
+    if not result:
+        return None
+    
+    await _touch_cached_response(cache_key)
+    return result[0]
+
+
+async def find_similar_cached_responses(band_keys: list, model: str, min_created_at: float) -> list:
+    """Находит кэшированные ответы, совпадающие хотя бы по одной полосе MinHash"""
+    if not band_keys:
+        return []
+    
+    placeholders = ", ".join("?" for _ in band_keys)
+    async with _read_connection() as conn:
+        async with conn.execute(
+            f'''
+            SELECT DISTINCT c.cache_key, c.response, c.signature
+            FROM response_cache_bands b
+            JOIN response_cache c ON c.cache_key = b.cache_key
+            WHERE b.band_key IN ({placeholders})
+              AND c.model = ? AND c.created_at >= ?
+            ''',
+            (*band_keys, model, min_created_at)
+        ) as cursor:
+            rows = await cursor.fetchall()
+    
+    return [
+        {
+            'key': row[0],
+            'response': row[1],
+            'signature': row[2]
+        }
+        for row in rows
+    ]
+
+
+async def _touch_cached_response(cache_key: str):
+    """
+    Отмечает использование ответа из кэша (для вытеснения LRU).
+    Отметка ставится в очередь отложенной записи (даже если она выключена для
+    сообщений) и записывается вместе с ближайшей транзакцией или сбросом очереди,
+    чтобы попадания в кэш не занимали пишущее соединение. Повторные попадания
+    в один ответ схлопываются в одно обновление
+    """
+    key = (_TOUCH_CACHED_RESPONSE, cache_key)
+    previous = _pending_updates.get(key)
+    hits = previous[1] + 1 if previous else 1
+    _pending_updates[key] = (time.time(), hits, cache_key)
+    if len(_pending_inserts) + len(_pending_updates) >= WRITE_BEHIND_BATCH_SIZE:
+        await flush_writes()
+
+
+async def save_cached_response(cache_key: str, model: str, response: str,
+                               signature: bytes = None, band_keys: list = None):
+    """Сохраняет ответ модели в кэш"""
+    now = time.time()
+    async with _write_transaction() as cur:
+        await cur.execute(
+            '''
+            INSERT OR REPLACE INTO response_cache
+                (cache_key, model, response, signature, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''',
+            (cache_key, model, response, signature, now, now)
+        )
+        if band_keys:
+            await cur.executemany(
+                'INSERT OR IGNORE INTO response_cache_bands (band_key, cache_key) VALUES (?, ?)',
+                [(band_key, cache_key) for band_key in band_keys]
+            )
+
+
+async def evict_response_cache(max_entries: int, min_created_at: float) -> int:
+    """Удаляет устаревшие ответы и самые давно использованные сверх лимита"""
+    async with _write_transaction() as cur:
+        await cur.execute(
+            'DELETE FROM response_cache WHERE created_at < ?',
+            (min_created_at,)
+        )
+        expired = cur.rowcount
+        
+        await cur.execute(
+            '''
+            DELETE FROM response_cache WHERE cache_key IN (
+                SELECT cache_key FROM response_cache
+                ORDER BY last_used_at DESC
+                LIMIT -1 OFFSET ?
+            )
+            ''',
+            (max_entries,)
+        )
+        evicted = cur.rowcount
+        
+        await cur.execute(
+            '''
+            DELETE FROM response_cache_bands
+            WHERE cache_key NOT IN (SELECT cache_key FROM response_cache)
+            '''
+        )
+    
+    return expired + evicted
+
+
+
+async def get_fsm_record(storage_key: str) -> dict:
+    """Получает состояние FSM и его данные по ключу"""
+    async with _read_connection() as conn:
+        async with conn.execute(
+            'SELECT state, data FROM fsm_storage WHERE storage_key = ?',
+            (storage_key,)
+        ) as cursor:
+            result = await cursor.fetchone()
+    
+    if not result:
+        return None
+    return {
+        'state': result[0],
+        'data': result[1]
+    }
+
+
+async def set_fsm_state(storage_key: str, state: str = None):
+    """Устанавливает состояние FSM (None - сброс состояния)"""
+    async with _write_transaction() as cur:
+        await cur.execute(
+            '''
+            INSERT INTO fsm_storage (storage_key, state) VALUES (?, ?)
+            ON CONFLICT(storage_key) DO UPDATE
+            SET state = excluded.state, updated_at = CURRENT_TIMESTAMP
+            ''',
+            (storage_key, state)
+        )
+        await _delete_empty_fsm_record(cur, storage_key)
+
+
+async def set_fsm_data(storage_key: str, data: str):
+    """Сохраняет данные FSM (JSON-строка)"""
+    async with _write_transaction() as cur:
+        await cur.execute(
+            '''
+            INSERT INTO fsm_storage (storage_key, data) VALUES (?, ?)
+            ON CONFLICT(storage_key) DO UPDATE
+            SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+            ''',
+            (storage_key, data)
+        )
+        await _delete_empty_fsm_record(cur, storage_key)
+
+
+async def _delete_empty_fsm_record(cur, storage_key: str):
+    """Удаляет запись без состояния и данных, чтобы таблица не росла"""
+    await cur.execute(
+        "DELETE FROM fsm_storage WHERE storage_key = ? AND state IS NULL AND data = '{}'",
+        (storage_key,)
+    )
@@ -0,0 +1,48 @@
+import json
+import logging
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в общей базе SQLite.
+    Состояния переживают перезапуск и доступны всем процессам бота.
+    """
+    
+    def __init__(self, key_builder: Optional[KeyBuilder] = None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        """Устанавливает состояние для ключа"""
+        value = state.state if isinstance(state, State) else state
+        await db.set_fsm_state(self.key_builder.build(key), value)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        """Получает состояние для ключа"""
+        record = await db.get_fsm_record(self.key_builder.build(key))
+        return record['state'] if record else None
+    
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        """Заменяет данные для ключа"""
+        await db.set_fsm_data(
+            self.key_builder.build(key),
+            json.dumps(dict(data), ensure_ascii=False)
+        )
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        """Получает данные для ключа"""
+        record = await db.get_fsm_record(self.key_builder.build(key))
+        if not record or not record['data']:
+            return {}
+        return json.loads(record['data'])
+    
+    async def close(self) -> None:
+        """Соединение с базой закрывается вместе с db.close_db()"""
+        pass
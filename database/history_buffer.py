@@ -0,0 +1,153 @@
+import itertools
+import sys
+from collections import OrderedDict, deque
+
+# Память, занимаемая записью без текста сообщения (объект, ссылки, числа), байт
+RECORD_OVERHEAD = 120
+
+
+class HistoryRecord:
+    """
+    Сообщение истории чата.
+    Поля читаются и как атрибуты, и как ключи словаря: msg.content или msg['content']
+    """
+    
+    __slots__ = ('id', 'role', 'content', 'created_at')
+    
+    def __init__(self, message_id: int, role: str, content: str, created_at):
+        self.id = message_id
+        self.role = role
+        self.content = content
+        self.created_at = created_at
+    
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def size(self) -> int:
+        """Приблизительный объем памяти записи в байтах"""
+        return sys.getsizeof(self.content) + RECORD_OVERHEAD
+    
+    def to_dict(self) -> dict:
+        return {
+            'role': self.role,
+            'content': self.content,
+            'created_at': self.created_at,
+            'id': self.id
+        }
+
+
+class _ChatHistory:
+    """Последние сообщения одного чата"""
+    
+    __slots__ = ('records', 'complete', 'size')
+    
+    def __init__(self, records: deque, complete: bool):
+        self.records = records
+        # В буфере все сообщения чата (чат короче емкости буфера)
+        self.complete = complete
+        self.size = sum(record.size() for record in records)
+
+
+class HistoryBuffer:
+    """
+    Кольцевые буферы последних сообщений активных чатов.
+    Буфер чата заполняется из базы при первом обращении и дополняется при записи сообщений.
+    При превышении общего объема max_bytes вытесняются давно не использованные чаты.
+    """
+    
+    def __init__(self, max_messages: int = 40, max_bytes: int = 64 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._chats = OrderedDict()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_messages > 0 and self.max_bytes > 0
+    
+    def get(self, chat_id: int, limit: int):
+        """
+        Возвращает не больше limit последних сообщений чата (от новых к старым)
+        или None, если в буфере их недостаточно
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None or (len(chat.records) < limit and not chat.complete):
+            self.misses += 1
+            return None
+        
+        self._chats.move_to_end(chat_id)
+        self.hits += 1
+        return list(itertools.islice(reversed(chat.records), limit))
+    
+    def hydrate(self, chat_id: int, records: list, limit: int):
+        """
+        Заполняет буфер чата сообщениями из базы.
+        records - последние сообщения от новых к старым, выбранные с ограничением limit
+        """
+        if not self.enabled:
+            return
+        
+        complete = len(records) < limit and len(records) <= self.max_messages
+        chat = _ChatHistory(
+            deque(reversed(records[:self.max_messages]), maxlen=self.max_messages),
+            complete
+        )
+        self.invalidate(chat_id)
+        self._chats[chat_id] = chat
+        self.size += chat.size
+        self._evict()
+    
+    def append(self, chat_id: int, record: HistoryRecord):
+        """Добавляет записанное сообщение в буфер чата (если чат в буфере)"""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return
+        
+        if chat.records and chat.records[-1].id >= record.id:
+            # Порядок нарушен - буфер больше не отражает базу
+            self.invalidate(chat_id)
+            return
+        
+        if len(chat.records) == self.max_messages:
+            removed = chat.records[0].size()
+            chat.size -= removed
+            self.size -= removed
+            chat.complete = False
+        
+        chat.records.append(record)
+        added = record.size()
+        chat.size += added
+        self.size += added
+        self._chats.move_to_end(chat_id)
+        self._evict()
+    
+    def invalidate(self, chat_id: int):
+        """Удаляет буфер чата"""
+        chat = self._chats.pop(chat_id, None)
+        if chat is not None:
+            self.size -= chat.size
+    
+    def clear(self):
+        """Очищает все буферы"""
+        self._chats.clear()
+        self.size = 0
+    
+    def _evict(self):
+        """Вытесняет давно не использованные чаты, пока объем больше max_bytes"""
+        while self.size > self.max_bytes and self._chats:
+            chat_id, chat = self._chats.popitem(last=False)
+            self.size -= chat.size
+    
+    def stats(self) -> dict:
+        """Возвращает статистику буфера"""
+        return {
+            'chats': len(self._chats),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses
+        }
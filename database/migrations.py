@@ -0,0 +1,265 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Список миграций схемы: (версия, описание, SQL-запросы)
+# Текущая версия хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка с увеличением версии.
+MIGRATIONS = [
+    (
+        1,
+        "Indexes for chats and chat_messages",
+        [
+            # Оставляем у каждого пользователя только один активный чат (самый новый),
+            # иначе уникальный индекс ниже не создастся на старых базах
+            '''
+            UPDATE chats SET is_active = 0
+            WHERE is_active = 1 AND chat_id NOT IN (
+                SELECT MAX(chat_id) FROM chats
+                WHERE is_active = 1
+                GROUP BY user_id
+            )
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id
+            ON chat_messages (chat_id, message_id DESC)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_chats_user_active
+            ON chats (user_id, is_active)
+            ''',
+            '''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_chats_single_active
+            ON chats (user_id) WHERE is_active = 1
+            ''',
+        ]
+    ),
+    (
+        2,
+        "Rolling chat summaries",
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS chat_summaries (
+                chat_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+            )
+            ''',
+        ]
+    ),
+    (
+        3,
+        "Response cache",
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                signature BLOB,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hits INTEGER DEFAULT 0
+            )
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_response_cache_last_used
+            ON response_cache (last_used_at)
+            ''',
+            # Полосы MinHash для поиска похожих запросов
+            '''
+            CREATE TABLE IF NOT EXISTS response_cache_bands (
+                band_key TEXT NOT NULL,
+                cache_key TEXT NOT NULL,
+                PRIMARY KEY (band_key, cache_key)
+            ) WITHOUT ROWID
+            ''',
+        ]
+    ),
+    (
+        4,
+        "FSM storage",
+        [
+            # Состояния FSM, общие для всех процессов бота
+            '''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                storage_key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+        ]
+    ),
+    (
+        5,
+        "Compressed message archive",
+        [
+            # Старые сообщения чата, сжатые блоками (см. database/archive.py)
+            '''
+            CREATE TABLE IF NOT EXISTS chat_archive (
+                archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                first_message_id INTEGER NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                message_count INTEGER NOT NULL,
+                first_created_at TIMESTAMP,
+                last_created_at TIMESTAMP,
+                compression TEXT NOT NULL,
+                data BLOB NOT NULL,
+                FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+            )
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_chat_archive_chat
+            ON chat_archive (chat_id, first_message_id)
+            ''',
+            # Место удаленных строк возвращается через PRAGMA incremental_vacuum.
+            # На существующей базе режим включается только после VACUUM
+            'PRAGMA auto_vacuum = INCREMENTAL',
+            'VACUUM',
+        ]
+    ),
+    (
+        6,
+        "Full-text search over chat messages",
+        [
+            # Индекс без собственной копии текста: текст берется из chat_messages или архива.
+            # owner - токен владельца "u<user_id>", чтобы искать только в чатах пользователя
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+                content,
+                owner,
+                content='',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+            ''',
+            # Прогресс заполнения индекса сообщениями, записанными до миграции:
+            # проиндексированы сообщения с ID <= hot_last_id или > hot_end_id
+            # и блоки архива с ID <= archive_last_id или > archive_end_id
+            '''
+            CREATE TABLE IF NOT EXISTS chat_messages_fts_backfill (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                hot_last_id INTEGER NOT NULL,
+                hot_end_id INTEGER NOT NULL,
+                archive_last_id INTEGER NOT NULL,
+                archive_end_id INTEGER NOT NULL
+            )
+            ''',
+            '''
+            INSERT OR IGNORE INTO chat_messages_fts_backfill
+            SELECT 1, 0, (SELECT COALESCE(MAX(message_id), 0) FROM chat_messages),
+                   0, (SELECT COALESCE(MAX(archive_id), 0) FROM chat_archive)
+            ''',
+            # Новые сообщения индексируются сразу (сообщения не изменяются, только удаляются)
+            '''
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert
+            AFTER INSERT ON chat_messages
+            BEGIN
+                INSERT INTO chat_messages_fts (rowid, content, owner)
+                SELECT new.message_id, new.content, 'u' || user_id
+                FROM chats WHERE chat_id = new.chat_id;
+            END
+            ''',
+            # Удаленное сообщение убирается из индекса, если оно было проиндексировано
+            # и не перенесено в архив (блок архива записывается до удаления строк)
+            '''
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete
+            AFTER DELETE ON chat_messages
+            WHEN NOT EXISTS (
+                SELECT 1 FROM chat_archive
+                WHERE chat_id = old.chat_id
+                  AND old.message_id BETWEEN first_message_id AND last_message_id
+            ) AND (
+                SELECT old.message_id <= hot_last_id OR old.message_id > hot_end_id
+                FROM chat_messages_fts_backfill
+            )
+            BEGIN
+                INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content, owner)
+                SELECT 'delete', old.message_id, old.content, 'u' || user_id
+                FROM chats WHERE chat_id = old.chat_id;
+            END
+            ''',
+        ]
+    ),
+    (
+        7,
+        "Chat token in the full-text search index",
+        [
+            # owner становится "u<user_id> c<chat_id>", чтобы искать и в одном чате.
+            # Строки индекса без исходных значений не удалить, поэтому индекс
+            # очищается целиком и заполняется заново в фоне
+            'DROP TRIGGER IF EXISTS chat_messages_fts_insert',
+            'DROP TRIGGER IF EXISTS chat_messages_fts_delete',
+            "INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('delete-all')",
+            '''
+            UPDATE chat_messages_fts_backfill SET
+                hot_last_id = 0,
+                hot_end_id = (SELECT COALESCE(MAX(message_id), 0) FROM chat_messages),
+                archive_last_id = 0,
+                archive_end_id = (SELECT COALESCE(MAX(archive_id), 0) FROM chat_archive)
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert
+            AFTER INSERT ON chat_messages
+            BEGIN
+                INSERT INTO chat_messages_fts (rowid, content, owner)
+                SELECT new.message_id, new.content, 'u' || user_id || ' c' || chat_id
+                FROM chats WHERE chat_id = new.chat_id;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete
+            AFTER DELETE ON chat_messages
+            WHEN NOT EXISTS (
+                SELECT 1 FROM chat_archive
+                WHERE chat_id = old.chat_id
+                  AND old.message_id BETWEEN first_message_id AND last_message_id
+            ) AND (
+                SELECT old.message_id <= hot_last_id OR old.message_id > hot_end_id
+                FROM chat_messages_fts_backfill
+            )
+            BEGIN
+                INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content, owner)
+                SELECT 'delete', old.message_id, old.content, 'u' || user_id || ' c' || chat_id
+                FROM chats WHERE chat_id = old.chat_id;
+            END
+            ''',
+        ]
+    ),
+]
+
+
+async def get_schema_version(db) -> int:
+    """Получает текущую версию схемы базы данных"""
+    async with db.execute('PRAGMA user_version') as cursor:
+        result = await cursor.fetchone()
+        return result[0] if result else 0
+
+
+async def apply_migrations(db):
+    """Применяет все миграции, которые ещё не были применены к базе"""
+    current_version = await get_schema_version(db)
+    
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        
+        try:
+            async with db.cursor() as cur:
+                for statement in statements:
+                    await cur.execute(statement)
+                # PRAGMA не поддерживает параметры, версия всегда int
+                await cur.execute(f'PRAGMA user_version = {int(version)}')
+            await db.commit()
+            logger.info(f"Applied migration {version}: {description}")
+            
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Error applying migration {version}: {e}")
+            raise
+    
+    latest_version = MIGRATIONS[-1][0] if MIGRATIONS else 0
+    logger.info(f"Database schema version: {max(current_version, latest_version)}")
@@ -1,17 +1,28 @@
+import html
 import logging
+import os
+import re
+import time
+from contextlib import aclosing
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery
-from aiogram.filters import Command
+from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.filters import Command, CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 from database import db
+from config import SEARCH_PAGE_SIZE, SEARCH_SNIPPET_CHARS, TEMP_DIR, EXPORT_BATCH_SIZE, EXPORT_MAX_BYTES
+from services.search import get_query_terms, build_match_query, make_snippet
+from services.export import EXPORT_FORMATS, ExportTooLargeError, write_export
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 
+# Пользователи, для которых сейчас готовится файл экспорта
+_exports_in_progress = set()
+
 class ChatStates(StatesGroup):
     """Состояния для управления чатами"""
     waiting_for_chat_name = State()  # Ожидание имени чата
@@ -22,8 +33,10 @@ def register_handlers(dp):
     """Регистрация обработчиков команд чата"""
     logger.info("Registering chat command handlers")
     
-    # Регистрируем команду /chats
+    # Регистрируем команды /chats, /search и /export
     router.message.register(cmd_chats, Command("chats"))
+    router.message.register(cmd_search, Command("search"))
+    router.message.register(cmd_export, Command("export"))
     
     # Регистрируем обработчики callback'ов
     router.callback_query.register(
@@ -34,6 +47,10 @@ def register_handlers(dp):
         process_chat_action_callback,
         lambda c: c.data and c.data.startswith("chat_action_")
     )
+    router.callback_query.register(
+        process_search_callback,
+        lambda c: c.data and c.data.startswith("search_page_")
+    )
     
     # Регистрируем обработчик ввода имени чата
     router.message.register(
@@ -116,7 +133,6 @@ async def process_chat_list_callback(callback: CallbackQuery, state: FSMContext)
     """Обработчик выбора чата из списка"""
     try:
         action = callback.data.split('_')[2]
-        user_id = callback.from_user.id
         
         if action == 'new':
             # Запрашиваем имя нового чата
@@ -143,6 +159,14 @@ async def process_chat_list_callback(callback: CallbackQuery, state: FSMContext)
                 text="🗑️ Очистить историю",
                 callback_data=f"chat_action_clear_{chat_id}"
             )
+            builder.button(
+                text="📤 Экспорт в Markdown",
+                callback_data=f"chat_action_export_{chat_id}_md"
+            )
+            builder.button(
+                text="📤 Экспорт в JSONL",
+                callback_data=f"chat_action_export_{chat_id}_jsonl"
+            )
             builder.button(
                 text="❌ Удалить чат",
                 callback_data=f"chat_action_delete_{chat_id}"
@@ -218,6 +242,17 @@ async def process_chat_action_callback(callback: CallbackQuery, state: FSMContex
             await callback.message.delete()
             await show_chat_list_to_chat(chat.id, callback.from_user.id, callback.message)
             
+        elif action == 'export':
+            # Отправляем историю чата файлом
+            export_format = parts[4] if len(parts) > 4 else "md"
+            await callback.answer("Готовим файл экспорта...")
+            try:
+                await send_chat_export(callback.message, callback.from_user.id, chat_id, export_format)
+            except Exception as e:
+                # На callback уже ответили, об ошибке сообщаем отдельным сообщением
+                logger.error(f"Error exporting chat: {e}")
+                await callback.message.answer("Не удалось выгрузить чат. Попробуйте позже.")
+            
     except Exception as e:
         logger.error(f"Error processing chat action callback: {e}")
         await callback.answer(
@@ -230,7 +265,7 @@ async def process_chat_name(message: Message, state: FSMContext):
     """Обработчик ввода имени нового чата"""
     try:
         # Создаем новый чат
-        chat_id = await db.create_chat(message.from_user.id, message.text)
+        await db.create_chat(message.from_user.id, message.text)
         
         # Сбрасываем состояние
         await state.clear()
@@ -269,3 +304,178 @@ async def process_chat_rename(message: Message, state: FSMContext):
             "Произошла ошибка при переименовании чата. "
             "Попробуйте позже или обратитесь к администратору."
         )
+
+
+async def cmd_search(message: Message, command: CommandObject, state: FSMContext):
+    """Обработчик команды /search"""
+    try:
+        query = (command.args or "").strip()
+        if not get_query_terms(query):
+            await message.reply(
+                "Укажите, что найти, например:\n/search рецепт пирога"
+            )
+            return
+        
+        # Запрос сохраняем для переключения страниц (в callback_data он может не поместиться)
+        await state.update_data(search_query=query)
+        await show_search_results(message, message.from_user.id, query, 0)
+    
+    except Exception as e:
+        logger.error(f"Error in search command: {e}", extra={'user_id': message.from_user.id})
+        await message.reply("Произошла ошибка при поиске. Попробуйте позже.")
+
+
+async def process_search_callback(callback: CallbackQuery, state: FSMContext):
+    """Обработчик переключения страниц результатов поиска"""
+    try:
+        page = int(callback.data.split('_')[2])
+        data = await state.get_data()
+        query = data.get('search_query')
+        
+        if not query:
+            await callback.answer(
+                "Результаты поиска устарели. Повторите поиск командой /search",
+                show_alert=True
+            )
+            return
+        
+        await show_search_results(callback.message, callback.from_user.id, query, page, edit=True)
+        await callback.answer()
+    
+    except Exception as e:
+        logger.error(f"Error processing search callback: {e}", extra={'user_id': callback.from_user.id})
+        await callback.answer(
+            "Произошла ошибка. Попробуйте позже.",
+            show_alert=True
+        )
+
+
+async def show_search_results(message: Message, user_id: int, query: str, page: int, edit: bool = False):
+    """Показывает страницу результатов поиска с кнопками переключения страниц"""
+    start = time.perf_counter()
+    terms = get_query_terms(query)
+    
+    # Берем на один результат больше, чтобы узнать, есть ли следующая страница
+    results = await db.search_messages(
+        user_id,
+        build_match_query(terms),
+        limit=SEARCH_PAGE_SIZE + 1,
+        offset=page * SEARCH_PAGE_SIZE
+    )
+    has_next = len(results) > SEARCH_PAGE_SIZE
+    results = results[:SEARCH_PAGE_SIZE]
+    
+    if results:
+        lines = [f"🔎 Результаты поиска «{html.escape(query)}», страница {page + 1}:"]
+        for number, result in enumerate(results, page * SEARCH_PAGE_SIZE + 1):
+            author = "👤" if result['role'] == 'user' else "🤖"
+            lines.append(
+                f"\n{number}. {author} <b>{html.escape(result['chat_name'])}</b>, "
+                f"{str(result['created_at'])[:16]}\n"
+                f"{make_snippet(result['content'], terms, SEARCH_SNIPPET_CHARS)}"
+            )
+        text = "\n".join(lines)
+    else:
+        text = f"🔎 По запросу «{html.escape(query)}» ничего не найдено."
+    
+    # Кнопки переключения страниц
+    builder = InlineKeyboardBuilder()
+    if page > 0:
+        builder.button(text="⬅️ Назад", callback_data=f"search_page_{page - 1}")
+    if has_next:
+        builder.button(text="Вперед ➡️", callback_data=f"search_page_{page + 1}")
+    builder.adjust(2)
+    
+    if edit:
+        await message.edit_text(text, reply_markup=builder.as_markup())
+    else:
+        await message.answer(text, reply_markup=builder.as_markup())
+    
+    logger.info(
+        "Search results shown",
+        extra={
+            'user_id': user_id,
+            'results': len(results),
+            'latency_ms': round((time.perf_counter() - start) * 1000),
+            'sampled': True
+        }
+    )
+
+
+async def cmd_export(message: Message, command: CommandObject):
+    """Обработчик команды /export [md|jsonl] - экспорт активного чата"""
+    try:
+        export_format = (command.args or "md").strip().lower()
+        if export_format not in EXPORT_FORMATS:
+            await message.reply(
+                "Укажите формат экспорта: /export md или /export jsonl"
+            )
+            return
+        
+        chat = await db.get_active_chat(message.from_user.id)
+        await send_chat_export(message, message.from_user.id, chat['id'], export_format)
+    
+    except Exception as e:
+        logger.error(f"Error in export command: {e}", extra={'user_id': message.from_user.id})
+        await message.reply(
+            "Произошла ошибка при экспорте чата. "
+            "Попробуйте позже или обратитесь к администратору."
+        )
+
+
+async def send_chat_export(message: Message, user_id: int, chat_id: int, export_format: str):
+    """
+    Выгружает историю чата в сжатый файл в TEMP_DIR и отправляет его документом.
+    Сообщения читаются из базы пачками, поэтому память не зависит от размера чата
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    
+    if user_id in _exports_in_progress:
+        await message.answer("⏳ Экспорт уже выполняется, дождитесь файла.")
+        return
+    
+    # Отмечаем экспорт до первого ожидания, иначе два запроса пройдут проверку одновременно
+    _exports_in_progress.add(user_id)
+    start = time.perf_counter()
+    path = None
+    try:
+        # Чат должен принадлежать пользователю
+        chat = await db.get_user_chat(user_id, chat_id)
+        if not chat:
+            await message.answer("Чат не найден.")
+            return
+        
+        async with aclosing(db.iter_chat_messages(chat_id, EXPORT_BATCH_SIZE)) as batches:
+            path, count = await write_export(batches, chat['name'], export_format, TEMP_DIR, EXPORT_MAX_BYTES)
+        
+        if count == 0:
+            await message.answer("В этом чате пока нет сообщений.")
+            return
+        
+        filename = re.sub(r'[^\w-]+', '_', chat['name']).strip('_') or "chat"
+        await message.answer_document(
+            FSInputFile(path, filename=f"{filename}.{export_format}.gz"),
+            caption=f"📤 Экспорт чата «{html.escape(chat['name'])}»: {count} сообщений"
+        )
+        
+        logger.info(
+            "Chat exported",
+            extra={
+                'user_id': user_id,
+                'chat_id': chat_id,
+                'messages': count,
+                'bytes': os.path.getsize(path),
+                'latency_ms': round((time.perf_counter() - start) * 1000)
+            }
+        )
+    
+    except ExportTooLargeError:
+        await message.answer(
+            "Чат слишком большой для отправки одним файлом."
+        )
+    
+    finally:
+        _exports_in_progress.discard(user_id)
+        if path:
+            os.remove(path)
@@ -18,7 +18,9 @@ def get_commands() -> list[BotCommand]:
         BotCommand(command="help", description="Показать справку"),
         BotCommand(command="think", description="Включить/выключить режим размышления"),
         BotCommand(command="model", description="Выбрать модель для общения"),
-        BotCommand(command="chats", description="Управление чатами")
+        BotCommand(command="chats", description="Управление чатами"),
+        BotCommand(command="search", description="Поиск по истории чатов"),
+        BotCommand(command="export", description="Экспорт активного чата в файл")
     ]
 
 def register_handlers(dp, ai_service):
@@ -69,6 +71,8 @@ async def cmd_start(message: Message):
 /think - включить/выключить режим размышления
 /model - выбрать модель для общения
 /chats - управление чатами
+/search - поиск по истории
+/export - экспорт чата в файл
 
 Просто напиши мне сообщение, и я постараюсь помочь!
         """
@@ -93,6 +97,8 @@ async def cmd_help(message: Message):
 /think - включить/выключить режим размышления
 /model - выбрать модель для общения
 /chats - управление чатами и историей
+/search &lt;запрос&gt; - найти сообщения во всех чатах
+/export [md|jsonl] - выгрузить активный чат в файл
 
 В обычном режиме я просто отвечаю на ваши сообщения.
 В режиме размышления я подробно объясняю ход своих мыслей.
@@ -1,11 +1,41 @@
+import asyncio
 import logging
+import time
+from contextlib import aclosing
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 
 from database import db
-from config import THINKING_MODE_PROMPT, DEFAULT_TEXT_MODEL
+from services.admission import ServiceBusyError
+from services.context_builder import ContextBuilder
+from services.message_coalescer import MessageCoalescer
+from services.metrics import CACHE_REQUESTS, ERRORS, STAGE_DURATION
+from services.model_router import ModelRouter
+from services.output import TELEGRAM_MESSAGE_LIMIT, send_reply
+from services.providers import PollinationsProvider
+from services.response_cache import CachingProvider
+from services.thinking_process import ThinkingProcess
+from config import (
+    THINKING_MODE_PROMPT,
+    DEFAULT_TEXT_MODEL,
+    MAX_HISTORY_LENGTH,
+    STREAMING_ENABLED,
+    STREAM_EDIT_INTERVAL_MS,
+    STREAM_PLACEHOLDER,
+    THINKING_ENGINE_ENABLED,
+    THINKING_ITERATIONS,
+    THINKING_PARALLEL,
+    THINKING_CONCURRENCY,
+    THINKING_SIMILARITY_THRESHOLD,
+    THINKING_MAX_PROMPT_CHARS,
+    THINKING_CONTEXT_MESSAGES,
+    MESSAGE_DEBOUNCE_MS,
+    MODEL_FALLBACK_ENABLED,
+    RESPONSE_CACHE_ENABLED
+)
 
 logger = logging.getLogger(__name__)
 
@@ -15,10 +45,41 @@ router = Router()
 # Сохраняем сервис AI как атрибут роутера
 _ai_service = None
 
-def register_handlers(dp, ai_service):
+# Поставщик ответов модели (по умолчанию поверх сервиса AI)
+_provider = None
+
+# Поставщик ответов на сообщения пользователя: _provider с кэшем ответов
+_reply_provider = None
+
+# Сборщик контекста для модели
+_context_builder = None
+
+# Очереди сообщений пользователей
+_coalescer = None
+
+def register_handlers(dp, ai_service, provider=None):
     """Регистрация обработчиков режима размышления"""
-    global _ai_service
+    global _ai_service, _provider, _reply_provider, _context_builder, _coalescer
     _ai_service = ai_service
+    _provider = provider or PollinationsProvider(ai_service)
+    if MODEL_FALLBACK_ENABLED:
+        # Резервные модели при ошибках и медленных ответах
+        _provider = ModelRouter(_provider)
+    _reply_provider = _provider
+    if RESPONSE_CACHE_ENABLED:
+        # Повторные запросы пользователей отдаются из кэша без обращения к модели.
+        # Черновики размышления и краткое содержание кэш не используют
+        _reply_provider = CachingProvider(_provider)
+        cache = _reply_provider
+        CACHE_REQUESTS.labels("response", "hit").set_function(lambda: cache.hits)
+        CACHE_REQUESTS.labels("response", "near_hit").set_function(lambda: cache.near_hits)
+        CACHE_REQUESTS.labels("response", "miss").set_function(lambda: cache.misses)
+    _context_builder = ContextBuilder(_provider)
+    _coalescer = MessageCoalescer(
+        save_messages,
+        respond_to_messages,
+        debounce=MESSAGE_DEBOUNCE_MS / 1000
+    )
     
     logger.info("Registering thinking mode handlers")
     
@@ -60,10 +121,10 @@ async def toggle_thinking_mode(message: Message):
             response = "🤔 Режим размышления включен. Теперь я буду подробно объяснять ход своих мыслей."
         else:
             response = "✨ Режим размышления выключен. Вернулся к обычному режиму общения."
-            
+        
         await message.reply(response)
         logger.info(f"Thinking mode {'enabled' if new_mode else 'disabled'} for user {user_id}")
-        
+    
     except Exception as e:
         logger.error(f"Error toggling thinking mode: {e}")
         await message.reply("Произошла ошибка при изменении режима. Попробуйте позже.")
@@ -84,7 +145,7 @@ async def process_thinking_callback(callback: CallbackQuery):
                 f"{'🤔 Режим размышления включен' if new_mode else '✨ Режим размышления выключен'}"
             )
             await callback.answer()
-            
+    
     except Exception as e:
         logger.error(f"Error processing thinking mode callback: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.", show_alert=True)
@@ -98,54 +159,198 @@ async def handle_message(message: Message, state: FSMContext):
         if current_state is not None:
             # Если есть активное состояние, пропускаем сообщение
             return
-            
-        # Получаем настройки пользователя
-        user_id = message.from_user.id
-        thinking_mode = await db.get_thinking_mode(user_id)
-        selected_model = await db.get_user_model(user_id) or DEFAULT_TEXT_MODEL
-        
-        # Получаем активный чат
-        chat = await db.get_active_chat(user_id)
         
-        # Сохраняем сообщение пользователя
-        await db.add_chat_message(chat['id'], "user", message.text)
-        
-        # Получаем историю чата
-        history = await db.get_chat_history(chat['id'])
-        
-        # Формируем сообщения для AI
-        messages = []
-        
-        # Добавляем системный промпт для режима размышления
-        if thinking_mode:
-            messages.append({
-                "role": "system",
-                "content": THINKING_MODE_PROMPT
-            })
-        
-        # Добавляем историю чата
-        for msg in reversed(history):  # Разворачиваем историю в хронологическом порядке
-            messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+        # Ставим сообщение в очередь пользователя: быстрые подряд сообщения
+        # объединяются, устаревший запрос к модели отменяется
+        _coalescer.submit(message.from_user.id, message)
+    
+    except Exception as e:
+        logger.error(f"Error processing message: {e}", extra={'user_id': message.from_user.id})
+        await reply_error(message)
+
+
+async def save_messages(batch: list) -> dict:
+    """
+    Сохраняет сообщения пользователя одной записью и загружает контекст.
+    Возвращает None при ошибке.
+    """
+    message = batch[-1]
+    try:
+        # Сохраняем сообщение пользователя и получаем настройки,
+        # активный чат и историю за один проход по базе
+        text = "\n\n".join(msg.text for msg in batch)
+        with STAGE_DURATION.labels("db_context").time():
+            return await db.load_conversation_context(
+                message.from_user.id,
+                text,
+                limit=MAX_HISTORY_LENGTH
+            )
+    
+    except Exception as e:
+        ERRORS.labels("db_context").inc()
+        logger.error(f"Error saving message: {e}", extra={'user_id': message.from_user.id})
+        await reply_error(message)
+        return None
+
+
+async def respond_to_messages(batch: list, context: dict):
+    """Получает ответ AI на сохраненные сообщения и отправляет его пользователю"""
+    if context is None:
+        return
+    
+    # Отвечаем на последнее сообщение пачки
+    message = batch[-1]
+    start = time.perf_counter()
+    try:
+        user_id = message.from_user.id
+        thinking_mode = context['thinking_mode']
+        selected_model = context['model'] or DEFAULT_TEXT_MODEL
+        chat = context['chat']
+        history = context['history']
         
-        # Получаем ответ от AI
-        response = await _ai_service.generate_response(
-            messages,
-            model=selected_model
-        )
+        reply = None
+        if thinking_mode and THINKING_ENGINE_ENABLED:
+            # Размышление строит промпты из истории само, контекст для модели не собираем
+            with STAGE_DURATION.labels("llm").time():
+                response = await run_thinking_process(history, selected_model)
+        else:
+            # Формируем сообщения для AI в пределах бюджета токенов модели
+            with STAGE_DURATION.labels("history_build").time():
+                messages = await _context_builder.build_messages(
+                    chat['id'],
+                    history,
+                    selected_model,
+                    system_prompt=THINKING_MODE_PROMPT if thinking_mode else None
+                )
+            
+            with STAGE_DURATION.labels("llm").time():
+                if STREAMING_ENABLED:
+                    # Показываем ответ по мере генерации
+                    response, reply = await stream_reply(message, messages, selected_model)
+                else:
+                    # Получаем ответ от AI
+                    response = await _reply_provider.generate(messages, selected_model)
         
         # Сохраняем ответ в историю
-        await db.add_chat_message(chat['id'], "assistant", response)
+        with STAGE_DURATION.labels("db_write").time():
+            await db.add_chat_message(chat['id'], "assistant", response)
         
         # Отправляем ответ пользователю
-        await message.reply(response)
-        logger.info(f"Response sent to user {user_id}")
+        # (при потоковой выдаче заменяем промежуточный текст отформатированным ответом)
+        with STAGE_DURATION.labels("telegram_send").time():
+            await send_reply(message, response, placeholder=reply)
         
-    except Exception as e:
-        logger.error(f"Error processing message: {e}")
+        latency = time.perf_counter() - start
+        STAGE_DURATION.labels("respond").observe(latency)
+        logger.info(
+            "Response sent",
+            extra={
+                'user_id': user_id,
+                'chat_id': chat['id'],
+                'model': selected_model,
+                'latency_ms': round(latency * 1000),
+                'sampled': True
+            }
+        )
+    
+    except ServiceBusyError as e:
+        # Сервис перегружен - сразу сообщаем, а не ждем в очереди
+        ERRORS.labels("llm_busy").inc()
+        logger.warning(f"AI service busy, request rejected: {e}", extra={'user_id': message.from_user.id})
         await message.reply(
-            "Извините, произошла ошибка при обработке вашего сообщения. "
-            "Попробуйте позже или обратитесь к администратору."
+            "⏳ Сейчас слишком много запросов. "
+            "Пожалуйста, повторите сообщение через минуту."
         )
+    
+    except Exception as e:
+        ERRORS.labels("respond").inc()
+        logger.error(
+            f"Error processing message: {e}",
+            extra={'user_id': message.from_user.id, 'latency_ms': round((time.perf_counter() - start) * 1000)}
+        )
+        await reply_error(message)
+
+
+async def reply_error(message: Message):
+    """Сообщает пользователю об ошибке обработки сообщения"""
+    await message.reply(
+        "Извините, произошла ошибка при обработке вашего сообщения. "
+        "Попробуйте позже или обратитесь к администратору."
+    )
+
+
+async def stream_reply(message: Message, messages: list, model: str) -> tuple:
+    """
+    Показывает ответ AI по мере генерации, редактируя одно сообщение.
+    Редактирования ограничены одним в STREAM_EDIT_INTERVAL_MS
+    (частоту сообщений в чат дополнительно ограничивает SendScheduler).
+    Возвращает полный текст ответа и сообщение с промежуточным текстом.
+    """
+    reply = await message.reply(STREAM_PLACEHOLDER)
+    interval = STREAM_EDIT_INTERVAL_MS / 1000
+    last_edit_time = time.monotonic()
+    chunks = []
+    shown_text = STREAM_PLACEHOLDER
+    
+    try:
+        # aclosing гарантирует освобождение слота провайдера при отмене
+        async with aclosing(_reply_provider.stream(messages, model)) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                
+                now = time.monotonic()
+                if now - last_edit_time < interval:
+                    continue
+                
+                # Промежуточный текст может содержать незакрытые теги, поэтому без разметки
+                text = "".join(chunks)[:TELEGRAM_MESSAGE_LIMIT]
+                if not text.strip() or text == shown_text:
+                    continue
+                
+                last_edit_time = now
+                try:
+                    await reply.edit_text(text, parse_mode=None)
+                    shown_text = text
+                except TelegramBadRequest as e:
+                    logger.warning(f"Error editing streamed message: {e}")
+    
+    except (asyncio.CancelledError, Exception):
+        # Запрос отменен более новым сообщением или завершился ошибкой -
+        # убираем незаконченный ответ
+        try:
+            await reply.delete()
+        except TelegramBadRequest:
+            pass
+        raise
+    
+    response = "".join(chunks)
+    if not response.strip():
+        raise ValueError("Empty response from AI service")
+    
+    return response, reply
+
+
+async def run_thinking_process(history: list, model: str) -> str:
+    """
+    Получает ответ через ThinkingProcess.
+    Последний запрос пользователя идет первым, чтобы не потеряться при обрезке промпта.
+    """
+    question = history[0]['content']
+    context = [
+        f"{msg['role']}: {msg['content']}"
+        for msg in reversed(history[1:THINKING_CONTEXT_MESSAGES + 1])
+    ]
+    query = question
+    if context:
+        query += "\n\nКонтекст диалога:\n" + "\n".join(context)
+    
+    process = ThinkingProcess(
+        _provider,
+        model,
+        iterations=THINKING_ITERATIONS,
+        parallel=THINKING_PARALLEL,
+        concurrency=THINKING_CONCURRENCY,
+        similarity_threshold=THINKING_SIMILARITY_THRESHOLD,
+        max_prompt_chars=THINKING_MAX_PROMPT_CHARS
+    )
+    return await process.process_query(query)
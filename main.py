@@ -1,68 +1,360 @@
 import asyncio
 import logging
 import os
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
-from config import BOT_TOKEN, TEMP_DIR, LOG_LEVEL
+from config import (
+    BOT_TOKEN,
+    TEMP_DIR,
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_SAMPLE_RATE,
+    LOG_SAMPLED_LOGGERS,
+    LOG_QUEUE_SIZE,
+    BOT_MODE,
+    MAX_CONCURRENT_UPDATES,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+    FSM_STORAGE,
+    REDIS_URL,
+    WORKERS,
+    POLLING_TIMEOUT,
+    SEND_GLOBAL_RATE,
+    SEND_CHAT_RATE,
+    SEND_GROUP_RATE,
+    SEND_CHAT_BURST,
+    SEND_MAX_RETRIES,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT
+)
 from database import db
+from database.fsm_storage import SQLiteStorage
 from handlers import commands, thinking_mode, chat_commands
+from handlers.middlewares import ConcurrencyLimitMiddleware
+from services import metrics
+from services.logging_setup import setup_logging
 from services.pollinations_api import PollinationsService
+from services.send_scheduler import SendScheduler
+from services.workers import WorkerPool, consume_updates
 
-# Настройка логирования
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+# Настройка логирования (запись в поток вывода выполняется в фоновом потоке)
+setup_logging(
+    level=LOG_LEVEL,
+    log_format=LOG_FORMAT,
+    sample_rate=LOG_SAMPLE_RATE,
+    sampled_loggers=LOG_SAMPLED_LOGGERS,
+    queue_size=LOG_QUEUE_SIZE
 )
 logger = logging.getLogger(__name__)
 
 
+WORKER_POOL = web.AppKey("worker_pool", WorkerPool)
+
+
+def create_storage() -> BaseStorage:
+    """Создает хранилище состояний FSM согласно FSM_STORAGE"""
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage()
+    
+    if FSM_STORAGE == "redis":
+        # Необязательная зависимость: pip install redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(
+            REDIS_URL,
+            key_builder=DefaultKeyBuilder(with_destiny=True)
+        )
+    
+    return MemoryStorage()
+
+
+def create_bot() -> Bot:
+    """Создает бота с настройками по умолчанию"""
+    default = DefaultBotProperties(parse_mode=ParseMode.HTML)
+    bot = Bot(token=BOT_TOKEN, default=default)
+    
+    # Все исходящие запросы проходят через планировщик отправки.
+    # Общий лимит бота делится между процессами-обработчиками
+    scheduler = SendScheduler(
+        global_rate=SEND_GLOBAL_RATE / max(WORKERS, 1),
+        chat_rate=SEND_CHAT_RATE,
+        group_rate=SEND_GROUP_RATE,
+        chat_burst=SEND_CHAT_BURST,
+        max_retries=SEND_MAX_RETRIES
+    )
+    bot.session.middleware(scheduler)
+    
+    metrics.SEND_QUEUE_DEPTH.set_function(lambda: scheduler.stats()['queued'])
+    metrics.TELEGRAM_RETRY_AFTER.set_function(lambda: scheduler.retry_after)
+    return bot
+
+
+def create_dispatcher(ai_service: PollinationsService) -> Dispatcher:
+    """Создает диспетчер и регистрирует обработчики"""
+    dp = Dispatcher(storage=create_storage())
+    logger.info(f"Dispatcher initialized with {FSM_STORAGE} FSM storage")
+    
+    # Ограничиваем количество одновременно обрабатываемых обновлений
+    limiter = ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES)
+    dp.update.outer_middleware(limiter)
+    
+    # Метрики, которые читаются из счетчиков компонентов в момент запроса /metrics
+    metrics.UPDATES_IN_FLIGHT.set_function(lambda: limiter.in_flight)
+    metrics.UPDATES_WAITING.set_function(lambda: limiter.waiting)
+    metrics.LLM_IN_FLIGHT.set_function(lambda: ai_service.admission.in_flight)
+    metrics.LLM_QUEUE_DEPTH.set_function(lambda: ai_service.admission.waiting)
+    metrics.LLM_REJECTED.set_function(lambda: ai_service.admission.rejected)
+    metrics.LLM_RETRIES.set_function(lambda: ai_service.retries)
+    metrics.CACHE_REQUESTS.labels("settings", "hit").set_function(lambda: db.get_cache_stats()['hits'])
+    metrics.CACHE_REQUESTS.labels("settings", "miss").set_function(lambda: db.get_cache_stats()['misses'])
+    metrics.CACHE_REQUESTS.labels("history", "hit").set_function(lambda: db.get_history_buffer_stats()['hits'])
+    metrics.CACHE_REQUESTS.labels("history", "miss").set_function(lambda: db.get_history_buffer_stats()['misses'])
+    
+    # Регистрируем обработчики
+    # Регистрируем базовые команды
+    commands.register_handlers(dp, ai_service)
+    logger.info("Basic command handlers registered")
+    
+    # Регистрируем обработчики чатов (до обработчиков режима размышления!)
+    chat_commands.register_handlers(dp)
+    logger.info("Chat command handlers registered")
+    
+    # Регистрируем обработчики режима размышления
+    thinking_mode.register_handlers(dp, ai_service)
+    logger.info("Thinking mode handlers registered")
+    
+    return dp
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Метрики процесса в текстовом формате Prometheus"""
+    return web.Response(
+        text=metrics.REGISTRY.render(),
+        content_type="text/plain",
+        charset="utf-8",
+        headers={"X-Content-Type-Options": "nosniff"}
+    )
+
+
+async def start_metrics_server(port: int) -> web.AppRunner:
+    """Запускает локальный HTTP-сервер с /metrics"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, METRICS_HOST, port)
+    await site.start()
+    logger.info(f"Metrics server started on {METRICS_HOST}:{port}/metrics")
+    return runner
+
+
+async def health_handler(request: web.Request) -> web.Response:
+    """Проверка, что процесс жив"""
+    return web.json_response({'status': 'ok'})
+
+
+async def ready_handler(request: web.Request) -> web.Response:
+    """Проверка готовности принимать обновления"""
+    pool = request.app.get(WORKER_POOL)
+    if pool:
+        # Базой пользуются процессы-обработчики, проверяем их
+        ready = pool.is_healthy()
+    else:
+        ready = await db.check_db()
+    
+    if ready:
+        return web.json_response({'status': 'ready'})
+    return web.json_response({'status': 'not ready'}, status=503)
+
+
+async def sharded_webhook_handler(request: web.Request) -> web.Response:
+    """Принимает обновление от Telegram и передает его процессу-обработчику"""
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    
+    request.app[WORKER_POOL].dispatch(await request.json())
+    return web.Response()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, pool: WorkerPool = None):
+    """Запускает веб-сервер, принимающий обновления через вебхук"""
+    app = web.Application()
+    app.router.add_get('/healthz', health_handler)
+    app.router.add_get('/readyz', ready_handler)
+    
+    if pool:
+        # Обновления обрабатываются в процессах-обработчиках
+        app[WORKER_POOL] = pool
+        app.router.add_post(WEBHOOK_PATH, sharded_webhook_handler)
+    else:
+        # Обработчик обновлений от Telegram
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET or None
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logger.info(f"Webhook server started on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        # Без публичного адреса вебхук не регистрируется (локальная проверка)
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info("Webhook set")
+        
+        # Работаем до остановки процесса
+        await asyncio.Event().wait()
+    
+    finally:
+        await runner.cleanup()
+
+
+async def run_sharded_polling(bot: Bot, dp: Dispatcher, pool: WorkerPool):
+    """Получает обновления через long polling и распределяет их по процессам"""
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    logger.info("Start sharded polling")
+    
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=allowed_updates,
+                request_timeout=POLLING_TIMEOUT + 10
+            )
+        except Exception as e:
+            logger.error(f"Error getting updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        
+        for update in updates:
+            offset = update.update_id + 1
+            pool.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+async def worker_main(worker_id: int, worker_queue):
+    """Процесс-обработчик: обрабатывает обновления своей части пользователей"""
+    bot = None
+    dp = None
+    metrics_runner = None
+    try:
+        # Схема уже подготовлена основным процессом, фоновое обслуживание базы
+        # выполняет только первый обработчик
+        await db.init_db(migrate=False, maintenance=worker_id == 0)
+        ai_service = PollinationsService()
+        bot = create_bot()
+        dp = create_dispatcher(ai_service)
+        if METRICS_ENABLED:
+            metrics_runner = await start_metrics_server(METRICS_PORT + 1 + worker_id)
+        logger.info(f"Worker {worker_id} started")
+        
+        await consume_updates(
+            worker_queue,
+            lambda update: dp.feed_raw_update(bot, update)
+        )
+        
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if dp:
+            await dp.storage.close()
+        if bot:
+            await bot.session.close()
+        await db.close_db()
+        logger.info(f"Worker {worker_id} stopped")
+
+
+def run_worker(worker_id: int, worker_queue):
+    """Точка входа процесса-обработчика"""
+    try:
+        asyncio.run(worker_main(worker_id, worker_queue))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
 async def main():
     """Основная функция запуска бота"""
+    bot = None
+    dp = None
+    pool = None
+    metrics_runner = None
     try:
-        # Инициализируем базу данных
-        await db.init_db()
-        logger.info("Database initialized")
+        # При нескольких процессах базой пользуются только обработчики
+        if WORKERS <= 1:
+            # Инициализируем базу данных
+            await db.init_db()
+            logger.info("Database initialized")
+        else:
+            # Миграции выполняются один раз до запуска обработчиков
+            await db.migrate_db()
+            logger.info("Database schema prepared")
         
         # Создаем сервис AI
         ai_service = PollinationsService()
         logger.info("AI service created")
         
-        # Создаем бота и диспетчер с настройками по умолчанию
-        default = DefaultBotProperties(parse_mode=ParseMode.HTML)
-        bot = Bot(token=BOT_TOKEN, default=default)
-        dp = Dispatcher(storage=MemoryStorage())
+        # Создаем бота и диспетчер
+        bot = create_bot()
+        dp = create_dispatcher(ai_service)
         logger.info("Bot and dispatcher initialized")
         
-        # Регистрируем обработчики
-        # Регистрируем базовые команды
-        commands.register_handlers(dp, ai_service)
-        logger.info("Basic command handlers registered")
-        
-        # Регистрируем обработчики чатов (до обработчиков режима размышления!)
-        chat_commands.register_handlers(dp)
-        logger.info("Chat command handlers registered")
-        
-        # Регистрируем обработчики режима размышления
-        thinking_mode.register_handlers(dp, ai_service)
-        logger.info("Thinking mode handlers registered")
-        
         # Устанавливаем команды бота
         await bot.set_my_commands(commands.get_commands())
         logger.info("Bot commands set")
         
-        # Запускаем поллинг
-        logger.info("Start polling")
-        await dp.start_polling(bot)
+        if METRICS_ENABLED:
+            metrics_runner = await start_metrics_server(METRICS_PORT)
+        
+        if WORKERS > 1:
+            # Обновления обрабатываются в отдельных процессах
+            pool = WorkerPool(WORKERS, run_worker)
+            pool.start()
+        
+        if BOT_MODE == "webhook":
+            # Получаем обновления через вебхук
+            await run_webhook(bot, dp, pool)
+        elif pool:
+            # Получаем обновления сами и распределяем по процессам
+            await run_sharded_polling(bot, dp, pool)
+        else:
+            # Запускаем поллинг
+            logger.info("Start polling")
+            await dp.start_polling(bot)
         
     except Exception as e:
         logger.error(f"Critical error: {e}")
         raise
 
     finally:
-        await bot.session.close()
+        if pool:
+            pool.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if dp:
+            await dp.storage.close()
+        if bot:
+            await bot.session.close()
+        # Закрываем базу данных (с записью накопленной очереди)
         await db.close_db()
 
 
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceBusyError(Exception):
+    """Сервис перегружен: запрос отклонен, чтобы не копить очередь"""
+
+
+class AdmissionController:
+    """
+    Ограничивает количество одновременных запросов к модели:
+    общий лимит и отдельный лимит для каждой модели.
+    Если очередь ожидающих слишком длинная или слот не освободился
+    за queue_timeout, запрос сразу отклоняется с ServiceBusyError.
+    """
+    
+    def __init__(
+        self,
+        max_concurrency: int,
+        default_model_limit: int,
+        model_limits: dict = None,
+        max_queue: int = 100,
+        queue_timeout: float = 10.0
+    ):
+        self.default_model_limit = default_model_limit
+        self.model_limits = model_limits or {}
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._models = {}
+        
+        # Метрики
+        self.waiting = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.in_flight_by_model = {}
+    
+    def is_busy(self) -> bool:
+        """Проверяет, будет ли новый запрос отклонен из-за длины очереди"""
+        return self.waiting >= self.max_queue
+    
+    def _model_semaphore(self, model: str) -> asyncio.Semaphore:
+        """Возвращает семафор модели, создавая его при первом обращении"""
+        semaphore = self._models.get(model)
+        if semaphore is None:
+            limit = self.model_limits.get(model, self.default_model_limit)
+            semaphore = self._models[model] = asyncio.Semaphore(limit)
+        return semaphore
+    
+    async def _acquire(self, model: str, acquired: list):
+        """Занимает слот модели, затем общий слот"""
+        for semaphore in (self._model_semaphore(model), self._global):
+            await semaphore.acquire()
+            acquired.append(semaphore)
+    
+    @asynccontextmanager
+    async def slot(self, model: str):
+        """Занимает слот для запроса к модели на время блока"""
+        if self.is_busy():
+            self.rejected += 1
+            raise ServiceBusyError(f"Too many queued requests ({self.waiting})")
+        
+        acquired = []
+        try:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._acquire(model, acquired), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise ServiceBusyError(f"No free slot for model {model}")
+            finally:
+                self.waiting -= 1
+            
+            self.in_flight += 1
+            self.in_flight_by_model[model] = self.in_flight_by_model.get(model, 0) + 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+                self.in_flight_by_model[model] -= 1
+        
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+    
+    def stats(self) -> dict:
+        """Возвращает метрики очереди"""
+        return {
+            'queue_depth': self.waiting,
+            'in_flight': self.in_flight,
+            'in_flight_by_model': dict(self.in_flight_by_model),
+            'rejected': self.rejected
+        }
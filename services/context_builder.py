@@ -0,0 +1,270 @@
+import asyncio
+import logging
+
+from database import db
+from database.cache import TTLCache, MISSING
+from config import (
+    MAX_HISTORY_LENGTH,
+    HISTORY_TOKEN_BUDGET,
+    MODEL_TOKEN_BUDGETS,
+    SUMMARY_ENABLED,
+    SUMMARY_MODEL,
+    SUMMARY_MIN_NEW_MESSAGES,
+    SUMMARY_MAX_SOURCE_MESSAGES,
+    SUMMARY_MAX_CHARS,
+    RETRIEVAL_ENABLED,
+    RETRIEVAL_TOP_K,
+    RETRIEVAL_BUDGET_SHARE,
+    RETRIEVAL_MAX_CHARS,
+    RETRIEVAL_MIN_TERM_LENGTH
+)
+from services.search import get_query_terms, build_match_query
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Составь краткое содержание диалога пользователя с ассистентом.
+Сохрани важные факты, договоренности, имена и открытые вопросы, без лишних деталей.
+Ответь только текстом краткого содержания, не длиннее {max_chars} символов.
+
+Предыдущее краткое содержание:
+{summary}
+
+Новые сообщения:
+{transcript}"""
+
+SUMMARY_MESSAGE_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+RELEVANT_MESSAGE_PREFIX = "Сообщения из более ранней части диалога, которые могут относиться к вопросу:\n"
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Сколько чатов и как долго (в секундах) помнить, до какого сообщения
+# проверялись не свернутые сообщения старше загруженной истории
+SUMMARY_CHECKS_MAX_SIZE = 10000
+SUMMARY_CHECKS_TTL = 3600
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительно оценивает количество токенов в тексте"""
+    # В среднем около 3 символов на токен для смеси русского и английского текста
+    return len(text) // 3 + MESSAGE_TOKEN_OVERHEAD
+
+
+def select_history_window(history: list, budget: int) -> list:
+    """
+    Выбирает самые новые сообщения, помещающиеся в бюджет токенов.
+    history - сообщения от новых к старым, результат - в хронологическом порядке.
+    Самое новое сообщение попадает в окно всегда.
+    """
+    window = []
+    used = 0
+    for msg in history:
+        tokens = estimate_tokens(msg['content'])
+        if window and used + tokens > budget:
+            break
+        window.append(msg)
+        used += tokens
+    return list(reversed(window))
+
+
+def format_relevant_messages(relevant: list) -> str:
+    """Текст системного сообщения с найденными старыми сообщениями"""
+    return RELEVANT_MESSAGE_PREFIX + "\n".join(
+        f"{msg['role']}: {msg['content'][:RETRIEVAL_MAX_CHARS]}"
+        for msg in relevant
+    )
+
+
+class ContextBuilder:
+    """
+    Собирает сообщения для модели в пределах бюджета токенов.
+    Выпавшие из окна сообщения сворачиваются в краткое содержание чата,
+    которое пересчитывается в фоне только при накоплении новых выпавших сообщений.
+    Из более старой части чата добавляются сообщения, относящиеся к новому сообщению.
+    """
+    
+    def __init__(self, provider, history_limit: int = MAX_HISTORY_LENGTH):
+        """
+        :param provider: Поставщик ответов модели (для краткого содержания)
+        :param history_limit: Сколько последних сообщений загружается в history
+        """
+        self.provider = provider
+        self.history_limit = history_limit
+        self._refreshing = set()
+        self._tasks = set()
+        # ID самого нового сообщения чата при последней проверке старых сообщений
+        self._older_checked = TTLCache(max_size=SUMMARY_CHECKS_MAX_SIZE, ttl=SUMMARY_CHECKS_TTL)
+    
+    def get_token_budget(self, model: str) -> int:
+        """Возвращает бюджет токенов на историю для модели"""
+        return MODEL_TOKEN_BUDGETS.get(model, HISTORY_TOKEN_BUDGET)
+    
+    async def build_messages(self, chat_id: int, history: list, model: str, system_prompt: str = None) -> list:
+        """
+        Формирует список сообщений для модели
+        
+        :param chat_id: ID чата
+        :param history: История чата от новых сообщений к старым
+        :param model: Название модели
+        :param system_prompt: Дополнительный системный промпт
+        :return: Список сообщений в формате [{role: str, content: str}]
+        """
+        budget = self.get_token_budget(model)
+        messages = []
+        
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+            budget -= estimate_tokens(system_prompt)
+        
+        summary = await db.get_chat_summary(chat_id) if SUMMARY_ENABLED else None
+        summarized_id = 0
+        if summary:
+            summarized_id = summary['last_message_id']
+            summary_text = SUMMARY_MESSAGE_PREFIX + summary['summary']
+            messages.append({"role": "system", "content": summary_text})
+            budget -= estimate_tokens(summary_text)
+        
+        # Сообщения, уже свернутые в краткое содержание, повторно не отправляем
+        recent = [msg for msg in history if msg['id'] > summarized_id]
+        
+        relevant = []
+        if RETRIEVAL_ENABLED and recent:
+            # Часть бюджета отводим под старые сообщения, относящиеся к новому сообщению,
+            # и ищем их среди сообщений старше окна
+            reserve = int(budget * RETRIEVAL_BUDGET_SHARE)
+            window = select_history_window(recent, budget - reserve)
+            relevant = await self._find_relevant(chat_id, recent[0]['content'], window[0]['id'], reserve)
+        
+        if relevant:
+            # Неиспользованный резерв отдаем окну последних сообщений
+            window = select_history_window(recent, budget - estimate_tokens(format_relevant_messages(relevant)))
+            relevant = [msg for msg in relevant if msg['id'] < window[0]['id']]
+        else:
+            window = select_history_window(recent, budget)
+        
+        if relevant:
+            messages.append({"role": "system", "content": format_relevant_messages(relevant)})
+        
+        for msg in window:
+            messages.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+        
+        if SUMMARY_ENABLED and window:
+            dropped = len(recent) - len(window)
+            if dropped >= SUMMARY_MIN_NEW_MESSAGES or self._older_messages_due(chat_id, history, summarized_id):
+                self._schedule_refresh(chat_id, summary, window[0]['id'])
+        
+        return messages
+    
+    async def _find_relevant(self, chat_id: int, text: str, before_id: int, budget: int) -> list:
+        """
+        Находит сообщения чата старше before_id, относящиеся к тексту,
+        и отбирает самые релевантные в пределах бюджета. Результат - в хронологическом порядке
+        """
+        terms = get_query_terms(text, RETRIEVAL_MIN_TERM_LENGTH)
+        if not terms or budget <= 0:
+            return []
+        
+        try:
+            found = await db.find_relevant_messages(
+                chat_id,
+                build_match_query(terms, any_term=True),
+                before_id,
+                RETRIEVAL_TOP_K
+            )
+        except Exception as e:
+            # Без найденных сообщений ответ все равно можно получить
+            logger.warning(f"Error retrieving relevant messages for chat {chat_id}: {e}")
+            return []
+        
+        relevant = []
+        used = estimate_tokens(RELEVANT_MESSAGE_PREFIX)
+        for msg in found:
+            tokens = estimate_tokens(msg['content'][:RETRIEVAL_MAX_CHARS])
+            if used + tokens > budget:
+                continue
+            relevant.append(msg)
+            used += tokens
+        return sorted(relevant, key=lambda msg: msg['id'])
+    
+    def _older_messages_due(self, chat_id: int, history: list, summarized_id: int) -> bool:
+        """
+        Проверяет, пора ли сворачивать сообщения старше загруженной истории.
+        Если и самое старое загруженное сообщение не свернуто, до него тоже могут быть
+        не свернутые сообщения. Сколько их, без запроса к базе неизвестно, поэтому
+        пересчет запускается не чаще, чем раз в SUMMARY_MIN_NEW_MESSAGES новых сообщений
+        """
+        if len(history) < self.history_limit or history[-1]['id'] <= summarized_id:
+            return False
+        
+        checked_id = self._older_checked.get(chat_id)
+        if checked_id is not MISSING:
+            new_messages = sum(1 for msg in history if msg['id'] > checked_id)
+            if new_messages < SUMMARY_MIN_NEW_MESSAGES:
+                return False
+        
+        self._older_checked.set(chat_id, history[0]['id'])
+        return True
+    
+    def _schedule_refresh(self, chat_id: int, summary: dict, window_start_id: int):
+        """Запускает фоновый пересчет краткого содержания чата"""
+        if chat_id in self._refreshing:
+            return
+        
+        self._refreshing.add(chat_id)
+        task = asyncio.create_task(self._refresh_summary(chat_id, summary, window_start_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _refresh_summary(self, chat_id: int, summary: dict, window_start_id: int):
+        """
+        Дополняет краткое содержание сообщениями, выпавшими из окна.
+        Сообщения берутся от старых к новым страницами по SUMMARY_MAX_SOURCE_MESSAGES,
+        каждая страница дополняет краткое содержание, полученное по предыдущей
+        """
+        try:
+            while True:
+                after_id = summary['last_message_id'] if summary else 0
+                aged_out = await db.get_chat_messages_range(
+                    chat_id,
+                    after_id,
+                    window_start_id,
+                    SUMMARY_MAX_SOURCE_MESSAGES
+                )
+                if len(aged_out) < SUMMARY_MIN_NEW_MESSAGES:
+                    # Слишком мало новых сообщений - ждем, пока выпадут еще
+                    return
+                
+                transcript = "\n".join(
+                    f"{msg['role']}: {msg['content'][:SUMMARY_MAX_CHARS]}"
+                    for msg in aged_out
+                )
+                prompt = SUMMARY_PROMPT.format(
+                    max_chars=SUMMARY_MAX_CHARS,
+                    summary=summary['summary'] if summary else "(нет)",
+                    transcript=transcript
+                )
+                
+                new_summary = await self.provider.generate(
+                    [{"role": "user", "content": prompt}],
+                    SUMMARY_MODEL
+                )
+                
+                summary = {
+                    'summary': new_summary[:SUMMARY_MAX_CHARS],
+                    'last_message_id': aged_out[-1]['id']
+                }
+                await db.save_chat_summary(chat_id, summary['summary'], summary['last_message_id'])
+                logger.info(f"Chat summary updated for chat {chat_id}")
+                
+                if len(aged_out) < SUMMARY_MAX_SOURCE_MESSAGES:
+                    return
+            
+        except Exception as e:
+            logger.error(f"Error updating chat summary for chat {chat_id}: {e}")
+        
+        finally:
+            self._refreshing.discard(chat_id)
@@ -0,0 +1,84 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+from contextlib import aclosing
+
+# Форматы экспорта: Markdown для чтения, JSONL для обработки программами
+EXPORT_FORMATS = ("md", "jsonl")
+
+GZIP_LEVEL = 6
+
+ROLE_TITLES = {
+    "user": "👤 Пользователь",
+    "assistant": "🤖 Ассистент",
+    "system": "⚙️ Система",
+}
+
+
+class ExportTooLargeError(Exception):
+    """Файл экспорта превысил допустимый размер"""
+
+
+def render_markdown(batch: list) -> str:
+    """Сообщения пачки в Markdown"""
+    return "".join(
+        f"### {ROLE_TITLES.get(msg['role'], msg['role'])} · {msg['created_at']}\n\n{msg['content']}\n\n"
+        for msg in batch
+    )
+
+
+def render_jsonl(batch: list) -> str:
+    """Сообщения пачки в JSONL: одно сообщение - один объект JSON в строке"""
+    return "".join(
+        json.dumps(
+            {
+                'id': msg['id'],
+                'role': msg['role'],
+                'content': msg['content'],
+                'created_at': msg['created_at']
+            },
+            ensure_ascii=False,
+            default=str
+        ) + "\n"
+        for msg in batch
+    )
+
+
+async def render_chat(batches, chat_name: str, export_format: str):
+    """Преобразует пачки сообщений в части файла экспорта: (количество сообщений, текст)"""
+    if export_format == "md":
+        yield 0, f"# {chat_name}\n\n"
+    render = render_markdown if export_format == "md" else render_jsonl
+    async for batch in batches:
+        yield len(batch), render(batch)
+
+
+async def write_export(batches, chat_name: str, export_format: str, directory: str, max_bytes: int) -> tuple:
+    """
+    Записывает чат в сжатый gzip файл в directory по мере чтения пачек сообщений,
+    в памяти держится только текущая пачка.
+    Возвращает (путь к файлу, количество сообщений). При ошибке файл удаляется
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=f".{export_format}.gz", dir=directory)
+    count = 0
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(filename=f"chat.{export_format}", mode='wb',
+                               compresslevel=GZIP_LEVEL, fileobj=raw) as archive:
+                async with aclosing(render_chat(batches, chat_name, export_format)) as parts:
+                    async for messages, text in parts:
+                        # Сжатие и запись на диск не блокируют цикл событий
+                        await asyncio.to_thread(archive.write, text.encode('utf-8'))
+                        count += messages
+                        if raw.tell() > max_bytes:
+                            raise ExportTooLargeError(f"Export exceeds {max_bytes} bytes")
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, count
@@ -0,0 +1,156 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from .metrics import LOG_RECORDS_DROPPED
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Атрибуты, которые есть у любой записи; все остальные пришли через extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+# Служебные поля extra, которые не попадают в вывод
+_SERVICE_FIELDS = {'sampled'}
+
+
+def get_fields(record: logging.LogRecord) -> dict:
+    """Дополнительные поля записи (user_id, chat_id, model, latency_ms и т.п.)"""
+    return {
+        key: value for key, value in vars(record).items()
+        if key not in _RECORD_ATTRIBUTES and key not in _SERVICE_FIELDS
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - один объект JSON в строке"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process
+        }
+        entry.update(get_fields(record))
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат, дополнительные поля добавляются в конец как key=value"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = get_fields(record)
+        if not fields:
+            return text
+        
+        suffix = " ".join(f"{key}={value}" for key, value in fields.items())
+        head, newline, tail = text.partition("\n")
+        return f"{head} [{suffix}]{newline}{tail}"
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю rate частых info-сообщений.
+    Частыми считаются записи с extra={'sampled': True} и записи логгеров из loggers.
+    Предупреждения и ошибки пропускаются всегда.
+    """
+    
+    def __init__(self, rate: float, loggers: tuple = ()):
+        super().__init__()
+        self.rate = rate
+        self.loggers = tuple(loggers)
+    
+    def _is_sampled(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'sampled', False):
+            return True
+        return any(
+            record.name == name or record.name.startswith(name + ".")
+            for name in self.loggers
+        )
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or record.levelno >= logging.WARNING or not self._is_sampled(record):
+            return True
+        if random.random() >= self.rate:
+            return False
+        
+        # Для восстановления реального количества событий при анализе
+        record.sample_rate = self.rate
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Кладет записи в очередь, которую разбирает фоновый поток.
+    При переполнении очереди запись отбрасывается, а не блокирует цикл событий.
+    """
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение подставляем сразу (аргументы могут измениться), а оформляет
+        # запись уже фоновый поток. Трассировку сохраняем отдельно для JSON
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+
+class _Listener(QueueListener):
+    """Фоновый поток вывода записей"""
+    
+    def enqueue_sentinel(self):
+        # Очередь может быть заполнена - ждем, пока поток освободит место
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(
+    level: str = "INFO",
+    log_format: str = "text",
+    sample_rate: float = 1.0,
+    sampled_loggers: tuple = (),
+    queue_size: int = 10000
+) -> QueueListener:
+    """
+    Настраивает логирование: обработчики пишут записи в очередь,
+    а вывод в stderr выполняет отдельный поток QueueListener.
+    Поток останавливается (с записью оставшихся сообщений) при завершении процесса.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter(TEXT_FORMAT))
+    
+    log_queue = queue.Queue(queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate, sampled_loggers))
+    
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, level))
+    
+    listener = _Listener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
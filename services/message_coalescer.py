@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    """Пачка сообщений, обрабатываемая одним запросом"""
+    __slots__ = ('items', 'prepared')
+    
+    def __init__(self, items: list):
+        self.items = items
+        self.prepared = False
+
+
+class _KeyState:
+    """Состояние очереди одного пользователя"""
+    __slots__ = ('items', 'timer', 'task', 'batch', 'lock')
+    
+    def __init__(self):
+        self.items = []
+        self.timer = None
+        self.task = None
+        self.batch = None
+        self.lock = asyncio.Lock()
+
+
+class MessageCoalescer:
+    """
+    Последовательная обработка сообщений по ключу (например, user_id)
+    с объединением быстро идущих подряд сообщений.
+    
+    Обработка делится на два шага:
+    prepare(items) - сохранение сообщений, не прерывается после начала;
+    respond(items, prepared) - запрос к модели и ответ, отменяется,
+    если до его завершения пришло новое сообщение от того же пользователя.
+    Новый запрос видит в истории все ранее сохраненные сообщения,
+    поэтому отмененный ответ не теряет контекст.
+    """
+    
+    def __init__(self, prepare, respond, debounce: float = 0.0):
+        """
+        :param prepare: Корутина prepare(items), выполняемая до конца
+        :param respond: Корутина respond(items, prepared), которую можно отменить
+        :param debounce: Окно ожидания новых сообщений перед обработкой, в секундах
+        """
+        self._prepare = prepare
+        self._respond = respond
+        self.debounce = debounce
+        self._states = {}
+        self.superseded = 0
+        self.merged = 0
+    
+    def submit(self, key, item):
+        """Добавляет сообщение в очередь пользователя"""
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _KeyState()
+        state.items.append(item)
+        
+        # Отменяем устаревший запрос: новый учтет и его сообщения
+        if state.task and not state.task.done():
+            state.task.cancel()
+            self.superseded += 1
+            if not state.batch.prepared:
+                # Сообщения еще не сохранены - переносим их в новую пачку
+                state.items[:0] = state.batch.items
+        
+        if state.timer:
+            state.timer.cancel()
+            state.timer = None
+        
+        if self.debounce > 0:
+            state.timer = asyncio.create_task(self._wait_and_start(key, state))
+        else:
+            self._start(key, state)
+    
+    def stats(self) -> dict:
+        """Возвращает статистику объединения запросов"""
+        return {
+            'active_keys': len(self._states),
+            'superseded': self.superseded,
+            'merged': self.merged
+        }
+    
+    async def _wait_and_start(self, key, state: _KeyState):
+        """Ждет окончания окна ожидания и запускает обработку"""
+        await asyncio.sleep(self.debounce)
+        state.timer = None
+        self._start(key, state)
+    
+    def _start(self, key, state: _KeyState):
+        """Запускает обработку накопленных сообщений"""
+        batch = _Batch(state.items)
+        state.items = []
+        self.merged += len(batch.items) - 1
+        state.batch = batch
+        state.task = asyncio.create_task(self._run(key, state, batch))
+    
+    async def _run(self, key, state: _KeyState, batch: _Batch):
+        """Обрабатывает пачку, дожидаясь завершения предыдущей"""
+        try:
+            async with state.lock:
+                batch.prepared = True
+                prepared = await asyncio.shield(self._prepare(batch.items))
+                await self._respond(batch.items, prepared)
+                
+        except asyncio.CancelledError:
+            logger.info("Request superseded by a newer message", extra={'key': key, 'sampled': True})
+            
+        except Exception as e:
+            logger.error(f"Error processing messages for {key}: {e}")
+            
+        finally:
+            # Удаляем состояние, если больше нечего обрабатывать
+            if state.task is asyncio.current_task() and not state.items and state.timer is None:
+                self._states.pop(key, None)
@@ -0,0 +1,260 @@
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+# Границы корзин гистограмм задержек по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    """Экранирует значение метки для текстового формата Prometheus"""
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+    """Формирует {name="value",...} для строки метрики"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra.items())
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    """Форматирует число для текстового формата Prometheus"""
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    """Набор метрик процесса, отдаваемых на /metrics"""
+    
+    def __init__(self):
+        self._metrics = {}
+    
+    def register(self, metric):
+        """Добавляет метрику (имена должны быть уникальны)"""
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+    
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _ValueChild:
+    """Значение счетчика или датчика для одного набора меток"""
+    
+    __slots__ = ('value', 'function')
+    
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+    
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+    
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+    
+    def set(self, value: float):
+        self.value = value
+    
+    def set_function(self, function: Callable[[], float]):
+        """Значение берется из функции в момент чтения метрик"""
+        self.function = function
+    
+    def get(self) -> float:
+        if self.function is not None:
+            return float(self.function())
+        return self.value
+
+
+class _HistogramChild:
+    """Гистограмма для одного набора меток"""
+    
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+    
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+    
+    @contextmanager
+    def time(self):
+        """Замеряет время выполнения блока"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class _Metric:
+    """Метрика с необязательными метками"""
+    
+    type = ""
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if registry is not None:
+            registry.register(self)
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def labels(self, *values, **kwargs):
+        """Возвращает значение метрики для указанных меток"""
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}")
+        
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+    
+    def children(self) -> dict:
+        """Значения метрики по наборам меток"""
+        return dict(self._children)
+    
+    def collect(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    
+    type = "counter"
+    
+    def _new_child(self):
+        return _ValueChild()
+    
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+    
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+    
+    def collect(self) -> list:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}"
+            for values, child in self._children.items()
+        ]
+
+
+class Gauge(Counter):
+    """Значение, которое может как расти, так и уменьшаться"""
+    
+    type = "gauge"
+    
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+    
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    """Распределение значений (задержек) по корзинам"""
+    
+    type = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+    
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+    
+    def observe(self, value: float):
+        self.labels().observe(value)
+    
+    def time(self):
+        return self.labels().time()
+    
+    def collect(self) -> list:
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, {'le': _format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values, {'le': "+Inf"})
+            lines.append(f"{self.name}_bucket{labels} {child.count}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+# Задержки этапов обработки сообщения:
+# db_context - сохранение сообщения и загрузка контекста, history_build - сборка промпта,
+# llm - получение ответа модели, db_write - сохранение ответа, telegram_send - отправка ответа,
+# respond - весь ответ после загрузки контекста
+STAGE_DURATION = Histogram(
+    "bot_stage_duration_seconds",
+    "Duration of message handling stages",
+    ["stage"]
+)
+LLM_REQUEST_DURATION = Histogram(
+    "bot_llm_request_duration_seconds",
+    "Duration of upstream LLM requests",
+    ["model", "outcome"]
+)
+LLM_FIRST_CHUNK_DURATION = Histogram(
+    "bot_llm_first_chunk_seconds",
+    "Time to the first streamed chunk of an LLM response",
+    ["model"]
+)
+TELEGRAM_REQUEST_DURATION = Histogram(
+    "bot_telegram_request_duration_seconds",
+    "Duration of Telegram Bot API requests",
+    ["method"]
+)
+SEND_QUEUE_WAIT = Histogram(
+    "bot_send_queue_wait_seconds",
+    "Time outbound Telegram requests wait in the send scheduler"
+)
+
+ERRORS = Counter("bot_errors_total", "Errors by stage", ["stage"])
+LLM_RETRIES = Counter("bot_llm_retries_total", "Retried upstream LLM requests")
+LLM_REJECTED = Counter("bot_llm_rejected_total", "LLM requests rejected by admission control")
+TELEGRAM_RETRY_AFTER = Counter("bot_telegram_retry_after_total", "Telegram 429 RetryAfter responses")
+CACHE_REQUESTS = Counter("bot_cache_requests_total", "Cache lookups", ["cache", "result"])
+LOG_RECORDS_DROPPED = Counter("bot_log_records_dropped_total", "Log records dropped because the log queue was full")
+
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Updates being handled")
+UPDATES_WAITING = Gauge("bot_updates_waiting", "Updates waiting for a handling slot")
+LLM_IN_FLIGHT = Gauge("bot_llm_in_flight", "Upstream LLM requests in flight")
+LLM_QUEUE_DEPTH = Gauge("bot_llm_queue_depth", "LLM requests waiting for a slot")
+SEND_QUEUE_DEPTH = Gauge("bot_send_queue_depth", "Outbound Telegram requests waiting in the send scheduler")
@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator
+
+from config import (
+    MODEL_FALLBACK_CHAIN,
+    MODEL_LATENCY_SLO,
+    MODEL_HEDGING_ENABLED,
+    MODEL_STATS_WINDOW,
+    MODEL_STATS_MIN_SAMPLES,
+    MODEL_STATS_MAX_AGE,
+    MODEL_ERROR_RATE_THRESHOLD
+)
+from services.admission import ServiceBusyError
+from services.providers import answered_model
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStats:
+    """
+    Скользящая статистика задержек и ошибок модели.
+    Запросы старше max_age секунд не учитываются, поэтому модель, исключенная
+    из цепочки из-за ошибок, со временем снова получает запросы
+    """
+    
+    def __init__(self, window: int = 100, max_age: float = 300.0):
+        self.max_age = max_age
+        # Элементы - (время, задержка) и (время, успех)
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+    
+    def _expire(self):
+        """Удаляет устаревшие запросы"""
+        if self.max_age <= 0:
+            return
+        threshold = time.monotonic() - self.max_age
+        for samples in (self.latencies, self.outcomes):
+            while samples and samples[0][0] < threshold:
+                samples.popleft()
+    
+    def record_success(self, latency: float):
+        now = time.monotonic()
+        self.latencies.append((now, latency))
+        self.outcomes.append((now, True))
+    
+    def record_error(self):
+        self.outcomes.append((time.monotonic(), False))
+    
+    @property
+    def samples(self) -> int:
+        self._expire()
+        return len(self.outcomes)
+    
+    def error_rate(self) -> float:
+        """Доля ошибок среди последних запросов"""
+        self._expire()
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, success in self.outcomes if not success) / len(self.outcomes)
+    
+    def percentile(self, percent: float) -> float:
+        """Перцентиль задержки успешных запросов (None, если данных нет)"""
+        self._expire()
+        if not self.latencies:
+            return None
+        ordered = sorted(latency for _, latency in self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+    
+    def to_dict(self) -> dict:
+        return {
+            'samples': self.samples,
+            'error_rate': round(self.error_rate(), 3),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95)
+        }
+
+
+class ModelRouter:
+    """
+    Поставщик ответов с резервными моделями поверх другого поставщика.
+    
+    Запрос идет в выбранную модель, а при ошибке или превышении
+    MODEL_LATENCY_SLO (при потоковой выдаче - до первого фрагмента)
+    - в следующую модель цепочки. Модели с высокой
+    долей ошибок пропускаются. Отказ локального ограничения запросов
+    (ServiceBusyError) не считается ошибкой модели и сразу передается
+    вызывающему. При включенном хеджировании, если основная
+    модель не ответила за свой p95, параллельно запускается резервная
+    и используется первый полученный ответ.
+    """
+    
+    def __init__(
+        self,
+        provider,
+        fallback_chain: list = None,
+        latency_slo: float = MODEL_LATENCY_SLO,
+        hedging: bool = MODEL_HEDGING_ENABLED
+    ):
+        self.provider = provider
+        self.fallback_chain = MODEL_FALLBACK_CHAIN if fallback_chain is None else fallback_chain
+        self.latency_slo = latency_slo
+        self.hedging = hedging
+        self.model_stats = {}
+        self.fallbacks = 0
+        self.hedged = 0
+    
+    def _stats(self, model: str) -> ModelStats:
+        stats = self.model_stats.get(model)
+        if stats is None:
+            stats = self.model_stats[model] = ModelStats(MODEL_STATS_WINDOW, MODEL_STATS_MAX_AGE)
+        return stats
+    
+    def stats(self) -> dict:
+        """Возвращает статистику по моделям"""
+        return {
+            'fallbacks': self.fallbacks,
+            'hedged': self.hedged,
+            'models': {model: stats.to_dict() for model, stats in self.model_stats.items()}
+        }
+    
+    def get_chain(self, model: str) -> list:
+        """Строит цепочку моделей для запроса, пропуская сбоящие модели"""
+        chain = [model] + [m for m in self.fallback_chain if m != model]
+        healthy = [
+            m for m in chain
+            if self._stats(m).samples < MODEL_STATS_MIN_SAMPLES
+            or self._stats(m).error_rate() < MODEL_ERROR_RATE_THRESHOLD
+        ]
+        # Если сбоят все модели, все равно пробуем всю цепочку
+        return healthy or chain
+    
+    async def _call(self, messages: list, model: str) -> str:
+        """Запрос к модели с учетом статистики"""
+        started = time.monotonic()
+        try:
+            response = await self.provider.generate(messages, model)
+        except (asyncio.CancelledError, ServiceBusyError):
+            # Перегружен бот, а не модель
+            raise
+        except Exception:
+            self._stats(model).record_error()
+            raise
+        self._stats(model).record_success(time.monotonic() - started)
+        return response
+    
+    async def _call_with_slo(self, messages: list, model: str, is_last: bool) -> str:
+        """Запрос к модели, прерываемый по SLO, если есть резервная модель"""
+        if is_last or not self.latency_slo:
+            return await self._call(messages, model)
+        try:
+            return await asyncio.wait_for(self._call(messages, model), self.latency_slo)
+        except asyncio.TimeoutError:
+            self._stats(model).record_error()
+            raise
+    
+    async def _hedged_call(self, messages: list, primary: str, secondary: str, delay: float) -> tuple:
+        """
+        Запускает резервную модель, если основная не ответила за delay секунд.
+        Возвращает (ответ, ответившая модель)
+        """
+        primary_task = asyncio.create_task(self._call(messages, primary))
+        models = {primary_task: primary}
+        tasks = {primary_task}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedged += 1
+                logger.info(
+                    f"Model {primary} slower than {delay:.2f}s, hedging with {secondary}",
+                    extra={'model': primary, 'sampled': True}
+                )
+                secondary_task = asyncio.create_task(self._call(messages, secondary))
+                models[secondary_task] = secondary
+                tasks.add(secondary_task)
+            
+            last_error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), models[task]
+                    if isinstance(task.exception(), ServiceBusyError):
+                        raise task.exception()
+                    last_error = task.exception()
+            raise last_error
+            
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def generate(self, messages: list, model: str) -> str:
+        chain = self.get_chain(model)
+        last_error = None
+        index = 0
+        
+        while index < len(chain):
+            current = chain[index]
+            is_last = index == len(chain) - 1
+            try:
+                p95 = self._stats(current).percentile(95)
+                if (
+                    self.hedging
+                    and not is_last
+                    and p95 is not None
+                    and self._stats(current).samples >= MODEL_STATS_MIN_SAMPLES
+                ):
+                    # Хеджированный запрос использует сразу две модели цепочки
+                    index += 2
+                    response, answered = await self._hedged_call(messages, current, chain[index - 1], p95)
+                    answered_model.set(answered)
+                    return response
+                
+                index += 1
+                response = await self._call_with_slo(messages, current, is_last)
+                answered_model.set(current)
+                return response
+                
+            except ServiceBusyError:
+                # Резервные модели прошли бы через то же ограничение
+                raise
+                
+            except Exception as e:
+                last_error = e
+                if index < len(chain):
+                    self.fallbacks += 1
+                    logger.warning(f"Model {current} failed ({e!r}), falling back to {chain[index]}")
+        
+        raise last_error
+    
+    async def stream(self, messages: list, model: str) -> AsyncIterator[str]:
+        chain = self.get_chain(model)
+        
+        for index, current in enumerate(chain):
+            is_last = index == len(chain) - 1
+            received = False
+            started = time.monotonic()
+            try:
+                async with aclosing(self.provider.stream(messages, current)) as stream:
+                    first = stream.__anext__()
+                    if not is_last and self.latency_slo:
+                        # Пока ответ не начат, медленную модель можно заменить резервной
+                        first = asyncio.wait_for(first, self.latency_slo)
+                    try:
+                        chunk = await first
+                    except StopAsyncIteration:
+                        pass
+                    else:
+                        received = True
+                        yield chunk
+                        async for chunk in stream:
+                            yield chunk
+                self._stats(current).record_success(time.monotonic() - started)
+                answered_model.set(current)
+                return
+                
+            except ServiceBusyError:
+                raise
+                
+            except Exception as e:
+                self._stats(current).record_error()
+                # Переключаться можно только пока пользователь ничего не получил
+                if received or is_last:
+                    raise
+                self.fallbacks += 1
+                logger.warning(f"Model {current} failed ({e!r}), falling back to {chain[index + 1]}")
@@ -0,0 +1,237 @@
+import asyncio
+import html
+import logging
+import re
+
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message
+
+from config import REPLY_CHUNK_DELAY, REPLY_MAX_CHUNKS
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+DOCUMENT_CAPTION = "📄 Ответ слишком длинный, поэтому отправлен файлом."
+
+# Разметка Markdown, которую переводим в HTML Telegram
+_CODE_SPAN_RE = re.compile(r'`([^`\n]+)`')
+_LINK_RE = re.compile(r'\[([^\]\n]+)\]\((https?://[^)\s]+)\)')
+_BOLD_RE = re.compile(r'\*\*(?!\s)(.+?)(?<!\s)\*\*|__(?!\s)(.+?)(?<!\s)__')
+_STRIKE_RE = re.compile(r'~~(?!\s)(.+?)(?<!\s)~~')
+_ITALIC_RE = re.compile(r'(?<![\w*])\*(?![\s*])(.+?)(?<![\s*])\*(?![\w*])|(?<!\w)_(?![\s_])(.+?)(?<![\s_])_(?!\w)')
+_HEADING_RE = re.compile(r'^#{1,6}\s+(.+?)\s*#*$', re.M)
+_BULLET_RE = re.compile(r'^(\s*)[-*+]\s+', re.M)
+_PLACEHOLDER_RE = re.compile(r'\x00(\d+)\x00')
+
+# Разделители для слишком длинных блоков: строки, затем слова
+_SEPARATORS = ('\n', ' ')
+
+
+def split_blocks(text: str) -> list:
+    """
+    Делит текст Markdown на блоки: абзацы и блоки кода.
+    Возвращает список (вид, язык, содержимое), где вид - "text" или "code".
+    """
+    blocks = []
+    lines = []
+    code_lang = None
+    
+    def flush(kind: str, lang: str = ''):
+        body = '\n'.join(lines).strip('\n')
+        if body.strip() or kind == 'code':
+            blocks.append((kind, lang, body))
+        lines.clear()
+    
+    for line in text.split('\n'):
+        fence = line.strip().startswith('```')
+        if code_lang is None:
+            if fence:
+                flush('text')
+                code_lang = line.strip()[3:].strip().split(' ')[0]
+            elif not line.strip():
+                flush('text')
+            else:
+                lines.append(line)
+        else:
+            if fence:
+                flush('code', code_lang)
+                code_lang = None
+            else:
+                lines.append(line)
+    
+    # Незакрытый блок кода (например, ответ оборвался) тоже оформляем как код
+    if code_lang is not None:
+        flush('code', code_lang)
+    else:
+        flush('text')
+    
+    return blocks
+
+
+def markdown_to_html(text: str) -> str:
+    """Переводит строчную разметку Markdown в HTML Telegram, экранируя остальной текст"""
+    code_spans = []
+    
+    def stash(match):
+        code_spans.append(match.group(1))
+        return f"\x00{len(code_spans) - 1}\x00"
+    
+    # Код не форматируем, поэтому убираем его до обработки остальной разметки
+    text = _CODE_SPAN_RE.sub(stash, text)
+    text = html.escape(text, quote=False)
+    
+    # Адрес ссылки уже экранирован вместе с текстом, остается только кавычка
+    text = _LINK_RE.sub(
+        lambda m: f'<a href="{m.group(2).replace(chr(34), "%22")}">{m.group(1)}</a>',
+        text
+    )
+    text = _HEADING_RE.sub(r'<b>\1</b>', text)
+    text = _BOLD_RE.sub(lambda m: f"<b>{m.group(1) or m.group(2)}</b>", text)
+    text = _STRIKE_RE.sub(r'<s>\1</s>', text)
+    text = _ITALIC_RE.sub(lambda m: f"<i>{m.group(1) or m.group(2)}</i>", text)
+    text = _BULLET_RE.sub(r'\1• ', text)
+    
+    return _PLACEHOLDER_RE.sub(
+        lambda m: f"<code>{html.escape(code_spans[int(m.group(1))], quote=False)}</code>",
+        text
+    )
+
+
+def render_block(kind: str, lang: str, body: str) -> str:
+    """Переводит блок в HTML Telegram"""
+    if kind == 'code':
+        code = html.escape(body, quote=False)
+        if lang:
+            return f'<pre><code class="language-{html.escape(lang)}">{code}</code></pre>'
+        return f"<pre>{code}</pre>"
+    return markdown_to_html(body)
+
+
+def block_source(kind: str, lang: str, body: str) -> str:
+    """Исходный текст блока (для отправки без разметки)"""
+    if kind == 'code':
+        return f"```{lang}\n{body}\n```"
+    return body
+
+
+def _fit_block(kind: str, lang: str, body: str, limit: int, level: int = 0) -> list:
+    """
+    Делит блок на части, каждая из которых после перевода в HTML укладывается в limit.
+    Блок делится по строкам, затем по словам, в крайнем случае - по символам.
+    Возвращает список (html, исходный текст).
+    """
+    rendered = render_block(kind, lang, body)
+    if len(rendered) <= limit:
+        return [(rendered, block_source(kind, lang, body))]
+    
+    if level < len(_SEPARATORS):
+        separator = _SEPARATORS[level]
+        parts = body.split(separator)
+    else:
+        # Экранирование удлиняет текст не больше чем в 5 раз
+        separator = ''
+        size = max(1, limit // 8)
+        parts = [body[i:i + size] for i in range(0, len(body), size)]
+    
+    result = []
+    group = []
+    for part in parts:
+        candidate = separator.join(group + [part])
+        if group and len(render_block(kind, lang, candidate)) > limit:
+            result.extend(_fit_block(kind, lang, separator.join(group), limit, level + 1))
+            group = [part]
+        else:
+            group.append(part)
+    
+    if group:
+        result.extend(_fit_block(kind, lang, separator.join(group), limit, level + 1))
+    return result
+
+
+def format_reply(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Переводит ответ модели в HTML Telegram и делит на сообщения не длиннее limit.
+    Сообщения делятся по границам абзацев и блоков кода, теги в каждом закрыты.
+    Возвращает список (html, исходный текст).
+    """
+    pieces = []
+    for kind, lang, body in split_blocks(text):
+        pieces.extend(_fit_block(kind, lang, body, limit))
+    
+    chunks = []
+    html_parts = []
+    source_parts = []
+    size = 0
+    for rendered, source in pieces:
+        extra = len(rendered) + (2 if html_parts else 0)
+        if html_parts and size + extra > limit:
+            chunks.append(("\n\n".join(html_parts), "\n\n".join(source_parts)))
+            html_parts = []
+            source_parts = []
+            extra = len(rendered)
+            size = 0
+        html_parts.append(rendered)
+        source_parts.append(source)
+        size += extra
+    
+    if html_parts:
+        chunks.append(("\n\n".join(html_parts), "\n\n".join(source_parts)))
+    return chunks
+
+
+async def _send_chunk(send, rendered: str, source: str) -> Message:
+    """
+    Отправляет одну часть ответа, при ошибке разметки - без форматирования.
+    RetryAfter повторяет планировщик отправки (SendScheduler)
+    """
+    try:
+        return await send(text=rendered, parse_mode=ParseMode.HTML)
+    
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return None
+        logger.warning(f"Error sending formatted reply, sending as plain text: {e}")
+    
+    return await send(text=source[:TELEGRAM_MESSAGE_LIMIT], parse_mode=None)
+
+
+async def send_document_reply(message: Message, text: str, placeholder: Message = None):
+    """Отправляет ответ файлом Markdown"""
+    if placeholder:
+        try:
+            await placeholder.delete()
+        except TelegramBadRequest:
+            pass
+    
+    document = BufferedInputFile(text.encode('utf-8'), filename="response.md")
+    return await message.reply_document(document, caption=DOCUMENT_CAPTION)
+
+
+async def send_reply(message: Message, text: str, placeholder: Message = None):
+    """
+    Отправляет ответ модели пользователю.
+    Длинный ответ делится на несколько сообщений с паузой REPLY_CHUNK_DELAY между ними,
+    ответ длиннее REPLY_MAX_CHUNKS сообщений отправляется файлом.
+    Если передан placeholder, первая часть заменяет его текст.
+    """
+    # Заведомо слишком длинный ответ не форматируем
+    if len(text) > REPLY_MAX_CHUNKS * TELEGRAM_MESSAGE_LIMIT:
+        return await send_document_reply(message, text, placeholder)
+    
+    chunks = format_reply(text)
+    if not chunks:
+        raise ValueError("Empty response from AI service")
+    if len(chunks) > REPLY_MAX_CHUNKS:
+        return await send_document_reply(message, text, placeholder)
+    
+    for index, (rendered, source) in enumerate(chunks):
+        if index == 0:
+            send = placeholder.edit_text if placeholder else message.reply
+        else:
+            # Соблюдаем ограничение Telegram на частоту сообщений в один чат
+            await asyncio.sleep(REPLY_CHUNK_DELAY)
+            send = message.answer
+        await _send_chunk(send, rendered, source)
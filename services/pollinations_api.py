@@ -1,9 +1,37 @@
+import asyncio
 import logging
+import random
+import time
+from typing import AsyncIterator
+import aiohttp
 import g4f
+from g4f.errors import ResponseStatusError
 from g4f.Provider import PollinationsAI
 
+from config import (
+    LLM_MAX_CONCURRENCY,
+    LLM_MODEL_CONCURRENCY,
+    LLM_MODEL_CONCURRENCY_LIMITS,
+    LLM_MAX_QUEUE,
+    LLM_QUEUE_TIMEOUT,
+    LLM_REQUEST_TIMEOUT,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY
+)
+from .admission import AdmissionController
+from .metrics import LLM_REQUEST_DURATION, LLM_FIRST_CHUNK_DURATION
+
 logger = logging.getLogger(__name__)
 
+# Ошибки, после которых запрос имеет смысл повторить
+TRANSIENT_ERRORS = (
+    asyncio.TimeoutError,
+    OSError,
+    aiohttp.ClientError,
+    ResponseStatusError
+)
+
 class PollinationsService:
     """Сервис для работы с PollinationsAI"""
     
@@ -22,11 +50,32 @@ class PollinationsService:
             "gemini-2.0-flash-thinking",
             "gemini-2.0-flash"
         ]
+        
+        # Ограничение одновременных запросов к провайдеру
+        self.admission = AdmissionController(
+            max_concurrency=LLM_MAX_CONCURRENCY,
+            default_model_limit=LLM_MODEL_CONCURRENCY,
+            model_limits=LLM_MODEL_CONCURRENCY_LIMITS,
+            max_queue=LLM_MAX_QUEUE,
+            queue_timeout=LLM_QUEUE_TIMEOUT
+        )
+        self.retries = 0
     
     async def get_models(self):
         """Получить список доступных моделей"""
         return self.text_models
     
+    def is_busy(self) -> bool:
+        """Проверяет, перегружен ли сервис"""
+        return self.admission.is_busy()
+    
+    def stats(self) -> dict:
+        """Возвращает метрики запросов к провайдеру"""
+        return {
+            **self.admission.stats(),
+            'retries': self.retries
+        }
+    
     async def generate_response(self, messages: list, model: str = "gpt-4") -> str:
         """
         Генерация ответа от модели
@@ -36,15 +85,115 @@ class PollinationsService:
         :return: Ответ от модели
         """
         try:
-            # Используем g4f для получения ответа
-            response = await g4f.ChatCompletion.create_async(
-                model=model,
-                messages=messages,
-                provider=PollinationsAI
-            )
-            
-            return response
+            async with self.admission.slot(model):
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + LLM_REQUEST_TIMEOUT
+                attempt = 0
+                start = time.perf_counter()
+                outcome = "error"
+                
+                try:
+                    while True:
+                        try:
+                            # Используем g4f для получения ответа
+                            response = await asyncio.wait_for(
+                                g4f.ChatCompletion.create_async(
+                                    model=model,
+                                    messages=messages,
+                                    provider=PollinationsAI
+                                ),
+                                max(deadline - loop.time(), 0)
+                            )
+                            outcome = "ok"
+                            return response
+                            
+                        except TRANSIENT_ERRORS as e:
+                            await self._backoff(attempt, deadline, model, e)
+                            attempt += 1
+                
+                finally:
+                    LLM_REQUEST_DURATION.labels(model, outcome).observe(time.perf_counter() - start)
             
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             raise
+    
+    async def stream_response(self, messages: list, model: str = "gpt-4") -> AsyncIterator[str]:
+        """
+        Потоковая генерация ответа от модели
+        
+        :param messages: Список сообщений в формате [{role: str, content: str}]
+        :param model: Название модели для использования
+        :return: Асинхронный генератор фрагментов ответа
+        """
+        start = None
+        try:
+            async with self.admission.slot(model):
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + LLM_REQUEST_TIMEOUT
+                attempt = 0
+                start = time.perf_counter()
+                first_chunk = True
+                
+                while True:
+                    received = False
+                    response = g4f.ChatCompletion.create_async(
+                        model=model,
+                        messages=messages,
+                        provider=PollinationsAI,
+                        stream=True
+                    ).__aiter__()
+                    
+                    try:
+                        while True:
+                            # Каждый фрагмент ждем не дольше, чем осталось до общего срока
+                            try:
+                                chunk = await asyncio.wait_for(
+                                    response.__anext__(),
+                                    max(deadline - loop.time(), 0)
+                                )
+                            except StopAsyncIteration:
+                                LLM_REQUEST_DURATION.labels(model, "ok").observe(time.perf_counter() - start)
+                                return
+                            
+                            # Провайдер может присылать служебные объекты помимо текста
+                            if isinstance(chunk, str) and chunk:
+                                if first_chunk:
+                                    LLM_FIRST_CHUNK_DURATION.labels(model).observe(time.perf_counter() - start)
+                                    first_chunk = False
+                                received = True
+                                yield chunk
+                                
+                    except TRANSIENT_ERRORS as e:
+                        # Повторяем только если пользователь еще ничего не получил
+                        if received:
+                            raise
+                        await self._backoff(attempt, deadline, model, e)
+                        attempt += 1
+                        
+                    finally:
+                        if hasattr(response, "aclose"):
+                            await response.aclose()
+                    
+        except Exception as e:
+            if start is not None:
+                LLM_REQUEST_DURATION.labels(model, "error").observe(time.perf_counter() - start)
+            logger.error(f"Error streaming response: {e}")
+            raise
+    
+    async def _backoff(self, attempt: int, deadline: float, model: str, error: Exception):
+        """
+        Ждет перед повтором запроса (экспоненциально, со случайным разбросом).
+        Пробрасывает ошибку, если повторы исчерпаны или не укладываются в срок.
+        """
+        delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+        remaining = deadline - asyncio.get_running_loop().time()
+        if attempt >= LLM_MAX_RETRIES or delay >= remaining:
+            raise error
+        
+        self.retries += 1
+        logger.warning(
+            f"Transient error from model {model} (attempt {attempt + 1}), "
+            f"retrying in {delay:.2f}s: {error!r}"
+        )
+        await asyncio.sleep(delay)
@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import random
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, AsyncIterator, Protocol
+
+if TYPE_CHECKING:
+    from .pollinations_api import PollinationsService
+
+# Модель, которая фактически ответила на последний запрос в текущей задаче.
+# Устанавливают поставщики, которые могут заменить запрошенную модель (ModelRouter)
+answered_model = ContextVar('answered_model', default=None)
+
+
+class TextProvider(Protocol):
+    """Интерфейс поставщика текстовых ответов"""
+    
+    async def generate(self, messages: list, model: str) -> str:
+        """Генерирует полный ответ"""
+        ...
+    
+    def stream(self, messages: list, model: str) -> AsyncIterator[str]:
+        """Генерирует ответ по частям"""
+        ...
+
+
+class PollinationsProvider:
+    """Поставщик ответов через PollinationsAI (g4f)"""
+    
+    def __init__(self, service: "PollinationsService"):
+        self.service = service
+    
+    async def generate(self, messages: list, model: str) -> str:
+        return await self.service.generate_response(messages, model=model)
+    
+    def stream(self, messages: list, model: str) -> AsyncIterator[str]:
+        return self.service.stream_response(messages, model=model)
+
+
+class FakeProvider:
+    """
+    Детерминированный локальный поставщик для тестов и бенчмарков.
+    Ответ зависит только от модели и сообщений, задержка задается явно.
+    """
+    
+    def __init__(self, latency: float = 0.0, words: int = 50):
+        """
+        :param latency: Задержка ответа в секундах
+        :param words: Количество слов в ответе
+        """
+        self.latency = latency
+        self.words = words
+        self.calls = 0
+    
+    def _make_response(self, messages: list, model: str) -> str:
+        """Строит ответ из псевдослучайных слов, зависящих от запроса"""
+        prompt = messages[-1]["content"] if messages else ""
+        digest = hashlib.sha256(f"{model}:{prompt}".encode()).digest()
+        rng = random.Random(digest)
+        vocabulary = ["ответ", "модель", "данные", "пример", "вопрос", "идея", "шаг", "итог"]
+        body = " ".join(rng.choice(vocabulary) for _ in range(self.words))
+        return f"[{model}] {body}"
+    
+    async def generate(self, messages: list, model: str) -> str:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._make_response(messages, model)
+    
+    async def stream(self, messages: list, model: str) -> AsyncIterator[str]:
+        self.calls += 1
+        words = self._make_response(messages, model).split(" ")
+        delay = self.latency / len(words) if self.latency else 0
+        for i, word in enumerate(words):
+            if delay:
+                await asyncio.sleep(delay)
+            yield word if i == 0 else f" {word}"
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import struct
+import time
+from typing import AsyncIterator
+
+from database import db
+from services.providers import answered_model
+from config import (
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_NEAR_DUPLICATES,
+    RESPONSE_CACHE_SIMILARITY
+)
+
+logger = logging.getLogger(__name__)
+
+# Параметры MinHash: 64 хеша, разбитые на 16 полос по 4
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_ROWS = MINHASH_PERMUTATIONS // MINHASH_BANDS
+SHINGLE_SIZE = 3
+
+# Модуль и коэффициенты хеш-функций вида (a * x + b) mod p
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20250217)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+# Через сколько сохранений запускать вытеснение старых записей
+EVICTION_INTERVAL = 100
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к нормальной форме: регистр, ё, пунктуация, пробелы"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def make_cache_key(messages: list, model: str) -> str:
+    """Ключ точного совпадения: модель и нормализованный список сообщений"""
+    normalized = [[msg["role"], normalize_text(msg["content"])] for msg in messages]
+    payload = json.dumps([model, normalized], ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def minhash_signature(text: str) -> list:
+    """MinHash-сигнатура множества словесных шинглов текста"""
+    words = normalize_text(text).split()
+    if len(words) < SHINGLE_SIZE:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {
+            " ".join(words[i:i + SHINGLE_SIZE])
+            for i in range(len(words) - SHINGLE_SIZE + 1)
+        }
+    
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little")
+        for shingle in shingles
+    ]
+    return [
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def signature_similarity(first: list, second: list) -> float:
+    """Оценка сходства Жаккара по двум сигнатурам"""
+    matches = sum(1 for x, y in zip(first, second) if x == y)
+    return matches / len(first)
+
+
+def band_keys(signature: list, model: str) -> list:
+    """Ключи полос LSH для поиска кандидатов"""
+    keys = []
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+        digest = hashlib.blake2b(
+            struct.pack(f"<{MINHASH_ROWS}Q", *rows),
+            digest_size=8
+        ).hexdigest()
+        keys.append(f"{model}:{band}:{digest}")
+    return keys
+
+
+def pack_signature(signature: list) -> bytes:
+    return struct.pack(f"<{MINHASH_PERMUTATIONS}Q", *signature)
+
+
+def unpack_signature(data: bytes) -> list:
+    return list(struct.unpack(f"<{MINHASH_PERMUTATIONS}Q", data))
+
+
+def standalone_prompt(messages: list) -> str:
+    """
+    Возвращает текст запроса, если он самостоятельный
+    (одно сообщение пользователя без истории), иначе None
+    """
+    user_messages = [msg for msg in messages if msg["role"] != "system"]
+    if len(user_messages) == 1 and user_messages[0]["role"] == "user":
+        return user_messages[0]["content"]
+    return None
+
+
+class CachingProvider:
+    """
+    Поставщик ответов с кэшем поверх другого поставщика.
+    Точное совпадение ищется по модели и нормализованным сообщениям.
+    В режиме похожих запросов самостоятельные вопросы сравниваются по MinHash.
+    Ответ сохраняется под моделью, которая его дала (с учетом резервных моделей).
+    Предназначен только для ответов на сообщения пользователя: служебные запросы
+    (черновики размышления, краткое содержание) идут мимо кэша.
+    """
+    
+    def __init__(self, provider, near_duplicates: bool = RESPONSE_CACHE_NEAR_DUPLICATES):
+        self.provider = provider
+        self.near_duplicates = near_duplicates
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._saves = 0
+    
+    def stats(self) -> dict:
+        """Возвращает статистику кэша"""
+        return {
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses
+        }
+    
+    async def lookup(self, messages: list, model: str) -> str:
+        """Ищет ответ в кэше (None, если не найден)"""
+        min_created_at = time.time() - RESPONSE_CACHE_TTL
+        try:
+            response = await db.get_cached_response(make_cache_key(messages, model), min_created_at)
+            if response is not None:
+                self.hits += 1
+                return response
+            
+            prompt = standalone_prompt(messages) if self.near_duplicates else None
+            if prompt:
+                signature = minhash_signature(prompt)
+                candidates = await db.find_similar_cached_responses(
+                    band_keys(signature, model),
+                    model,
+                    min_created_at
+                )
+                best = None
+                best_similarity = RESPONSE_CACHE_SIMILARITY
+                for candidate in candidates:
+                    if not candidate['signature']:
+                        continue
+                    similarity = signature_similarity(signature, unpack_signature(candidate['signature']))
+                    if similarity >= best_similarity:
+                        best, best_similarity = candidate, similarity
+                if best:
+                    self.near_hits += 1
+                    return best['response']
+                    
+        except Exception as e:
+            # Ошибка кэша не должна мешать ответу
+            logger.error(f"Error reading response cache: {e}")
+        
+        self.misses += 1
+        return None
+    
+    async def store(self, messages: list, model: str, response: str):
+        """Сохраняет ответ в кэш"""
+        if not response or not response.strip():
+            return
+        
+        try:
+            signature = None
+            keys = None
+            prompt = standalone_prompt(messages) if self.near_duplicates else None
+            if prompt:
+                minhash = minhash_signature(prompt)
+                signature = pack_signature(minhash)
+                keys = band_keys(minhash, model)
+            
+            await db.save_cached_response(
+                make_cache_key(messages, model),
+                model,
+                response,
+                signature,
+                keys
+            )
+            
+            self._saves += 1
+            if self._saves % EVICTION_INTERVAL == 0:
+                removed = await db.evict_response_cache(
+                    RESPONSE_CACHE_MAX_ENTRIES,
+                    time.time() - RESPONSE_CACHE_TTL
+                )
+                logger.info(f"Response cache eviction removed {removed} entries")
+                
+        except Exception as e:
+            logger.error(f"Error saving response to cache: {e}")
+    
+    async def generate(self, messages: list, model: str) -> str:
+        cached = await self.lookup(messages, model)
+        if cached is not None:
+            return cached
+        
+        answered_model.set(None)
+        response = await self.provider.generate(messages, model)
+        await self.store(messages, answered_model.get() or model, response)
+        return response
+    
+    async def stream(self, messages: list, model: str) -> AsyncIterator[str]:
+        cached = await self.lookup(messages, model)
+        if cached is not None:
+            yield cached
+            return
+        
+        answered_model.set(None)
+        chunks = []
+        async for chunk in self.provider.stream(messages, model):
+            chunks.append(chunk)
+            yield chunk
+        
+        await self.store(messages, answered_model.get() or model, "".join(chunks))
@@ -0,0 +1,61 @@
+import html
+import re
+
+# Слова запроса (буквы и цифры любых алфавитов)
+_WORD_RE = re.compile(r'\w+')
+
+# Больше слов в запросе не учитываем
+MAX_QUERY_TERMS = 8
+
+
+def get_query_terms(text: str, min_length: int = 1) -> list:
+    """Слова поискового запроса в нижнем регистре без повторов (не короче min_length)"""
+    terms = []
+    for word in _WORD_RE.findall(text.lower()):
+        if len(word) >= min_length and word not in terms:
+            terms.append(word)
+    return terms[:MAX_QUERY_TERMS]
+
+
+def build_match_query(terms: list, any_term: bool = False) -> str:
+    """
+    Выражение FTS5 для слов запроса: все слова должны встретиться
+    (или хотя бы одно при any_term), каждое - как начало слова
+    (чтобы находить другие формы слова).
+    Слова берутся в кавычки, поэтому операторы FTS5 из запроса не выполняются
+    """
+    return (" OR " if any_term else " ").join(f'"{term}"*' for term in terms)
+
+
+def make_snippet(content: str, terms: list, width: int = 200) -> str:
+    """
+    Фрагмент сообщения вокруг первого найденного слова в HTML Telegram,
+    найденные слова выделены жирным
+    """
+    pattern = re.compile(
+        r'(?<!\w)(?:' + "|".join(re.escape(term) for term in terms) + r')\w*',
+        re.IGNORECASE
+    ) if terms else None
+    text = " ".join(content.split())
+    
+    start = 0
+    match = pattern.search(text) if pattern else None
+    if match and match.start() > width // 3:
+        # Начинаем фрагмент немного раньше найденного слова, с начала слова
+        start = text.rfind(" ", 0, match.start() - width // 3) + 1
+    end = min(len(text), start + width)
+    if end < len(text):
+        space = text.rfind(" ", start, end)
+        if space > start:
+            end = space
+    
+    fragment = text[start:end]
+    parts = []
+    position = 0
+    for found in (pattern.finditer(fragment) if pattern else ()):
+        parts.append(html.escape(fragment[position:found.start()], quote=False))
+        parts.append(f"<b>{html.escape(found.group(), quote=False)}</b>")
+        position = found.end()
+    parts.append(html.escape(fragment[position:], quote=False))
+    
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(text) else "")
@@ -0,0 +1,257 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, AnswerInlineQuery
+
+from .metrics import SEND_QUEUE_WAIT, TELEGRAM_REQUEST_DURATION
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов (меньше - важнее)
+PRIORITY_CALLBACK = 0  # Ответы на нажатия кнопок: пользователь видит "часики"
+PRIORITY_MESSAGE = 1   # Отправка и редактирование сообщений
+
+CALLBACK_METHODS = (AnswerCallbackQuery, AnswerInlineQuery)
+
+# Сколько корзин чатов хранить, прежде чем удалять неиспользуемые
+MAX_TRACKED_CHATS = 10000
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        """Начисляет токены за прошедшее время"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 - доступен сейчас)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self, now: float):
+        """Забирает один токен"""
+        self._refill(now)
+        self.tokens -= 1
+    
+    def is_full(self, now: float) -> bool:
+        """Корзина полная - ее можно удалить без потери ограничения"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass(order=True)
+class _Waiter:
+    """Запрос, ожидающий разрешения на отправку"""
+    priority: int
+    seq: int
+    chat_id: Any = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Планировщик исходящих запросов к Telegram (middleware сессии бота).
+    Соблюдает общий лимит бота и лимит на каждый чат с помощью корзин токенов,
+    учитывает retry_after из ответа 429 и пропускает ответы на callback'и вперед
+    отправки сообщений. Остальные методы (getUpdates, setWebhook и т.п.) не ограничиваются.
+    """
+    
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        chat_burst: int = 3,
+        max_retries: int = 3
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats = {}
+        self._global_paused_until = 0.0
+        self._chat_paused_until = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._timer = None
+        
+        # Метрики
+        self.sent = 0
+        self.retry_after = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    async def __call__(self, make_request, bot, method):
+        priority = self._classify(method)
+        if priority is None:
+            return await make_request(bot, method)
+        
+        chat_id = getattr(method, 'chat_id', None) if priority == PRIORITY_MESSAGE else None
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                with TELEGRAM_REQUEST_DURATION.labels(type(method).__name__).time():
+                    return await make_request(bot, method)
+            
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(
+                    f"Flood control on {type(method).__name__} (chat {chat_id}), "
+                    f"retrying in {e.retry_after}s"
+                )
+                self._pause(chat_id, e.retry_after)
+    
+    @staticmethod
+    def _classify(method) -> Optional[int]:
+        """Определяет приоритет запроса (None - запрос не ограничивается)"""
+        if isinstance(method, CALLBACK_METHODS):
+            return PRIORITY_CALLBACK
+        if 'chat_id' in type(method).model_fields:
+            return PRIORITY_MESSAGE
+        return None
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        """Возвращает корзину чата, создавая ее при первом обращении"""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # В группы и каналы Telegram разрешает отправлять реже, чем в личные чаты
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, max(1, self.chat_burst))
+        return bucket
+    
+    def _pause(self, chat_id, retry_after: float):
+        """Приостанавливает отправку в чат (или всю отправку) на retry_after секунд"""
+        until = time.monotonic() + retry_after
+        if chat_id is None:
+            self._global_paused_until = max(self._global_paused_until, until)
+        else:
+            self._chat_paused_until[chat_id] = max(self._chat_paused_until.get(chat_id, 0.0), until)
+    
+    def _global_delay(self, now: float) -> float:
+        """Через сколько секунд можно будет отправить хоть что-нибудь"""
+        return max(self._global.delay(now), self._global_paused_until - now)
+    
+    def _chat_delay(self, chat_id, now: float) -> float:
+        """Через сколько секунд можно будет отправить в чат"""
+        if chat_id is None:
+            return 0.0
+        return max(
+            self._chat_bucket(chat_id).delay(now),
+            self._chat_paused_until.get(chat_id, 0.0) - now
+        )
+    
+    async def _acquire(self, chat_id, priority: int):
+        """Ждет разрешения на отправку запроса"""
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(priority, next(self._seq), chat_id, loop.create_future(), time.monotonic())
+        bisect.insort(self._queue, waiter)
+        self._schedule()
+        
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._queue:
+                self._queue.remove(waiter)
+            raise
+        
+        wait = time.monotonic() - waiter.enqueued_at
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        SEND_QUEUE_WAIT.observe(wait)
+    
+    def _schedule(self):
+        """
+        Выдает разрешения ожидающим запросам в порядке приоритета.
+        Запрос в чат, лимит которого исчерпан, не задерживает запросы в другие чаты.
+        Если кто-то остался ждать, планирует следующий вызов на момент появления токена.
+        """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        
+        now = time.monotonic()
+        next_delay = None
+        index = 0
+        while index < len(self._queue):
+            waiter = self._queue[index]
+            if waiter.future.done():
+                # Запрос отменен
+                del self._queue[index]
+                continue
+            
+            global_delay = self._global_delay(now)
+            if global_delay > 0:
+                # Общий лимит исчерпан - ждут все
+                next_delay = global_delay if next_delay is None else min(next_delay, global_delay)
+                break
+            
+            chat_delay = self._chat_delay(waiter.chat_id, now)
+            if chat_delay > 0:
+                next_delay = chat_delay if next_delay is None else min(next_delay, chat_delay)
+                index += 1
+                continue
+            
+            self._global.take(now)
+            if waiter.chat_id is not None:
+                self._chat_bucket(waiter.chat_id).take(now)
+            del self._queue[index]
+            waiter.future.set_result(None)
+        
+        if self._queue and next_delay is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_delay, self._schedule)
+        
+        if len(self._chats) > MAX_TRACKED_CHATS:
+            self._prune(now)
+    
+    def _prune(self, now: float):
+        """Удаляет корзины чатов, которые успели наполниться и никого не ждут"""
+        waiting = {waiter.chat_id for waiter in self._queue}
+        for chat_id in list(self._chats):
+            if chat_id not in waiting and self._chats[chat_id].is_full(now):
+                del self._chats[chat_id]
+        for chat_id, until in list(self._chat_paused_until.items()):
+            if until <= now:
+                del self._chat_paused_until[chat_id]
+    
+    def stats(self) -> dict:
+        """Метрики очереди отправки"""
+        now = time.monotonic()
+        return {
+            'queued': len(self._queue),
+            'queued_callbacks': sum(1 for waiter in self._queue if waiter.priority == PRIORITY_CALLBACK),
+            'oldest_wait': max((now - waiter.enqueued_at for waiter in self._queue), default=0.0),
+            'sent': self.sent,
+            'retry_after': self.retry_after,
+            'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+            'max_wait': self.max_wait,
+            'tracked_chats': len(self._chats),
+            'paused_chats': sum(1 for until in self._chat_paused_until.values() if until > now),
+            'globally_paused': self._global_paused_until > now
+        }
@@ -1,11 +1,45 @@
 from typing import List
 import asyncio
-from .blackbox_api import query_text
+import re
+from .providers import TextProvider
+
+# Точки зрения для параллельных черновиков, чтобы они не повторяли друг друга
+DRAFT_PERSPECTIVES = [
+    "Дай подробный и точный ответ.",
+    "Рассмотри вопрос с практической стороны, приведи примеры.",
+    "Рассмотри возможные подводные камни и альтернативные подходы.",
+    "Объясни основные понятия и причины, лежащие в основе ответа.",
+]
+
 
 class ThinkingProcess:
-    def __init__(self, model: str, iterations: int = 7):
+    def __init__(
+        self,
+        provider: TextProvider,
+        model: str,
+        iterations: int = 7,
+        parallel: bool = False,
+        concurrency: int = 3,
+        similarity_threshold: float = None,
+        max_prompt_chars: int = None
+    ):
+        """
+        :param provider: Поставщик ответов модели
+        :param model: Название модели
+        :param iterations: Максимальное количество итераций (или черновиков в параллельном режиме,
+            но не больше количества точек зрения DRAFT_PERSPECTIVES)
+        :param parallel: Генерировать независимые черновики параллельно вместо последовательных улучшений
+        :param concurrency: Максимальное количество одновременных запросов к модели
+        :param similarity_threshold: Порог сходства (0..1), при достижении которого итерации прекращаются
+        :param max_prompt_chars: Ограничение размера промпта в символах
+        """
+        self.provider = provider
         self.model = model
         self.iterations = iterations
+        self.parallel = parallel
+        self.concurrency = max(1, concurrency)
+        self.similarity_threshold = similarity_threshold
+        self.max_prompt_chars = max_prompt_chars
         self.conversation_history: List[str] = []
 
     async def process_query(self, initial_query: str) -> str:
@@ -15,33 +49,123 @@ class ThinkingProcess:
         """
         # Сохраняем начальный запрос
         self.conversation_history = [initial_query]
-        current_response = initial_query
 
-        # Выполняем итерации размышления
-        for _ in range(self.iterations):
-            prompt = (
-                "Улучши этот ответ, добавь больше деталей и задай уточняющие вопросы:\n\n"
-                f"{current_response}"
-            )
-            
-            current_response = await query_text(prompt, self.model)
-            self.conversation_history.append(current_response)
+        if self.parallel:
+            await self._run_parallel(initial_query)
+        else:
+            await self._run_sequential(initial_query)
 
         # Формируем финальный запрос для структурирования
-        final_prompt = (
+        header = (
             "На основе следующего диалога составь один структурированный и подробный ответ. "
             "Используй маркированные списки где это уместно, раздели информацию на логические блоки "
             "и убери все повторения:\n\n"
             f"Начальный запрос: {initial_query}\n\n"
             f"Процесс размышления:\n{'-' * 40}\n"
-            + '\n'.join(f"Итерация {i+1}:\n{resp}\n{'-' * 40}" 
-                       for i, resp in enumerate(self.conversation_history[1:]))
         )
+        iterations = [
+            f"Итерация {i+1}:\n{resp}\n{'-' * 40}"
+            for i, resp in enumerate(self.conversation_history[1:])
+        ]
+        final_prompt = header + '\n'.join(self._fit_budget(iterations, len(header)))
 
         # Получаем и возвращаем структурированный ответ
-        structured_response = await query_text(final_prompt, self.model)
+        structured_response = await self._query(final_prompt)
         return structured_response
 
+    async def _run_sequential(self, initial_query: str):
+        """Последовательно улучшает ответ, пока он не перестанет меняться"""
+        current_response = initial_query
+
+        for _ in range(self.iterations):
+            prompt = (
+                "Улучши этот ответ, добавь больше деталей и задай уточняющие вопросы:\n\n"
+                f"{self._truncate(current_response)}"
+            )
+
+            previous_response = current_response
+            current_response = await self._query(prompt)
+            self.conversation_history.append(current_response)
+
+            # Останавливаемся, если ответ почти не изменился
+            if self._converged(current_response, [previous_response]):
+                break
+
+    async def _run_parallel(self, initial_query: str):
+        """
+        Генерирует независимые черновики волнами по concurrency запросов.
+        Черновиков не больше, чем точек зрения: повторный запрос с той же точкой
+        зрения дал бы тот же черновик.
+        Новые волны не запускаются, если очередная волна не добавила ничего нового.
+        """
+        query = self._truncate(initial_query)
+        drafts_limit = min(self.iterations, len(DRAFT_PERSPECTIVES))
+
+        while len(self.conversation_history) - 1 < drafts_limit:
+            done = len(self.conversation_history) - 1
+            batch_size = min(self.concurrency, drafts_limit - done)
+            prompts = [
+                f"{DRAFT_PERSPECTIVES[done + i]}\n\n{query}"
+                for i in range(batch_size)
+            ]
+
+            drafts = await asyncio.gather(
+                *(self._query(prompt) for prompt in prompts)
+            )
+
+            previous_drafts = self.conversation_history[1:]
+            self.conversation_history.extend(drafts)
+
+            # Останавливаемся, если все новые черновики повторяют уже полученные
+            if previous_drafts and all(
+                self._converged(draft, previous_drafts) for draft in drafts
+            ):
+                break
+
+    async def _query(self, prompt: str) -> str:
+        """Отправляет один запрос модели"""
+        return await self.provider.generate(
+            [{"role": "user", "content": prompt}],
+            self.model
+        )
+
+    def _converged(self, response: str, previous: List[str]) -> bool:
+        """Проверяет, похож ли ответ на один из предыдущих"""
+        if not self.similarity_threshold:
+            return False
+        return any(
+            self._similarity(response, other) >= self.similarity_threshold
+            for other in previous
+        )
+
+    @staticmethod
+    def _similarity(first: str, second: str) -> float:
+        """Сходство двух текстов по множествам слов (коэффициент Жаккара)"""
+        first_words = set(re.findall(r'\w+', first.lower()))
+        second_words = set(re.findall(r'\w+', second.lower()))
+        if not first_words and not second_words:
+            return 1.0
+        return len(first_words & second_words) / len(first_words | second_words)
+
+    def _truncate(self, text: str) -> str:
+        """Обрезает текст до бюджета промпта"""
+        if self.max_prompt_chars and len(text) > self.max_prompt_chars:
+            return text[:self.max_prompt_chars]
+        return text
+
+    def _fit_budget(self, parts: List[str], used: int = 0) -> List[str]:
+        """Оставляет самые поздние части, помещающиеся в бюджет промпта"""
+        if not self.max_prompt_chars:
+            return parts
+
+        selected = []
+        for part in reversed(parts):
+            if used + len(part) > self.max_prompt_chars and selected:
+                break
+            selected.append(self._truncate(part))
+            used += len(part)
+        return list(reversed(selected))
+
     def clear_history(self):
         """Очищает историю размышлений"""
         self.conversation_history.clear()
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# Максимум обновлений в очереди одного процесса
+WORKER_QUEUE_SIZE = 10000
+
+
+def get_update_user_id(update: dict) -> int:
+    """Определяет пользователя, к которому относится обновление (сырой JSON от Telegram)"""
+    for field, event in update.items():
+        if field == 'update_id' or not isinstance(event, dict):
+            continue
+        
+        # Сообщения, callback'и, inline-запросы и т.п.
+        sender = event.get('from') or event.get('user')
+        if isinstance(sender, dict) and 'id' in sender:
+            return sender['id']
+        
+        # Обновления без отправителя (например, посты в каналах)
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    
+    return 0
+
+
+def get_shard(update: dict, workers: int) -> int:
+    """Номер процесса, который обрабатывает обновление"""
+    return abs(get_update_user_id(update)) % workers
+
+
+class WorkerPool:
+    """
+    Набор процессов-обработчиков.
+    У каждого процесса своя очередь, обновления распределяются по user_id.
+    """
+    
+    def __init__(self, workers: int, target: Callable):
+        """
+        :param workers: количество процессов
+        :param target: функция процесса target(worker_id, queue), должна быть
+                       определена на уровне модуля (процессы запускаются через spawn)
+        """
+        self.workers = workers
+        self.target = target
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self._processes = [None] * workers
+        self.dispatched = [0] * workers
+    
+    def start(self):
+        """Запускает все процессы"""
+        for worker_id in range(self.workers):
+            self._start_worker(worker_id)
+        logger.info(f"Started {self.workers} workers")
+    
+    def _start_worker(self, worker_id: int):
+        """Запускает (или перезапускает) процесс с указанным номером"""
+        process = self._context.Process(
+            target=self.target,
+            args=(worker_id, self._queues[worker_id]),
+            name=f"bot-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self._processes[worker_id] = process
+    
+    def dispatch(self, update: dict):
+        """Передает обновление процессу, отвечающему за пользователя"""
+        worker_id = get_shard(update, self.workers)
+        
+        # Упавший процесс перезапускаем, его очередь сохраняется
+        if not self._processes[worker_id].is_alive():
+            logger.warning(f"Worker {worker_id} is dead, restarting")
+            self._start_worker(worker_id)
+        
+        try:
+            self._queues[worker_id].put_nowait(update)
+            self.dispatched[worker_id] += 1
+        except queue.Full:
+            logger.error(f"Worker {worker_id} queue is full, update {update.get('update_id')} dropped")
+    
+    def is_healthy(self) -> bool:
+        """Все процессы запущены и работают"""
+        return all(process and process.is_alive() for process in self._processes)
+    
+    def stats(self) -> dict:
+        """Состояние процессов и количество переданных им обновлений"""
+        return {
+            'workers': self.workers,
+            'alive': sum(1 for process in self._processes if process and process.is_alive()),
+            'dispatched': list(self.dispatched)
+        }
+    
+    def stop(self, timeout: float = 30.0):
+        """Останавливает процессы, дав им обработать оставшиеся обновления"""
+        for worker_queue in self._queues:
+            try:
+                worker_queue.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+        
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {process.name} did not stop in time, terminating")
+                process.terminate()
+        logger.info("Workers stopped")
+
+
+async def consume_updates(worker_queue, handle: Callable[[dict], Awaitable]):
+    """
+    Читает обновления из очереди процесса и обрабатывает их параллельно.
+    Завершается, когда основной процесс передает None.
+    """
+    tasks = set()
+    
+    async def run(update: dict):
+        try:
+            await handle(update)
+        except Exception as e:
+            logger.error(f"Error handling update {update.get('update_id')}: {e}")
+    
+    while True:
+        try:
+            update = await asyncio.to_thread(worker_queue.get, True, 1.0)
+        except queue.Empty:
+            continue
+        
+        if update is None:
+            break
+        
+        task = asyncio.create_task(run(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    
+    # Дожидаемся обработки уже полученных обновлений
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
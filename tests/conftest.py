@@ -0,0 +1,7 @@
+import os
+import sys
+
+# config.py требует токен бота при импорте
+os.environ.setdefault("TELEGRAM_TOKEN", "test-token")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,41 @@
+import asyncio
+import html
+import re
+from types import SimpleNamespace
+
+from handlers import commands
+
+# Теги и сущности, которые Telegram принимает в сообщениях с ParseMode.HTML.
+# Остальные символы <, > и & должны быть экранированы, иначе Telegram
+# отклоняет сообщение с ошибкой "can't parse entities"
+_TELEGRAM_TAG_RE = re.compile(
+    r'</?(?:b|strong|i|em|u|ins|s|strike|del|span|tg-spoiler|a|tg-emoji|code|pre|blockquote)(?:\s[^<>]*)?>'
+)
+_ENTITY_RE = re.compile(r'&(?:lt|gt|amp|quot|#\d+|#x[0-9a-fA-F]+);')
+
+
+def assert_telegram_html(text: str):
+    """Проверяет, что текст можно отправить с ParseMode.HTML"""
+    rest = _ENTITY_RE.sub('', _TELEGRAM_TAG_RE.sub('', text))
+    unescaped = re.findall(r'[<>&]', rest)
+    assert not unescaped, f"Unescaped HTML characters: {unescaped}"
+
+
+class FakeMessage:
+    """Сообщение, которое запоминает отправленные ответы"""
+    
+    def __init__(self):
+        self.from_user = SimpleNamespace(id=1)
+        self.replies = []
+    
+    async def reply(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def test_help_text_is_valid_telegram_html():
+    message = FakeMessage()
+    asyncio.run(commands.cmd_help(message))
+    
+    assert len(message.replies) == 1
+    assert_telegram_html(message.replies[0])
+    assert "/search <запрос>" in html.unescape(message.replies[0])
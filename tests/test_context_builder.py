@@ -0,0 +1,37 @@
+import asyncio
+
+from services import context_builder
+from services.context_builder import ContextBuilder
+
+
+def make_history(newest_id: int, count: int) -> list:
+    """История от новых сообщений к старым"""
+    return [
+        {'id': message_id, 'role': "user", 'content': f"сообщение {message_id}"}
+        for message_id in range(newest_id, newest_id - count, -1)
+    ]
+
+
+def test_older_messages_refresh_is_not_scheduled_every_turn(monkeypatch):
+    async def get_chat_summary(chat_id):
+        return {'summary': "кратко", 'last_message_id': 1}
+    
+    async def find_relevant_messages(*args, **kwargs):
+        return []
+    
+    monkeypatch.setattr(context_builder, "SUMMARY_ENABLED", True)
+    monkeypatch.setattr(context_builder, "SUMMARY_MIN_NEW_MESSAGES", 6)
+    monkeypatch.setattr(context_builder.db, "get_chat_summary", get_chat_summary)
+    monkeypatch.setattr(context_builder.db, "find_relevant_messages", find_relevant_messages)
+    
+    builder = ContextBuilder(provider=None, history_limit=10)
+    scheduled = []
+    monkeypatch.setattr(builder, "_schedule_refresh", lambda *args: scheduled.append(args))
+    
+    # Вся загруженная история помещается в окно, но старше нее есть не свернутые сообщения.
+    # Каждый ход добавляет сообщение пользователя и ответ
+    for newest_id in range(100, 120, 2):
+        asyncio.run(builder.build_messages(1, make_history(newest_id, 10), "model"))
+    
+    # Первая проверка и затем не чаще раза в 6 новых сообщений
+    assert len(scheduled) == 4
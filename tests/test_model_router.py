@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+from services.model_router import ModelRouter
+
+
+class DelayedProvider:
+    """Поставщик, у которого каждая модель начинает ответ с заданной задержкой"""
+    
+    def __init__(self, delays: dict):
+        self.delays = delays
+        self.started = []
+    
+    async def generate(self, messages: list, model: str) -> str:
+        await asyncio.sleep(self.delays[model])
+        return model
+    
+    async def stream(self, messages: list, model: str):
+        self.started.append(model)
+        await asyncio.sleep(self.delays[model])
+        for part in (model, " ok"):
+            yield part
+
+
+async def collect(router: ModelRouter, model: str) -> str:
+    return "".join([chunk async for chunk in router.stream([], model)])
+
+
+def test_stream_falls_back_when_first_chunk_misses_slo():
+    provider = DelayedProvider({'slow': 5.0, 'fast': 0.0})
+    router = ModelRouter(provider, fallback_chain=['fast'], latency_slo=0.1, hedging=False)
+    
+    started = time.monotonic()
+    response = asyncio.run(collect(router, 'slow'))
+    
+    assert response == "fast ok"
+    assert time.monotonic() - started < 1.0
+    assert provider.started == ['slow', 'fast']
+    assert router.fallbacks == 1
+    assert router.model_stats['slow'].error_rate() == 1.0
+
+
+def test_stream_waits_for_last_model_in_chain():
+    provider = DelayedProvider({'slow': 0.3})
+    router = ModelRouter(provider, fallback_chain=[], latency_slo=0.05, hedging=False)
+    
+    assert asyncio.run(collect(router, 'slow')) == "slow ok"
+    assert router.fallbacks == 0